@@ -1,13 +1,28 @@
 #!/usr/bin/env python3
 
-from collections import Counter, defaultdict
+from collections import Counter, defaultdict, namedtuple
+from pathlib import Path
+import argparse
+import codecs
 import json
+import multiprocessing
 import os
 import random
 import re
 import sys
 import urllib.parse
 
+try:
+    import publicsuffix2
+except ImportError:
+    publicsuffix2 = None  # Only needed for writing v3 files, which contain the registrable domains.
+
+# Imported by the server through the symlinks in storage/:
+try:
+    from storage import extract_cleanup_binary as cleanup_binary
+except ImportError:
+    import cleanup_binary
+
 
 EASY_REPAIRS = [
     (re.compile(r"^http(s?):///(?![\\/])"), r"http\1://"),
@@ -22,6 +37,10 @@ EASY_REPAIRS = [
     (re.compile(r"^([^#?]+)\?(#[^#?]+)?$"), r"\1\2"),
     (re.compile(r"^http://https://(?![\\/])"), r"https://"),
 ]
+# Matches every URL that at least one of the EASY_REPAIRS might change, i.e. a broken "http" prefix,
+# "http://https://", or a trailing "#" or "?" (or "?#…"). Most URLs don't match, and skip EASY_REPAIRS entirely.
+# Note that "$" also matches before a trailing newline, exactly like in EASY_REPAIRS.
+RE_NEEDS_EASY_REPAIR = re.compile(r"^http(?!s?://[^\\/])|^http://https://|[#?]$|\?#")
 RE_MULTI_VALUE = re.compile("[,;] ?(?=http)")
 NORMAL_URL_CHARS = "abcdefghijklmnopqrstuvwxyzäöüßABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÜ0123456789:/.?=&!#%()*+,-;@[]_{|}~$ "
 DISASTROUS_CHARACTERS_BYTES = [
@@ -33,8 +52,74 @@ DISASTROUS_CHARACTERS_BYTES = [
     b'\xe2\x80\x90',
 ]
 RE_BARE_IP = re.compile(r"^[0-9.:]+$")
+RE_JSON_WHITESPACE = re.compile(r"[ \t\n\r]*")
+# If a number is followed only by these until the end of the buffer, the number might continue in the next chunk:
+RE_JSON_NUMBER_TAIL = re.compile(r"[0-9.eE+-]*")
+JSON_STREAM_CHUNK_SIZE = 1 << 20
 
 DISASTROUS_CHARACTERS = [ch.decode() for ch in DISASTROUS_CHARACTERS_BYTES]
+# The server keeps the authoritative copy of the PSL. Note that this path also works when this file is
+# imported through the symlink monosmdom_server/storage/extract_cleanup.py, thanks to resolve():
+DEFAULT_PSL_FILENAME = Path(__file__).resolve().parent.parent / "monosmdom_server/storage/data/public_suffix_list.dat"
+RAW_URLFILE_TYPE = "monitor-osm-domains extraction results"
+URLFILE_TYPE = "monitor-osm-domains extraction results, filtered"
+URLFILE_VERSIONS = [2, 3]
+OUTPUT_FORMATS = ["json", "binary"]
+DISASTER_SAMPLE_SIZE = 10
+# Many URLs share the same hostname, so there's no point in walking the PSL for each of them again.
+# A Germany-sized import has about 422k Domains, and even more hostnames, so a smaller cache would
+# just thrash. Each entry takes roughly 300 bytes, so this is about 150 MB. That's why a cache of this size
+# only lives for the duration of a single cleanup or import (see large_hostname_cache in storage/logic.py).
+HOSTNAME_CACHE_SIZE = 1 << 19
+# With --jobs, each worker process handles this many tag values at a time:
+PARALLEL_CHUNK_SIZE = 10_000
+
+# Some hostnames appear way too often in the dataset, and are uninteresting for our purposes.
+# These services are likely to work equally well as each other, so checking thousands of URLs is pointless.
+# Some of the pages on these servers are actually broken (i.e. 404), but I can't easily fix them.
+# I'd be happy to collaborate with you on fixing these.
+# My focus for now is finding dead domains, offline webservers, etc.
+IGNORED_HOSTNAMES = {
+    "qr.bvg.de",  # Haltestellen Berlin, 7363 URLs
+    "fahrinfo.vbb.de",  # Haltestellen Berlin-Brandenburg, 3956 URLs
+    "ns.gis-bldam-brandenburg.de",  # Denkmale in Brandenburg, 2228 URLs
+    "www.wuppertal.de", "wuppertal.de",  # Denkmale and attractions in Wuppertal, >2128 URLs
+    "gisdata.krzn.de",  # Denkmale, GIS data, and attractions in NRW, 1592 URLs
+    "www.denkmalpflege.bremen.de", "denkmalpflege.bremen.de",  # Denkmale Bremen, >1462 URLs
+    "www.stadtwerke-muenster.de", "stadtwerke-muenster.de",  # Haltestellen Münster, >1314 URLs
+    "www.stolpersteine-berlin.de", "stolpersteine-berlin.de",  # Stolpersteine Berlin, >1075 URLs
+    "www.suehnekreuz.de", "suehnekreuz.de",  # Mahnkreuze, Germany-wide, >1008 URLs
+    "www.dortmund.de", "dortmund.de",  # ??? mostly dead links, Dortmund, >944 URLs
+    "kulturdb.de",  # Mahnkreuze, Germany-wide, 884 URLs
+    "www.rewe.de", "rewe.de",  # Discounter, Germany-wide, >866 URLs
+    "www.edeka.de", "edeka.de",  # Discounter, Germany-wide, >822 URLs
+    "denkmaldatenbank.berlin.de",  # Denkmale Berlin, 810 URLs
+    "rips-dienste.lubw.baden-wuerttemberg.de",  # Naturschutzgebiete BaWü, 746 URLs
+    "www.museenkoeln.de", "museenkoeln.de",  # Stolpersteine Köln, mostly dead links, >663 URLs
+    "db-sandsteinklettern.gipfelbuch.de",  # Gipfelbücher, 643 URLs
+    # If you don't know it be glad, >638 URLs:
+    "www.facebook.com", "www.facebook.de", "de-de.facebook.com", "m.facebook.com", "facebook.com",
+    "www.spessartprojekt.de", "spessartprojekt.de",  # Naturschutzgebiete(?) Spessart, monstly dead links, >621 URLs
+    "nsg.naturschutzinformationen.nrw.de",  # Naturschutzgebiete NRW, 618 URLs
+    "gdi.essen.de",  # ALL DEAD LINKS, wtf, 601 URLs
+    "de.wikipedia.org", "de.m.wikipedia.org",  # You already know, >583 URLs
+    "vertretung.allianz.de",  # Store managers(?) of Allianz, 570 URLs
+    "www.nlwkn.niedersachsen.de", "nlwkn.niedersachsen.de",  # Naturschutzgebiete Niedersachsen, >556 URLs
+    # -- I didn't check the following domains, but it seems reasonable to skip them.
+    "www.denkmalprojekt.org", "denkmalprojekt.org",  # >486 URLs
+    "www.aldi-nord.de", "aldi-nord.de", "www.aldi-sued.de", "aldi-sued.de", "aldi.de",  # >438 URLs
+    "www.magdeburg.de", "magdeburg.de",  # >415 URLs
+    "www.berlin.de", "berlin.de",  # 411 URLs
+    "youtu.be", "www.youtube.com", "youtube.com",  # >385 URLs
+    "wuerzburgwiki.de",  # 371 URLs
+    "www.outdoor-karte.de", "outdoor-karte.de",  # >368 URLs
+    "www.lidl.de", "lidl.de",  # 360 URLs
+    "polska-org.pl",  # 360 URLs
+    "www.netto-online.de", "netto-online.de",  # >357 URLs
+    # This eliminates over 37k out of 572k URLs.
+    # It may be less than 10%, but it's saved work/traffic/energy nonetheless.
+    # Since we avoid recently-queried domains, this only has an effect in the long run.
+}
 
 
 class DisasterUrl:
@@ -54,12 +139,126 @@ class DisasterEncoder(json.JSONEncoder):
         return json.JSONEncoder.default(self, obj)
 
 
-def repair_easy_stuff(url):
+class JsonStreamReader:
+    """
+    Incrementally parses a JSON document from a binary file object, without ever holding the entire
+    document in memory. Small values are parsed in one go (read_value), whereas huge objects and
+    arrays can be walked entry by entry (iter_object_keys, iter_object_items, iter_array).
+    This is used by the server (as storage.extract_cleanup) to read *.monosmdom.json files, which
+    are way too large to be loaded as a whole.
+    """
+
+    def __init__(self, fp, chunk_size=JSON_STREAM_CHUNK_SIZE):
+        self._fp = fp
+        self._chunk_size = chunk_size
+        self._decoder = json.JSONDecoder()
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self._buf = ""
+        self._pos = 0
+        self._eof = False
+        # Number of bytes consumed from the underlying file, which may run ahead by one chunk:
+        self.bytes_read = 0
+
+    def _refill(self):
+        if self._eof:
+            return False
+        chunk = self._fp.read(self._chunk_size)
+        self.bytes_read += len(chunk)
+        if chunk:
+            text = self._utf8.decode(chunk)
+        else:
+            self._eof = True
+            text = self._utf8.decode(b"", final=True)
+        # Drop everything that has already been consumed, so the buffer stays small:
+        self._buf = self._buf[self._pos:] + text
+        self._pos = 0
+        return True
+
+    def _peek(self):
+        """Skips whitespace, and returns the next character, or "" at the end of the file."""
+        while True:
+            self._pos = RE_JSON_WHITESPACE.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._refill():
+                return ""
+
+    def _expect(self, chars):
+        ch = self._peek()
+        if not ch or ch not in chars:
+            raise ValueError(f"Expected one of {chars!r} near byte {self.bytes_read}, got {ch!r} instead")
+        self._pos += 1
+        return ch
+
+    def read_value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                # Probably just cut off at the end of the buffer. If not, the retry will tell.
+                if self._refill():
+                    continue
+                raise
+            is_number = isinstance(value, (int, float)) and not isinstance(value, bool)
+            if is_number and RE_JSON_NUMBER_TAIL.fullmatch(self._buf, end) and self._refill():
+                # The number might have been cut short by the chunk boundary, e.g. "1.25" as "1."
+                # parses as 1, followed by ".". Only accept it once a delimiter follows. Parse it again:
+                continue
+            self._pos = end
+            return value
+
+    def iter_object_keys(self):
+        """
+        Yields the keys of an object. Before advancing the iterator, the caller MUST consume the
+        corresponding value, e.g. with read_value() or one of the nested iter_* methods.
+        """
+        self._expect("{")
+        if self._peek() == "}":
+            self._pos += 1
+            return
+        while True:
+            key = self.read_value()
+            if not isinstance(key, str):
+                raise ValueError(f"Expected object key near byte {self.bytes_read}, got {key!r} instead")
+            self._expect(":")
+            yield key
+            if self._expect(",}") == "}":
+                return
+
+    def iter_object_items(self):
+        for key in self.iter_object_keys():
+            yield key, self.read_value()
+
+    def iter_array(self):
+        self._expect("[")
+        if self._peek() == "]":
+            self._pos += 1
+            return
+        while True:
+            yield self.read_value()
+            if self._expect(",]") == "]":
+                return
+
+    def expect_eof(self):
+        ch = self._peek()
+        if ch:
+            raise ValueError(f"Expected end of file near byte {self.bytes_read}, got {ch!r} instead")
+
+
+def repair_easy_stuff_thoroughly(url):
     for regex, replacement in EASY_REPAIRS:
         url = regex.sub(replacement, url)
     return url
 
 
+def repair_easy_stuff(url):
+    # Same result as repair_easy_stuff_thoroughly, but much faster for the usual, well-formed URL.
+    if RE_NEEDS_EASY_REPAIR.search(url) is None:
+        return url
+    return repair_easy_stuff_thoroughly(url)
+
+
 def selftest():
     fails = 0
     tests = 0
@@ -120,41 +319,112 @@ def selftest():
         (r"https.//example.de", r"https://example.de"),
         (r"http//:example.de", r"http://example.de"),
         (r"https//:example.de", r"https://example.de"),
+        # Near misses of RE_NEEDS_EASY_REPAIR:
+        (r"http://https://example.de/x?", r"https://example.de/x"),
+        (r"https://example.com/foo?#bar?", None),
+        ("https://example.com/#\n", "https://example.com/\n"),
+        (r"www.example.com/?", r"www.example.com/"),
+        (r"www.example.com/?#", r"www.example.com/"),
+        (r"httpsexample.com", None),
     ]:
-        actual = repair_easy_stuff(given)
-        tests += 1
         if expected is None:
             expected = given
         else:
             assert given != expected, given
-        if actual == expected:
-            continue
-        print(f"FAIL: {given=} {expected=} {actual=}")
-        fails += 1
+        for function in [repair_easy_stuff, repair_easy_stuff_thoroughly]:
+            actual = function(given)
+            tests += 1
+            if actual == expected:
+                continue
+            print(f"FAIL: {function.__name__}: {given=} {expected=} {actual=}")
+            fails += 1
     print(f"Selftest completed: Ran {tests} tests, encountered {fails} failure(s).", file=sys.stderr)
     if fails:
         exit(100)
 
 
-def simplify_regex(old_findings, disasters):
+# The result of preprocess_parallel:
+# - splits: Tag value to the result of split_tag_value
+# - semantic: Regexed URL to the result of simplified_url_or_disaster_reason
+# - all_seen_chars: Exactly what simplify_semantically would count
+Preprocessed = namedtuple("Preprocessed", ["splits", "semantic", "all_seen_chars"])
+
+
+def split_tag_value(orig_url):
+    """
+    Returns a list of (regexed_url, None) for each URL in the tag value, or [(orig_url, disaster_reason)]
+    if the entire tag value is cursed.
+    """
+    for ch in DISASTROUS_CHARACTERS:
+        if ch in orig_url:
+            # Don't break it up into constituent URLs; this tag value is cursed anyway.
+            return [(orig_url, f"Weird character {ch.encode()}")]
+    return [(repair_easy_stuff(partial_url), None) for partial_url in RE_MULTI_VALUE.split(orig_url)]
+
+
+def split_finding(entry, preprocessed=None):
+    """
+    Like split_tag_value, for the tag value of the finding. Also remembers the tag value in each occurrence-object.
+    """
+    orig_url = entry["url"]
+    for occ in entry["occ"]:
+        occ["orig_url"] = orig_url
+    if preprocessed is not None:
+        return preprocessed.splits[orig_url]
+    return split_tag_value(orig_url)
+
+
+def preprocess_chunk(orig_urls):
+    # Runs in a worker process, see preprocess_parallel.
+    splits = []
+    semantic = dict()
+    all_seen_chars = Counter()
+    for orig_url in orig_urls:
+        split = split_tag_value(orig_url)
+        splits.append(split)
+        for parse_url, disaster_reason in split:
+            if disaster_reason is not None or parse_url in semantic:
+                continue
+            semantic[parse_url] = simplified_url_or_disaster_reason(parse_url)
+            if semantic[parse_url][1] is None:
+                all_seen_chars.update(parse_url)
+    return splits, semantic, all_seen_chars
+
+
+def preprocess_parallel(old_findings, jobs, chunk_size=PARALLEL_CHUNK_SIZE):
+    """
+    Does the expensive, but stateless part of simplify_regex and simplify_semantically (i.e. the
+    regexes, urlsplit, and counting characters) in jobs worker processes. The rest still happens in
+    order, in this process, so the result is exactly the same as without workers.
+    """
+    orig_urls = [entry["url"] for entry in old_findings]
+    chunks = [orig_urls[begin : begin + chunk_size] for begin in range(0, len(orig_urls), chunk_size)]
+    preprocessed = Preprocessed(dict(), dict(), Counter())
+    # Like update_osm_state --jobs, use "fork" so that the workers don't need to import anything again.
+    with multiprocessing.get_context("fork").Pool(jobs) as pool:
+        # Note that imap returns the results in order, which keeps all_seen_chars in the same order
+        # as in simplify_semantically, and thus the report.
+        for chunk, (splits, semantic, all_seen_chars) in zip(chunks, pool.imap(preprocess_chunk, chunks), strict=True):
+            preprocessed.splits.update(zip(chunk, splits, strict=True))
+            for parse_url, result in semantic.items():
+                if parse_url in preprocessed.semantic:
+                    # An earlier chunk already counted this regexed URL:
+                    if result[1] is None:
+                        all_seen_chars.subtract(parse_url)
+                    continue
+                preprocessed.semantic[parse_url] = result
+            preprocessed.all_seen_chars.update(all_seen_chars)
+    return preprocessed
+
+
+def simplify_regex(old_findings, disasters, preprocessed=None):
     by_regexed_url = defaultdict(list)  # Regexed URL string to list of occurrence-objects
     for entry in old_findings:
-        orig_url = entry["url"]
-        for occ in entry["occ"]:
-            occ["orig_url"] = orig_url
-        is_disaster = False
-        for ch in DISASTROUS_CHARACTERS:
-            if ch in orig_url:
-                disaster = disasters[orig_url]
-                disaster.extend(f"Weird character {ch.encode()}", entry["occ"])
-                is_disaster = True
-                break
-        if is_disaster:
-            # Don't break it up into constituent URLs; this tag value is cursed anyway.
-            continue
-        for partial_url in RE_MULTI_VALUE.split(orig_url):
-            parse_url = repair_easy_stuff(partial_url)
-            by_regexed_url[parse_url].extend(entry["occ"])
+        for url, disaster_reason in split_finding(entry, preprocessed):
+            if disaster_reason is not None:
+                disasters[url].extend(disaster_reason, entry["occ"])
+            else:
+                by_regexed_url[url].extend(entry["occ"])
     return by_regexed_url
 
 
@@ -221,78 +491,236 @@ def simplified_url_or_disaster_reason(parse_url):
     return simplified_url, None
 
 
-def simplify_semantically(by_regexed_url, disasters):
+def strict_sld_and_interest_by_hostname(psl, hostname):
+    # Note that we must use the hostname for the interest check, and not the second-level-domain.
+    # See get_strict_sld_and_interest in monosmdom_server/storage/logic.py for examples.
+    sld_or_none = psl.get_sld(hostname, strict=True)
+    have_interest = hostname not in IGNORED_HOSTNAMES
+    return sld_or_none, have_interest
+
+
+def load_psl(psl_filename):
+    assert publicsuffix2 is not None, (
+        "Writing v3 files requires publicsuffix2, try 'pip3 install publicsuffix2' or '--format-version 2'"
+    )
+    with open(psl_filename, "r", encoding="utf8") as fp:
+        return publicsuffix2.PublicSuffixList(fp)
+
+
+def simplify_semantically(by_regexed_url, disasters, preprocessed=None):
     by_simplified_url = defaultdict(list)  # Simplified URL string to list of occurrence-objects
     all_seen_chars = Counter()
     for parse_url, occs in by_regexed_url.items():
-        simplified_url, disaster_reason = simplified_url_or_disaster_reason(parse_url)
+        if preprocessed is not None:
+            simplified_url, disaster_reason = preprocessed.semantic[parse_url]
+        else:
+            simplified_url, disaster_reason = simplified_url_or_disaster_reason(parse_url)
         assert (simplified_url is None) != (disaster_reason is None), parse_url
         if disaster_reason is not None:
             disaster = disasters[parse_url]
             disaster.extend(disaster_reason, occs)
             continue
-        all_seen_chars.update(parse_url)
+        if preprocessed is None:
+            all_seen_chars.update(parse_url)
         by_simplified_url[simplified_url].extend(occs)
+    if preprocessed is not None:
+        all_seen_chars = preprocessed.all_seen_chars
     return by_simplified_url, all_seen_chars
 
 
-def report_stats(old_findings, by_simplified_url, disasters):
-    print(f"{len(old_findings)} unique tag-values resulted in {len(by_simplified_url)} unique simplified URLs.")
-    random_disasters = list(disasters.items())
-    random.shuffle(random_disasters)
-    random_disasters = random_disasters[:10]
-    print(f"Random sampling of {len(random_disasters)} of {len(disasters)} disastrous URLs:")
-    for disaster in random_disasters:
-        print(f" - {disaster[0]} ({disaster[1].reasons})")
+def classify_domains(by_simplified_url, disasters, psl):
+    # This is exactly the semantical and interest check that the server would otherwise do during import.
+    # The output is sorted by registrable domain, so that all URLs of a domain end up next to each other.
+    by_hostname = dict()
+    classified_urls = []
+    for simplified_url, occs in by_simplified_url.items():
+        hostname = urllib.parse.urlsplit(simplified_url).hostname
+        sld_and_interest = by_hostname.get(hostname)
+        if sld_and_interest is None:
+            sld_and_interest = strict_sld_and_interest_by_hostname(psl, hostname)
+            by_hostname[hostname] = sld_and_interest
+        sld, have_interest = sld_and_interest
+        if sld is None:
+            disasters[simplified_url].extend("has no public suffix", occs)
+            continue
+        classified_urls.append((sld, simplified_url, have_interest, occs))
+    classified_urls.sort(key=lambda entry: (entry[0], entry[1]))
+    return {
+        simplified_url: dict(d=sld, i=have_interest, occs=occs)
+        for sld, simplified_url, have_interest, occs in classified_urls
+    }
+
+
+def reservoir_sample(items, sample_size):
+    """
+    Returns a uniformly random sample of sample_size items (or all of them, if there are fewer),
+    without ever holding more than that in memory. This is "Algorithm R".
+    """
+    sample = []
+    for index, item in enumerate(items):
+        if index < sample_size:
+            sample.append(item)
+            continue
+        replace_index = random.randrange(index + 1)
+        if replace_index < sample_size:
+            sample[replace_index] = item
+    return sample
+
+
+def report_stats(num_findings, num_simplified_urls, num_disasters, disaster_sample):
+    # disaster_sample contains (url, reasons) pairs, see reservoir_sample.
+    print(f"{num_findings} unique tag-values resulted in {num_simplified_urls} unique simplified URLs.")
+    print(f"Random sampling of {len(disaster_sample)} of {num_disasters} disastrous URLs:")
+    for url, reasons in disaster_sample:
+        print(f" - {url} ({reasons})")
+
+
+def report_funky_chars(all_seen_chars):
+    # Warn about weird characters:
+    for boring_char in NORMAL_URL_CHARS:
+        del all_seen_chars[boring_char]
+    interesting_chars = list(all_seen_chars.most_common())
+    if interesting_chars:
+        print("Saw some funky characters:")
+        for char, count in interesting_chars:
+            print(f"    {count} times >>{char}<< → {str(char.encode())}")
 
 
-def cleanup(data):
+def cleanup(data, psl=None, *, jobs=1):
+    """
+    Without a psl, writes a v2 file, in which "simplified_urls" maps each URL to its list of occurrences.
+    With a psl, writes a v3 file, in which "simplified_urls" maps each URL to a dict with the keys
+    "d" (registrable domain), "i" (interest, i.e. hostname not ignored), and "occs" (the list of
+    occurrences), sorted by domain. URLs without a public suffix are moved to the disasters instead.
+    With jobs > 1, the result is exactly the same, but most of the work happens in worker processes.
+    """
     assert data["v"] == 2
-    assert data["type"] == "monitor-osm-domains extraction results"
-    data["type"] = "monitor-osm-domains extraction results, filtered"
+    assert data["type"] == RAW_URLFILE_TYPE
+    data["type"] = URLFILE_TYPE
     old_findings = data["findings"]
     del data["findings"]
     disasters = defaultdict(DisasterUrl)  # Original or simplified URL to list of occurrence-objects and set of reasons
     data["disasters"] = disasters
 
+    preprocessed = None
+    if jobs > 1:
+        print(f"Preprocessing with {jobs} processes …")
+        preprocessed = preprocess_parallel(old_findings, jobs)
+
     # Break down all tag values into singular URLs, potentially already rejecting
     # some terrible values, or grouping entries with the same regexed URL.
     print("Simplifying by regex …")
-    by_regexed_url = simplify_regex(old_findings, disasters)
+    by_regexed_url = simplify_regex(old_findings, disasters, preprocessed)
 
     # Parse URLs, simplify semantically. This can cause disasters when we discover
     # login information, have unexplained data loss, or discover a non-standard port.
     print("Simplifying semantically …")
-    by_simplified_url, all_seen_chars = simplify_semantically(by_regexed_url, disasters)
+    by_simplified_url, all_seen_chars = simplify_semantically(by_regexed_url, disasters, preprocessed)
     data["simplified_urls"] = by_simplified_url
 
-    report_stats(old_findings, by_simplified_url, disasters)
+    if psl is not None:
+        # Determine registrable domains and interest, which the server can then trust.
+        print("Classifying domains …")
+        data["v"] = 3
+        data["simplified_urls"] = classify_domains(by_simplified_url, disasters, psl)
 
-    # Warn about weird characters:
-    for boring_char in NORMAL_URL_CHARS:
-        del all_seen_chars[boring_char]
-    interesting_chars = list(all_seen_chars.most_common())
-    if interesting_chars:
-        print("Saw some funky characters:")
-        for char, count in interesting_chars:
-            print(f"    {count} times >>{char}<< → {str(char.encode())}")
+    disaster_sample = reservoir_sample(
+        ((url, disaster.reasons) for url, disaster in disasters.items()), DISASTER_SAMPLE_SIZE
+    )
+    report_stats(len(old_findings), len(by_simplified_url), len(disasters), disaster_sample)
+    report_funky_chars(all_seen_chars)
 
 
-def run(input_filename, output_filename):
+def run(
+    input_filename,
+    output_filename,
+    *,
+    format_version=3,
+    psl_filename=DEFAULT_PSL_FILENAME,
+    output_format="json",
+    streaming=False,
+    jobs=1,
+):
+    assert format_version in URLFILE_VERSIONS, format_version
+    assert output_format in OUTPUT_FORMATS, output_format
+    assert jobs >= 1, jobs
+    assert jobs == 1 or not streaming, "--jobs is not supported in --streaming mode"
     if os.path.exists(output_filename):
         print(f"Refusing to overwrite {output_filename}")
+    psl = None
+    if format_version >= 3:
+        psl = load_psl(psl_filename)
+    if streaming:
+        # Lives next to this file, and needs this module in turn:
+        try:
+            from storage import extract_cleanup_streaming as cleanup_streaming
+        except ImportError:
+            import cleanup_streaming
+
+        cleanup_streaming.run_streaming(input_filename, output_filename, psl, output_format)
+        return
     with open(input_filename, "r") as fp:
         data = json.load(fp)
-    cleanup(data)
+    cleanup(data, psl, jobs=jobs)
     print(f"Writing to {output_filename} …")
-    with open(output_filename, "w") as fp:
-        json.dump(data, fp, cls=DisasterEncoder)
+    if output_format == "binary":
+        with open(output_filename, "wb") as fp:
+            cleanup_binary.write_binary(data, fp)
+    else:
+        with open(output_filename, "w") as fp:
+            json.dump(data, fp, cls=DisasterEncoder)
     print("All done! Results written to file.")
 
 
+def make_parser():
+    parser = argparse.ArgumentParser(
+        description="Cleans up the raw output of 'extract', so that it can be imported by the server.",
+    )
+    parser.add_argument("input_filename", metavar="/path/to/input/raw.monosmdom.json")
+    parser.add_argument("output_filename", metavar="/path/to/output/all.monosmdom.json")
+    parser.add_argument(
+        "--format-version",
+        help="Version of the written file. "
+        "v3 precomputes the registrable domains (default), v2 does not need publicsuffix2.",
+        type=int,
+        choices=URLFILE_VERSIONS,
+        default=3,
+    )
+    parser.add_argument(
+        "--output-format",
+        help="json (default) or the much more compact binary format, which the server can import just the same",
+        choices=OUTPUT_FORMATS,
+        default="json",
+    )
+    parser.add_argument(
+        "--psl",
+        help=f"Path to the public suffix list (default: {DEFAULT_PSL_FILENAME})",
+        default=DEFAULT_PSL_FILENAME,
+    )
+    parser.add_argument(
+        "--streaming",
+        help="Use a bounded amount of memory, by spilling to temporary files ($TMPDIR). "
+        "Slower, and disasters (and v2 URLs) end up sorted by URL.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--jobs",
+        help="Number of worker processes for simplifying the URLs (default: 1). The result is exactly the same.",
+        type=int,
+        default=1,
+    )
+    return parser
+
+
 if __name__ == "__main__":
     selftest()
-    if len(sys.argv) != 3:
-        print(f"USAGE: {sys.argv[0]} /path/to/input/raw.monosmdom.json /path/to/output/all.monosmdom.json", file=sys.stderr)
-        exit(1)
-    run(sys.argv[1], sys.argv[2])
+    args = make_parser().parse_args()
+    run(
+        args.input_filename,
+        args.output_filename,
+        format_version=args.format_version,
+        psl_filename=args.psl,
+        output_format=args.output_format,
+        streaming=args.streaming,
+        jobs=args.jobs,
+    )
@@ -0,0 +1,311 @@
+"""
+The compact binary alternative to the "filtered" *.monosmdom.json, written by cleanup.py with
+--output-format binary, and read by the server. See BinaryUrlfileWriter for the format.
+"""
+
+import itertools
+import json
+import os
+import struct
+
+
+BINARY_MAGIC = b"monosmdom-bin\n"
+BINARY_U32 = struct.Struct("<I")
+BINARY_RECORD_PREFIX = struct.Struct("<cI")
+BINARY_BLOCK_HEADER = struct.Struct("<II")
+BINARY_BLOCK_SIZE = 1000
+# Item type ("n"/"w"/"r"), OSM id, tag key (string ref), x and y (micro-degrees),
+# orig_url (index into the URL's orig_urls):
+BINARY_OCC_STRUCT = struct.Struct("<BqIiiI")
+BINARY_COORD_SCALE = 1_000_000
+# Number of characters shared with the URL, and of the remaining suffix. OSM tag values have at most 255 characters.
+BINARY_ORIG_URL_STRUCT = struct.Struct("<HH")
+
+
+class BinaryUrlfileWriter:
+    """
+    Writes a *.monosmdom.bin file, the compact alternative to the "filtered" *.monosmdom.json.
+    The file consists of BINARY_MAGIC, followed by records. Each record is a single kind-byte,
+    the length of the payload (uint32), and the payload:
+    - b"H": The header as JSON, i.e. "v" and "type". Always the first record.
+    - b"S": Defines the next interned strings, which later records refer to by index. Used for tag
+      keys, disaster reasons, and domains, which are all highly repetitive. Written right before
+      the block that first uses them.
+    - b"D": A block of up to BINARY_BLOCK_SIZE disasters.
+    - b"U": A block of up to BINARY_BLOCK_SIZE simplified URLs.
+    - b"E": End of file. Guards against truncated files.
+    All disasters come before all simplified URLs, just like in the JSON file.
+    Blocks are stored column by column (see _write_block), so that the reader can unpack each column
+    with a single struct call, instead of doing lots of tiny reads per URL. Strings within a block
+    are concatenated and decoded all at once. Each orig_url is only stored as the suffix that differs
+    from the URL, since the two usually are nearly identical.
+    Coordinates are stored as int32 micro-degrees, which takes as little space as float32, but
+    (unlike float32) exactly reproduces the six decimals that 'extract' writes.
+    """
+
+    def __init__(self, fp, header, block_size=BINARY_BLOCK_SIZE):
+        self._fp = fp
+        self._block_size = block_size
+        self._version = header["v"]
+        self._string_refs = dict()
+        self._new_strings = []
+        self._block_kind = None
+        self._block = []
+        self._fp.write(BINARY_MAGIC)
+        self._write_record(b"H", json.dumps(header).encode())
+
+    def _write_record(self, kind, payload):
+        self._fp.write(kind)
+        self._fp.write(BINARY_U32.pack(len(payload)))
+        self._fp.write(payload)
+
+    def _string_ref(self, string):
+        ref = self._string_refs.get(string)
+        if ref is None:
+            ref = len(self._string_refs)
+            self._string_refs[string] = ref
+            self._new_strings.append(string)
+        return ref
+
+    def _append(self, kind, entry):
+        if self._block_kind != kind:
+            assert self._block_kind != b"U", "All disasters must come before all simplified URLs"
+            self._write_block()
+            self._block_kind = kind
+        self._block.append(entry)
+        if len(self._block) >= self._block_size:
+            self._write_block()
+
+    def write_disaster(self, url, reasons, occs):
+        self._append(b"D", (url, [self._string_ref(reason) for reason in reasons], occs))
+
+    def write_simplified_url(self, url, entry):
+        # The entry looks exactly like in the JSON file: A list of occs in v2, a dict in v3.
+        if self._version >= 3:
+            self._append(b"U", (url, (self._string_ref(entry["d"]), entry["i"]), entry["occs"]))
+        else:
+            self._append(b"U", (url, None, entry))
+
+    def _write_block(self):
+        # Layout, where n is the number of entries, and all string sizes are in characters, not bytes.
+        # Each concatenated UTF-8 string is prefixed by its size in bytes (see _pack_text).
+        # - uint32 n, uint32 total number of occs
+        # - n × uint32 URL size, followed by all URLs as one UTF-8 string
+        # - For disasters: n × uint32 number of reasons, then all reasons as string refs (uint32)
+        # - For simplified URLs in v3: n × uint32 domain as string ref, then n × uint8 interest flag
+        # - n × uint32 number of occs, n × uint32 number of distinct orig_urls
+        # - For each orig_url: BINARY_ORIG_URL_STRUCT, followed by all suffixes as one UTF-8 string
+        # - For each occ: BINARY_OCC_STRUCT
+        if not self._block:
+            return
+        urls = [url for url, _extra, _occs in self._block]
+        parts = [BINARY_BLOCK_HEADER.pack(len(self._block), sum(len(occs) for _url, _extra, occs in self._block))]
+        parts.append(struct.pack(f"<{len(urls)}I", *map(len, urls)))
+        parts.append(self._pack_text(urls))
+        if self._block_kind == b"D":
+            reason_refs = [reason_refs for _url, reason_refs, _occs in self._block]
+            parts.append(struct.pack(f"<{len(urls)}I", *map(len, reason_refs)))
+            all_reason_refs = [ref for refs in reason_refs for ref in refs]
+            parts.append(struct.pack(f"<{len(all_reason_refs)}I", *all_reason_refs))
+        elif self._version >= 3:
+            domain_refs = [domain_ref for _url, (domain_ref, _interest), _occs in self._block]
+            parts.append(struct.pack(f"<{len(urls)}I", *domain_refs))
+            parts.append(bytes(bool(interest) for _url, (_domain_ref, interest), _occs in self._block))
+        occ_counts = []
+        orig_url_counts = []
+        orig_url_parts = []
+        orig_url_suffixes = []
+        occ_parts = []
+        for url, _extra, occs in self._block:
+            orig_url_refs = dict()
+            for occ in occs:
+                orig_url_ref = orig_url_refs.setdefault(occ["orig_url"], len(orig_url_refs))
+                x_micro = round(occ["x"] * BINARY_COORD_SCALE)
+                y_micro = round(occ["y"] * BINARY_COORD_SCALE)
+                assert x_micro / BINARY_COORD_SCALE == occ["x"] and y_micro / BINARY_COORD_SCALE == occ["y"], occ
+                occ_parts.append(
+                    BINARY_OCC_STRUCT.pack(
+                        ord(occ["t"]), occ["id"], self._string_ref(occ["k"]), x_micro, y_micro, orig_url_ref
+                    )
+                )
+            occ_counts.append(len(occs))
+            orig_url_counts.append(len(orig_url_refs))
+            for orig_url in orig_url_refs:
+                prefix_size = len(os.path.commonprefix([url, orig_url]))
+                orig_url_parts.append(BINARY_ORIG_URL_STRUCT.pack(prefix_size, len(orig_url) - prefix_size))
+                orig_url_suffixes.append(orig_url[prefix_size:])
+        parts.append(struct.pack(f"<{len(urls)}I", *occ_counts))
+        parts.append(struct.pack(f"<{len(urls)}I", *orig_url_counts))
+        parts.extend(orig_url_parts)
+        parts.append(self._pack_text(orig_url_suffixes))
+        parts.extend(occ_parts)
+        if self._new_strings:
+            # Layout: uint32 number of strings, that many uint32 string sizes, all strings as one UTF-8 string.
+            strings_parts = [
+                BINARY_U32.pack(len(self._new_strings)),
+                struct.pack(f"<{len(self._new_strings)}I", *map(len, self._new_strings)),
+            ]
+            strings_parts.append(self._pack_text(self._new_strings))
+            self._write_record(b"S", b"".join(strings_parts))
+            self._new_strings = []
+        self._write_record(self._block_kind, b"".join(parts))
+        self._block = []
+
+    @staticmethod
+    def _pack_text(strings):
+        encoded = "".join(strings).encode()
+        return BINARY_U32.pack(len(encoded)) + encoded
+
+    def finish(self):
+        self._write_block()
+        self._write_record(b"E", b"")
+
+
+class BinaryUrlfileReader:
+    """
+    Reads a *.monosmdom.bin file (see BinaryUrlfileWriter) block by block, and returns exactly the
+    same values as JsonStreamReader would for the equivalent *.monosmdom.json file.
+    """
+
+    def __init__(self, fp):
+        self._fp = fp
+        self._strings = []
+        self.bytes_read = 0
+        magic = self._read_exactly(len(BINARY_MAGIC))
+        assert magic == BINARY_MAGIC, f"Not a binary urlfile, bad magic {magic!r}"
+        kind, payload = self._read_record()
+        assert kind == b"H", f"Expected header record, found {kind!r}"
+        self.header = json.loads(payload)
+        self._version = self.header["v"]
+
+    def _read_exactly(self, size):
+        data = self._fp.read(size)
+        if len(data) != size:
+            raise ValueError(f"Unexpected end of file after byte {self.bytes_read + len(data)}")
+        self.bytes_read += size
+        return data
+
+    def _read_record(self):
+        kind, size = BINARY_RECORD_PREFIX.unpack(self._read_exactly(BINARY_RECORD_PREFIX.size))
+        return kind, self._read_exactly(size)
+
+    def _decode_strings(self, payload):
+        (num_strings,) = BINARY_U32.unpack_from(payload, 0)
+        offset = BINARY_U32.size
+        string_sizes = struct.unpack_from(f"<{num_strings}I", payload, offset)
+        offset += BINARY_U32.size * num_strings
+        (text_size,) = BINARY_U32.unpack_from(payload, offset)
+        offset += BINARY_U32.size
+        assert offset + text_size == len(payload), (offset, text_size, len(payload))
+        text = payload[offset:].decode()
+        text_pos = 0
+        for string_size in string_sizes:
+            self._strings.append(text[text_pos:text_pos + string_size])
+            text_pos += string_size
+
+    def _decode_block(self, kind, payload):
+        # See BinaryUrlfileWriter._write_block for the layout.
+        strings = self._strings
+        num_entries, num_occs = BINARY_BLOCK_HEADER.unpack_from(payload, 0)
+        offset = BINARY_BLOCK_HEADER.size
+        column = struct.Struct(f"<{num_entries}I")
+
+        def read_column():
+            nonlocal offset
+            values = column.unpack_from(payload, offset)
+            offset += column.size
+            return values
+
+        def read_text():
+            nonlocal offset
+            (size,) = BINARY_U32.unpack_from(payload, offset)
+            offset += BINARY_U32.size
+            text = payload[offset:offset + size].decode()
+            offset += size
+            return text
+
+        url_sizes = read_column()
+        urls_text = read_text()
+        if kind == b"D":
+            reason_counts = read_column()
+            all_reason_refs = struct.unpack_from(f"<{sum(reason_counts)}I", payload, offset)
+            offset += BINARY_U32.size * len(all_reason_refs)
+        elif self._version >= 3:
+            domain_refs = read_column()
+            interests = payload[offset:offset + num_entries]
+            offset += num_entries
+        occ_counts = read_column()
+        orig_url_counts = read_column()
+        orig_url_sizes_end = offset + BINARY_ORIG_URL_STRUCT.size * sum(orig_url_counts)
+        orig_url_sizes = list(BINARY_ORIG_URL_STRUCT.iter_unpack(payload[offset:orig_url_sizes_end]))
+        offset += BINARY_ORIG_URL_STRUCT.size * len(orig_url_sizes)
+        suffixes_text = read_text()
+        assert offset + num_occs * BINARY_OCC_STRUCT.size == len(payload), (offset, num_occs, len(payload))
+        occ_rows = BINARY_OCC_STRUCT.iter_unpack(payload[offset:])
+
+        url_pos = 0
+        suffix_pos = 0
+        orig_url_index = 0
+        reason_index = 0
+        for entry_index in range(num_entries):
+            url = urls_text[url_pos:url_pos + url_sizes[entry_index]]
+            url_pos += url_sizes[entry_index]
+            orig_urls = []
+            orig_url_end = orig_url_index + orig_url_counts[entry_index]
+            for prefix_size, suffix_size in orig_url_sizes[orig_url_index:orig_url_end]:
+                orig_urls.append(url[:prefix_size] + suffixes_text[suffix_pos:suffix_pos + suffix_size])
+                suffix_pos += suffix_size
+            orig_url_index = orig_url_end
+            occs = [
+                dict(
+                    id=osm_id,
+                    k=strings[key_ref],
+                    orig_url=orig_urls[orig_url_ref],
+                    t=chr(item_type),
+                    x=x_micro / BINARY_COORD_SCALE,
+                    y=y_micro / BINARY_COORD_SCALE,
+                )
+                for item_type, osm_id, key_ref, x_micro, y_micro, orig_url_ref in itertools.islice(
+                    occ_rows, occ_counts[entry_index]
+                )
+            ]
+            if kind == b"D":
+                reason_end = reason_index + reason_counts[entry_index]
+                reasons = [strings[ref] for ref in all_reason_refs[reason_index:reason_end]]
+                reason_index = reason_end
+                yield "disaster", url, dict(occs=occs, reasons=reasons)
+            elif self._version >= 3:
+                info = dict(d=strings[domain_refs[entry_index]], i=interests[entry_index] != 0, occs=occs)
+                yield "simplified_url", url, info
+            else:
+                yield "simplified_url", url, occs
+
+    def iter_records(self):
+        """
+        Yields ("disaster", url, {"occs": …, "reasons": …}) and ("simplified_url", url, entry)
+        tuples, in file order. Returns after the end-of-file record.
+        """
+        while True:
+            kind, payload = self._read_record()
+            if kind == b"S":
+                self._decode_strings(payload)
+            elif kind in (b"D", b"U"):
+                yield from self._decode_block(kind, payload)
+            elif kind == b"E":
+                return
+            else:
+                raise ValueError(f"Unknown record kind {kind!r} near byte {self.bytes_read}")
+
+    def expect_eof(self):
+        rest = self._fp.read(1)
+        if rest:
+            raise ValueError(f"Expected end of file near byte {self.bytes_read}, got {rest!r} instead")
+
+
+def write_binary(data, fp):
+    writer = BinaryUrlfileWriter(fp, dict(v=data["v"], type=data["type"]))
+    for url, disaster in data["disasters"].items():
+        writer.write_disaster(url, list(sorted(disaster.reasons)), disaster.occs)
+    for url, entry in data["simplified_urls"].items():
+        writer.write_simplified_url(url, entry)
+    writer.finish()
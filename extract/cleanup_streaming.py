@@ -0,0 +1,251 @@
+"""
+The --streaming mode of cleanup.py, which needs only a bounded amount of memory, no matter how large
+the extract is. See cleanup_streaming().
+"""
+
+from collections import Counter
+from operator import itemgetter
+import functools
+import heapq
+import itertools
+import json
+import pickle
+import tempfile
+import urllib.parse
+
+# Imported by the server, see storage/extract_cleanup_streaming.py:
+try:
+    from storage import extract_cleanup as cleanup, extract_cleanup_binary as cleanup_binary
+except ImportError:
+    import cleanup
+    import cleanup_binary
+
+
+# In --streaming mode, how many (URL, occurrences) pairs are kept in memory before they are sorted and
+# spilled to a temporary file. Roughly 1 KB each, so this stays well below 1 GB.
+SPILL_BUFFER_ENTRIES = 200_000
+
+
+class JsonUrlfileWriter:
+    """
+    Writes a filtered *.monosmdom.json file entry by entry, byte for byte like json.dump would write
+    the entire dict at once. Same interface as BinaryUrlfileWriter.
+    """
+
+    def __init__(self, fp, header):
+        self._fp = fp
+        self._section = None
+        self._first_in_section = True
+        self._fp.write("{" + ", ".join(f"{json.dumps(key)}: {json.dumps(value)}" for key, value in header.items()))
+
+    def _enter_section(self, section):
+        if self._section == section:
+            return
+        assert self._section != "simplified_urls", "All disasters must come before all simplified URLs"
+        if self._section is None and section == "simplified_urls":
+            # No disasters at all:
+            self._enter_section("disasters")
+        if self._section is not None:
+            self._fp.write("}")
+        self._fp.write(f", {json.dumps(section)}: {{")
+        self._section = section
+        self._first_in_section = True
+
+    def _write_entry(self, key, value):
+        if not self._first_in_section:
+            self._fp.write(", ")
+        self._first_in_section = False
+        self._fp.write(f"{json.dumps(key)}: {json.dumps(value)}")
+
+    def write_disaster(self, url, reasons, occs):
+        self._enter_section("disasters")
+        self._write_entry(url, dict(reasons=reasons, occs=occs))
+
+    def write_simplified_url(self, url, entry):
+        self._enter_section("simplified_urls")
+        self._write_entry(url, entry)
+
+    def finish(self):
+        self._enter_section("simplified_urls")
+        self._fp.write("}}")
+
+
+class ExternalGroupBy:
+    """
+    Groups (key, order, value) triples by key, a bit like a defaultdict(list), but once more than
+    max_buffered triples are held in memory, they are sorted and spilled to a temporary file (i.e.
+    an external merge sort). groups() then yields (key, [(order, value), …]) sorted by key, and each
+    list sorted by order. Keys and orders must be comparable, and the orders must be unique, so
+    that the values never need to be compared.
+    Temporary files go to $TMPDIR, see tempfile.gettempdir().
+    """
+
+    def __init__(self, max_buffered=SPILL_BUFFER_ENTRIES):
+        self.max_buffered = max_buffered
+        self.buffer = []
+        self.runs = []  # Temporary files, each containing one sorted run of pickled triples
+
+    def add(self, key, order, value):
+        self.buffer.append((key, order, value))
+        if len(self.buffer) >= self.max_buffered:
+            self._spill()
+
+    def _spill(self):
+        self.buffer.sort(key=itemgetter(0, 1))
+        fp = tempfile.TemporaryFile()
+        for triple in self.buffer:
+            # Note: A single Pickler would remember every object it has ever written.
+            pickle.dump(triple, fp, pickle.HIGHEST_PROTOCOL)
+        fp.seek(0)
+        self.runs.append(fp)
+        self.buffer = []
+
+    @staticmethod
+    def _read_run(fp):
+        while True:
+            try:
+                yield pickle.load(fp)
+            except EOFError:
+                return
+
+    def groups(self):
+        self.buffer.sort(key=itemgetter(0, 1))
+        merged = heapq.merge(*[self._read_run(fp) for fp in self.runs], self.buffer, key=itemgetter(0, 1))
+        for key, triples in itertools.groupby(merged, key=itemgetter(0)):
+            yield key, [(order, value) for _key, order, value in triples]
+
+    def close(self):
+        for fp in self.runs:
+            fp.close()
+        self.runs = []
+        self.buffer = []
+
+
+def stream_findings(fp, header):
+    """
+    Yields the findings of a raw *.monosmdom.json file one by one, and collects everything else
+    (i.e. "v" and "type") in header.
+    """
+    reader = cleanup.JsonStreamReader(fp)
+    for key in reader.iter_object_keys():
+        if key == "findings":
+            yield from reader.iter_array()
+        else:
+            header[key] = reader.read_value()
+    reader.expect_eof()
+
+
+def cleanup_streaming(input_fp, writer, psl=None, *, spill_entries=SPILL_BUFFER_ENTRIES):
+    """
+    Like cleanup.cleanup(), but reads the raw findings incrementally from input_fp, groups them by URL with
+    an external merge sort (see ExternalGroupBy), and writes the result incrementally to writer
+    (JsonUrlfileWriter or BinaryUrlfileWriter, with "v" 3 if there is a psl, 2 otherwise). So it
+    only needs a bounded amount of memory, no matter how large the extract is.
+    Each entry is exactly the same as in cleanup(), including the order of the occurrences. Only the
+    order of the entries differs: Disasters are sorted by URL, and so are the simplified URLs in v2.
+    In v3, the simplified URLs are sorted by domain and URL in both cases.
+    """
+    # cleanup() handles each stage for all findings before the next stage. To reproduce the order
+    # of occurrences in each entry, each triple is ordered by (stage, first appearance of its
+    # regexed URL, position in the file). See merged_occs().
+    stage_regex, stage_semantic, stage_classify = 0, 1, 2
+    position = itertools.count()
+    header = dict()
+    sld_and_interest_by_hostname = functools.lru_cache(maxsize=cleanup.HOSTNAME_CACHE_SIZE)(
+        lambda hostname: cleanup.strict_sld_and_interest_by_hostname(psl, hostname)
+    )
+    simplified = ExternalGroupBy(spill_entries)  # Key: (domain or "", simplified URL)
+    disasters = ExternalGroupBy(spill_entries)  # Key: URL
+    try:
+        print("Simplifying and spilling …")
+        num_findings = 0
+        for entry in stream_findings(input_fp, header):
+            num_findings += 1
+            for parse_url, disaster_reason in cleanup.split_finding(entry):
+                if disaster_reason is not None:
+                    disasters.add(parse_url, (stage_regex, next(position)), (parse_url, disaster_reason, entry["occ"]))
+                    continue
+                simplified_url, disaster_reason = cleanup.simplified_url_or_disaster_reason(parse_url)
+                if disaster_reason is not None:
+                    disasters.add(
+                        parse_url, (stage_semantic, next(position)), (parse_url, disaster_reason, entry["occ"])
+                    )
+                    continue
+                sld, have_interest = "", True
+                if psl is not None:
+                    sld, have_interest = sld_and_interest_by_hostname(urllib.parse.urlsplit(simplified_url).hostname)
+                    if sld is None:
+                        disasters.add(
+                            simplified_url,
+                            (stage_classify, next(position)),
+                            (parse_url, "has no public suffix", entry["occ"]),
+                        )
+                        continue
+                simplified.add(
+                    (sld, simplified_url), (stage_semantic, next(position)), (parse_url, have_interest, entry["occ"])
+                )
+        assert header.get("v") == 2, header
+        assert header.get("type") == cleanup.RAW_URLFILE_TYPE, header
+
+        stats = Counter()
+        all_seen_chars = Counter()
+
+        def merged_occs(values, *, stages_with_chars):
+            # In cleanup(), each regexed URL is handled in the order of its first appearance:
+            first_position = dict()
+            for (stage, pos), (parse_url, _info, _occs) in values:
+                first_position.setdefault((stage, parse_url), pos)
+            values = sorted(
+                values, key=lambda value: (value[0][0], first_position[(value[0][0], value[1][0])], value[0][1])
+            )
+            occs = []
+            for (stage, pos), (parse_url, _info, entry_occs) in values:
+                occs.extend(entry_occs)
+                # Each regexed URL that survived simplify_semantically is counted once, just like in cleanup():
+                if stage in stages_with_chars and first_position[(stage, parse_url)] == pos:
+                    all_seen_chars.update(parse_url)
+            return occs
+
+        def write_disasters():
+            for url, values in disasters.groups():
+                reasons = sorted({reason for _order, (_parse_url, reason, _occs) in values})
+                writer.write_disaster(url, reasons, merged_occs(values, stages_with_chars=[stage_classify]))
+                stats["disasters"] += 1
+                if any(order[0] == stage_classify for order, _value in values):
+                    # These still count as simplified URLs, see report_stats in cleanup():
+                    stats["simplified_urls"] += 1
+                yield url, set(reasons)
+
+        print("Merging and writing disasters …")
+        disaster_sample = cleanup.reservoir_sample(write_disasters(), cleanup.DISASTER_SAMPLE_SIZE)
+        disasters.close()
+
+        print("Merging and writing simplified URLs …")
+        for (sld, url), values in simplified.groups():
+            occs = merged_occs(values, stages_with_chars=[stage_semantic])
+            if psl is not None:
+                have_interest = values[0][1][1]
+                writer.write_simplified_url(url, dict(d=sld, i=have_interest, occs=occs))
+            else:
+                writer.write_simplified_url(url, occs)
+            stats["simplified_urls"] += 1
+        writer.finish()
+    finally:
+        simplified.close()
+        disasters.close()
+
+    cleanup.report_stats(num_findings, stats["simplified_urls"], stats["disasters"], disaster_sample)
+    cleanup.report_funky_chars(all_seen_chars)
+
+
+def run_streaming(input_filename, output_filename, psl, output_format):
+    header = dict(v=2 if psl is None else 3, type=cleanup.URLFILE_TYPE)
+    print(f"Streaming from {input_filename} to {output_filename} …")
+    with open(input_filename, "rb") as input_fp:
+        if output_format == "binary":
+            with open(output_filename, "wb") as output_fp:
+                cleanup_streaming(input_fp, cleanup_binary.BinaryUrlfileWriter(output_fp, header), psl)
+        else:
+            with open(output_filename, "w") as output_fp:
+                cleanup_streaming(input_fp, JsonUrlfileWriter(output_fp, header), psl)
+    print("All done! Results written to file.")
@@ -1,9 +1,8 @@
 from django.conf import settings
 from django.core.files.base import ContentFile
 from django.db import transaction
-from django.db.models import F
-from django.db.models import Max
 from monosmdom_server import common
+import asyncio
 import brotli
 import crawl
 import datetime
@@ -11,11 +10,15 @@ import json
 import logging
 import pycurl
 import storage
+import time
 import traceback
 
 
-CRAWL_DOMAIN_DELAY_DAYS = 25
+CRAWL_DOMAIN_DELAY_DAYS = storage.models.CRAWL_DOMAIN_DELAY_DAYS
 CACHE_CABUNDLE_TIMEOUT = datetime.timedelta(hours=8)
+# How long a crawler may sit on leased domains (see lease_due_domains) before they are considered
+# abandoned, e.g. because the crawler crashed, and other crawlers may claim them instead:
+DOMAIN_LEASE_DURATION = datetime.timedelta(hours=1)
 
 # Options that are basically passed to curl.
 # Expect compression to be factor 10 at best, and abort connection after factor 100.
@@ -51,8 +54,10 @@ def current_crawl_cutoff():
 
 def bump_domain(domain):
     # This might also be called while following a redirect-chain.
+    # Note that save() also updates domain.next_due.
+    # The instance might be stale, so don't write back e.g. has_crawlable, which an import might have changed since.
     domain.last_contacted = common.now_tzaware()
-    domain.save()
+    domain.save(update_fields=["last_contacted"])
 
 
 def bump_locked_domain_or_none(domain):
@@ -74,14 +79,10 @@ def bump_locked_domain_or_none(domain):
 
 
 def pick_random_crawlable_url_from_bumped_domain(bumped_domain):
-    # For each CrawlableUrl in the bumped_domain, determine when it was crawled most recently.
-    # Then, choose the CrawlableUrl whose most recent crawl is the longest ago, or never happened.
-    # Don't be fooled by the seeming simplicity of the query: It contains two joins and a sort!
-    return (
-        storage.models.CrawlableUrl.objects.filter(domain=bumped_domain)
-        .annotate(last_crawl=Max("url__result__crawl_begin"))
-        .order_by(F("last_crawl").asc(nulls_first=True))[0]
-    )
+    # Choose the CrawlableUrl of the bumped_domain whose most recent crawl is the longest ago, or never happened.
+    # This used to join all results of all URLs of the domain, and sort them. Now it is a single
+    # lookup in the index "crawlableurl_domain_last_crawl", no matter how many results accumulate.
+    return storage.models.CrawlableUrl.objects.filter(domain=bumped_domain).order_by("last_crawled_at")[0]
 
 
 def pick_and_bump_random_crawlable_url():
@@ -92,11 +93,14 @@ def pick_and_bump_random_crawlable_url():
     with transaction.atomic(durable=True):
         try:
             # First, choose the oldest domain that we want to crawl.
-            # Note that this query contains a join, and isn't trivially cheap.
+            # This used to join all domains with their CrawlableUrls. Now it is a single lookup in
+            # the partial index "domain_next_due_crawlable", no matter how many domains there are.
+            # Note that next_due is derived from last_contacted, so the order is the same.
             oldest_domain = (
-                storage.models.Domain.objects.filter(crawlableurl__isnull=False)
-                .order_by(F("last_contacted").asc(nulls_first=True))
-                .select_for_update()[0:1]  # LOCK
+                storage.models.Domain.objects.filter(has_crawlable=True)
+                .order_by("next_due")
+                # LOCK, but don't wait for other crawlers; just take the next-oldest domain instead:
+                .select_for_update(skip_locked=True)[0:1]
                 .get()
             )
             # Note: This contains a lot of decisions on how to choose the URL "properly", so let me elaborate:
@@ -115,7 +119,11 @@ def pick_and_bump_random_crawlable_url():
         except storage.models.Domain.DoesNotExist:
             logger.warning("WARNING: Crawler trying to run on empty DB?!")
             return None
-        chosen_domain = bump_locked_domain_or_none(oldest_domain)
+        if oldest_domain.next_due > common.now_tzaware():
+            # Either everything was crawled recently, or the remaining domains are leased by other crawlers.
+            chosen_domain = None
+        else:
+            chosen_domain = bump_locked_domain_or_none(oldest_domain)
     if chosen_domain is None:
         # This can only happen if chosen_domain was very recently crawled,
         # which implies that all other domains are *even more* recent.
@@ -128,6 +136,66 @@ def pick_and_bump_random_crawlable_url():
     return pick_random_crawlable_url_from_bumped_domain(chosen_domain)
 
 
+def lease_due_domains(count, lease_duration=DOMAIN_LEASE_DURATION):
+    """
+    Claims up to 'count' domains that are due for crawling, oldest first, so that the crawler can
+    then crawl them one after another without going through the database lock every time.
+    Returns the list of leased domains, which may be shorter than 'count' or even empty.
+    Rows locked by other crawlers are skipped instead of waited for, so many crawlers can lease at
+    the same time, and each one receives a distinct batch of domains.
+    The lease itself is just next_due, pushed into the near future. This makes the domains
+    invisible to all other crawlers, without touching last_contacted yet. Before actually crawling
+    a leased domain, call bump_leased_domain_or_none(). If the crawler crashes instead, the lease
+    simply expires, and the domains become due again.
+    """
+    assert count >= 1, count
+    assert lease_duration > datetime.timedelta(0), lease_duration
+    now = common.now_tzaware()
+    leased_until = now + lease_duration
+    # This must be the "top" atomic layer, because the lease must be persisted before we return.
+    with transaction.atomic(durable=True):
+        leased_domains = list(
+            storage.models.Domain.objects.filter(has_crawlable=True, next_due__lte=now)
+            .order_by("next_due")
+            .select_for_update(skip_locked=True)[:count]  # LOCK
+        )
+        storage.models.Domain.objects.filter(id__in=[domain.id for domain in leased_domains]).update(
+            next_due=leased_until
+        )
+    for domain in leased_domains:
+        domain.next_due = leased_until
+    return leased_domains
+
+
+def bump_leased_domain_or_none(leased_domain):
+    # Turns the lease into a proper bump, like bump_domain(), but only if the lease is still ours:
+    # If it expired in the meantime, another crawler may have leased the domain again, or may have
+    # been redirected to it, and already bumped it. Either way, next_due has changed, and we must
+    # not contact the domain.
+    # This is a single compare-and-swap, so no lock is needed.
+    now = common.now_tzaware()
+    num_updated = storage.models.Domain.objects.filter(id=leased_domain.id, next_due=leased_domain.next_due).update(
+        last_contacted=now,
+        next_due=storage.models.next_due_after(now),
+    )
+    if num_updated == 0:
+        return None
+    leased_domain.last_contacted = now
+    leased_domain.next_due = storage.models.next_due_after(now)
+    return leased_domain
+
+
+def release_domain_leases(leased_domains):
+    # Gives back domains that we have leased but not yet bumped, e.g. when shutting down cleanly.
+    # Again a compare-and-swap, in case the lease has already been taken over by someone else.
+    num_released = 0
+    for domain in leased_domains:
+        num_released += storage.models.Domain.objects.filter(id=domain.id, next_due=domain.next_due).update(
+            next_due=storage.models.next_due_after(domain.last_contacted),
+        )
+    return num_released
+
+
 def compress_lossy(content_raw, max_length):
     if isinstance(content_raw, bytearray):
         # pybrotli can't handle bytearray :-(
@@ -315,50 +383,59 @@ class LockedCurlResult:
         self.location = None
 
 
+def make_curl_handle(*, verbose=False):
+    # Shared by LockedCurl and MultiCurl, so that both behave exactly the same towards the servers.
+    c = pycurl.Curl()
+    if verbose:
+        c.setopt(pycurl.VERBOSE, True)
+        print("Curl config:")
+        print(f"  {MAX_HEADER=}")
+        print(f"  {MAX_HEADER_STOP_COUNT=}")
+        print(f"  {MAX_BODY=}")
+        print(f"  {MAX_BODY_STOP_COUNT=}")
+        print(f"  {settings.CAINFO_ROOT_AND_INTERMEDIATE=}")
+        print(f"  {settings.CRAWLER_USERAGENT_EMAIL=}")
+    c.setopt(pycurl.CAINFO, settings.CAINFO_ROOT_AND_INTERMEDIATE.encode())
+    # Also disable the system store, fail-fast, to detect config problems quicker:
+    c.setopt(pycurl.CAPATH, None)
+    # Connections cannot usually be shared or reused, since we actively *avoid* contacting the
+    # same host twice. However, if we follow a redirect, then re-using the same curl object can
+    # reuse a TLS session or even the entire connection, hence:
+    # Do not use CURLOPT_FORBID_REUSE: Sometimes we get redirects.
+    # Do not turn off HTTP Keep-Alive: Sometimes we get redirects.
+    # Do not use CURLOPT_HEADER! (mixes header and body, hard to parse)
+    # Do not use CURLOPT_MAXFILESIZE(_LARGE)! (not honored in some circumstances)
+    # Do not use CURLOPT_RESOLVER_START_FUNCTION: called at the wrong time, CURLOPT_RESOLVER
+    # only does a static pre-cache.
+    # At the time of writing, the term "SuperTallSoupFleece" has zero hits on Google. So if
+    # you're here because you saw SuperTallSoupFleece in your webserver log, maybe it was this
+    # program – maybe I was even the person running it! Write me an e-mail and say hi :D
+    c.setopt(
+        pycurl.USERAGENT,
+        (
+            f"monosmdom-crawler/0.0.1 (contact: {settings.CRAWLER_USERAGENT_EMAIL}) "
+            "(codename: SuperTallSoupFleece)"
+        ).encode(),
+    )
+    c.setopt(pycurl.MAX_RECV_SPEED_LARGE, MAX_RECV_SPEED_BPS)
+    # Enable all built-ins (which also enables auto-decompression)
+    c.setopt(pycurl.ACCEPT_ENCODING, "")
+    c.setopt(pycurl.PROTOCOLS, pycurl.PROTO_HTTP | pycurl.PROTO_HTTPS)
+    c.setopt(pycurl.TIMEOUT_MS, MAX_CONN_TIMEOUT_MS)
+    # TODO: intercept "local" IPs with https://curl.se/libcurl/c/CURLOPT_SOCKOPTFUNCTION.html
+    # This will not actually prevent the socket from being connected, but it will abort the
+    # connection before any bytes are sent. This prevents any possible damage (which shouldn't
+    # be too much anyway, since an attacker could only trigger an arbitrary GET request without
+    # controlling cookies or auth info).
+    # TODO: Look into CURLOPT_LOW_SPEED_TIME and CURLOPT_LOW_SPEED_LIMIT: How well can I use them?
+    return c
+
+
 class LockedCurl:
     def __init__(self, *, verbose=False):
-        self.c = pycurl.Curl()
-        if verbose:
-            self.c.setopt(pycurl.VERBOSE, True)
-            print("Curl config:")
-            print(f"  {MAX_HEADER=}")
-            print(f"  {MAX_HEADER_STOP_COUNT=}")
-            print(f"  {MAX_BODY=}")
-            print(f"  {MAX_BODY_STOP_COUNT=}")
-            print(f"  {settings.CAINFO_ROOT_AND_INTERMEDIATE=}")
-            print(f"  {settings.CRAWLER_USERAGENT_EMAIL=}")
-        self.last_cabundle_read = common.now_tzaware()
+        self.c = make_curl_handle(verbose=verbose)
         # Note that this is only about local caching of settings, especially of the heavy CA bundle.
-        self.c.setopt(pycurl.CAINFO, settings.CAINFO_ROOT_AND_INTERMEDIATE.encode())
-        # Also disable the system store, fail-fast, to detect config problems quicker:
-        self.c.setopt(pycurl.CAPATH, None)
-        # Connections cannot usually be shared or reused, since we actively *avoid* contacting the
-        # same host twice. However, if we follow a redirect, then re-using the same curl object can
-        # reuse a TLS session or even the entire connection, hence:
-        # Do not use CURLOPT_FORBID_REUSE: Sometimes we get redirects.
-        # Do not turn off HTTP Keep-Alive: Sometimes we get redirects.
-        # Do not use CURLOPT_HEADER! (mixes header and body, hard to parse)
-        # Do not use CURLOPT_MAXFILESIZE(_LARGE)! (not honored in some circumstances)
-        # Do not use CURLOPT_RESOLVER_START_FUNCTION: called at the wrong time, CURLOPT_RESOLVER
-        # only does a static pre-cache.
-        # At the time of writing, the term "SuperTallSoupFleece" has zero hits on Google. So if
-        # you're here because you saw SuperTallSoupFleece in your webserver log, maybe it was this
-        # program – maybe I was even the person running it! Write me an e-mail and say hi :D
-        self.c.setopt(
-            pycurl.USERAGENT,
-            f"monosmdom-crawler/0.0.1 (contact: {settings.CRAWLER_USERAGENT_EMAIL}) (codename: SuperTallSoupFleece)".encode(),
-        )
-        self.c.setopt(pycurl.MAX_RECV_SPEED_LARGE, MAX_RECV_SPEED_BPS)
-        # Enable all built-ins (which also enables auto-decompression)
-        self.c.setopt(pycurl.ACCEPT_ENCODING, "")
-        self.c.setopt(pycurl.PROTOCOLS, pycurl.PROTO_HTTP | pycurl.PROTO_HTTPS)
-        self.c.setopt(pycurl.TIMEOUT_MS, MAX_CONN_TIMEOUT_MS)
-        # TODO: intercept "local" IPs with https://curl.se/libcurl/c/CURLOPT_SOCKOPTFUNCTION.html
-        # This will not actually prevent the socket from being connected, but it will abort the
-        # connection before any bytes are sent. This prevents any possible damage (which shouldn't
-        # be too much anyway, since an attacker could only trigger an arbitrary GET request without
-        # controlling cookies or auth info).
-        # TODO: Look into CURLOPT_LOW_SPEED_TIME and CURLOPT_LOW_SPEED_LIMIT: How well can I use them?
+        self.last_cabundle_read = common.now_tzaware()
 
     def check_cabundle(self):
         now = common.now_tzaware()
@@ -393,40 +470,249 @@ class LockedCurl:
             - "header_size_recv": The value is an int, the number of bytes read before the fatal error.
             - "body_size_recv": The value is an int, the number of bytes read before the fatal error.
         """
-        result = LockedCurlResult()
-        self.c.setopt(pycurl.HEADERFUNCTION, result.header.recv_callback)
-        self.c.setopt(pycurl.WRITEFUNCTION, result.body.recv_callback)
-        self.c.setopt(pycurl.URL, url.encode())
-        # Can't use referers, since unsetopt(pycurl.REFERER) refuses to work :(
+        result = start_transfer(self.c, url)
         try:
             # Note: perform() calls into the C stack, which calls into the python stack in
             # SingleBuf.recv_callback. Python exceptions during recv_callback are instead saved in
-            # SingleBuf.exc, and are then re-raised during E_WRITE_ERROR handling below.
+            # SingleBuf.exc, and are then re-raised by finish_transfer().
             self.c.perform()
         except pycurl.error as e:
-            code = e.args[0]
-            errstr = e.args[1]
             assert len(e.args) == 2, e.args
-            if code == pycurl.E_WRITE_ERROR:
-                # We aborted receiving data in the body, but everything before then was successful.
-                # We can safely ignore the error – unless it is due to a python exception.
-                # This should be handled outside this "except" block to simplify backtraces.
-                pass
-            else:
-                errdict = {
-                    "errcode": code,
-                    "errstr": errstr,
-                    # curl internally overwrites the response code with 0 before doing anything in
-                    # perform(), so this is never outdated:
-                    "response_code": self.c.getinfo(pycurl.RESPONSE_CODE),
-                    "header_size_recv": result.header.size,
-                    "body_size_recv": result.body.size,
-                }
-                return None, errdict
-        if result.header.exception is not None:
-            raise result.header.exception
-        if result.body.exception is not None:
-            raise result.body.exception
-        result.status_code = self.c.getinfo(pycurl.RESPONSE_CODE)
-        result.location = self.c.getinfo(pycurl.REDIRECT_URL)
-        return result, None
+            code, errstr = e.args
+            return finish_transfer(self.c, result, code, errstr)
+        return finish_transfer(self.c, result, pycurl.E_OK, None)
+
+
+def start_transfer(c, url):
+    # The first half of LockedCurl.crawl_response_or_errdict, also used by MultiCurl.
+    result = LockedCurlResult()
+    c.setopt(pycurl.HEADERFUNCTION, result.header.recv_callback)
+    c.setopt(pycurl.WRITEFUNCTION, result.body.recv_callback)
+    c.setopt(pycurl.URL, url.encode())
+    # Can't use referers, since unsetopt(pycurl.REFERER) refuses to work :(
+    return result
+
+
+def finish_transfer(c, result, code, errstr):
+    # The second half of LockedCurl.crawl_response_or_errdict, also used by MultiCurl.
+    # Turns the curl error code of a finished transfer (E_OK if there was none) into the
+    # (result, errdict) tuple, see there.
+    if code not in (pycurl.E_OK, pycurl.E_WRITE_ERROR):
+        errdict = {
+            "errcode": code,
+            "errstr": errstr,
+            # curl internally overwrites the response code with 0 before doing anything in
+            # perform(), so this is never outdated:
+            "response_code": c.getinfo(pycurl.RESPONSE_CODE),
+            "header_size_recv": result.header.size,
+            "body_size_recv": result.body.size,
+        }
+        return None, errdict
+    # If code is E_WRITE_ERROR, then we aborted receiving data in the body, but everything before
+    # then was successful. We can safely ignore the error – unless it is due to a python exception.
+    if result.header.exception is not None:
+        raise result.header.exception
+    if result.body.exception is not None:
+        raise result.body.exception
+    result.status_code = c.getinfo(pycurl.RESPONSE_CODE)
+    result.location = c.getinfo(pycurl.REDIRECT_URL)
+    return result, None
+
+
+class MultiCurl:
+    """
+    Like LockedCurl, but keeps up to max_transfers transfers in flight at the same time, all in a
+    single thread. This matters because most hosts in OSM data are dead, and LockedCurl would spend
+    most of its time waiting for MAX_CONN_TIMEOUT_MS to pass, doing nothing.
+    Each transfer uses its own easy handle, configured exactly like LockedCurl, and produces the
+    same (result, errdict) tuple as LockedCurl.crawl_response_or_errdict.
+    The caller is responsible for politeness, i.e. for never running two transfers to the same
+    domain at the same time.
+    """
+
+    def __init__(self, max_transfers, *, verbose=False):
+        assert max_transfers >= 1, max_transfers
+        if not pycurl.version_info()[4] & pycurl.VERSION_ASYNCHDNS:
+            # Then name resolution blocks all other transfers, and concurrency hardly helps.
+            logger.warning("WARNING: libcurl was built without asynchronous DNS!")
+        self.m = pycurl.CurlMulti()
+        self.m.setopt(pycurl.M_MAX_TOTAL_CONNECTIONS, max_transfers)
+        self.free_handles = [make_curl_handle(verbose=verbose) for _ in range(max_transfers)]
+        # Maps each busy easy handle to (result, tag):
+        self.transfers = dict()
+        self.last_cabundle_read = common.now_tzaware()
+
+    def num_free(self):
+        return len(self.free_handles)
+
+    def num_busy(self):
+        return len(self.transfers)
+
+    def check_cabundle(self):
+        now = common.now_tzaware()
+        if now - self.last_cabundle_read > CACHE_CABUNDLE_TIMEOUT:
+            print("Re-reading CA bundle ...")
+            for c in [*self.free_handles, *self.transfers.keys()]:
+                c.setopt(pycurl.CAINFO, settings.CAINFO_ROOT_AND_INTERMEDIATE.encode())
+            self.last_cabundle_read = now
+
+    def __del__(self):
+        for c in [*self.free_handles, *self.transfers.keys()]:
+            c.close()
+        self.m.close()
+
+    def start(self, url, tag):
+        """
+        Begins crawling `url`, which is a URL string. `tag` is an arbitrary object that identifies
+        this transfer in the return value of poll(). Requires a free handle, see num_free().
+        """
+        c = self.free_handles.pop()
+        result = start_transfer(c, url)
+        self.transfers[c] = (result, tag)
+        self.m.add_handle(c)
+
+    def poll(self, timeout_seconds):
+        """
+        Makes progress on all transfers, waiting at most timeout_seconds for network activity.
+        Returns a list of (tag, result, errdict) tuples, one for each transfer that has finished
+        in the meantime. Exactly one of result and errdict is None, see crawl_response_or_errdict.
+        """
+        if self.transfers:
+            # curl knows best when it needs to be called again, e.g. during name resolution:
+            curl_timeout_ms = self.m.timeout()
+            if curl_timeout_ms >= 0:
+                timeout_seconds = min(timeout_seconds, curl_timeout_ms / 1000)
+            self.m.select(timeout_seconds)
+        else:
+            time.sleep(timeout_seconds)
+        while True:
+            ret, _ = self.m.perform()
+            if ret != pycurl.E_CALL_MULTI_PERFORM:
+                break
+        finished = []
+        while True:
+            num_queued, ok_list, err_list = self.m.info_read()
+            for c in ok_list:
+                finished.append((c, pycurl.E_OK, None))
+            for c, code, errstr in err_list:
+                finished.append((c, code, errstr))
+            if num_queued == 0:
+                break
+        outcomes = []
+        for c, code, errstr in finished:
+            self.m.remove_handle(c)
+            result, tag = self.transfers.pop(c)
+            self.free_handles.append(c)
+            # Note that this might re-raise an exception from a recv_callback, just like LockedCurl.
+            outcomes.append((tag, *finish_transfer(c, result, code, errstr)))
+        return outcomes
+
+
+class AsyncCurl:
+    """
+    Like MultiCurl, but lets the asyncio event loop wait for the sockets and timeouts, by means of
+    curl's M_SOCKETFUNCTION and M_TIMERFUNCTION. Each transfer is a simple coroutine, see
+    crawl_response_or_errdict. This way, other coroutines (and threads) can do their work while
+    all transfers are waiting for the network.
+    Must only be used from within the event loop's thread.
+    """
+
+    def __init__(self, *, verbose=False):
+        if not pycurl.version_info()[4] & pycurl.VERSION_ASYNCHDNS:
+            # Then name resolution blocks the entire event loop.
+            logger.warning("WARNING: libcurl was built without asynchronous DNS!")
+        self.verbose = verbose
+        self.loop = asyncio.get_running_loop()
+        self.m = pycurl.CurlMulti()
+        self.m.setopt(pycurl.M_SOCKETFUNCTION, self._socket_callback)
+        self.m.setopt(pycurl.M_TIMERFUNCTION, self._timer_callback)
+        self.timer_handle = None
+        self.free_handles = []
+        # Maps each busy easy handle to (result, future):
+        self.transfers = dict()
+        self.last_cabundle_read = common.now_tzaware()
+
+    def check_cabundle(self):
+        # Same as MultiCurl.check_cabundle.
+        now = common.now_tzaware()
+        if now - self.last_cabundle_read > CACHE_CABUNDLE_TIMEOUT:
+            print("Re-reading CA bundle ...")
+            for c in [*self.free_handles, *self.transfers.keys()]:
+                c.setopt(pycurl.CAINFO, settings.CAINFO_ROOT_AND_INTERMEDIATE.encode())
+            self.last_cabundle_read = now
+
+    def close(self):
+        if self.timer_handle is not None:
+            self.timer_handle.cancel()
+        for c in [*self.free_handles, *self.transfers.keys()]:
+            c.close()
+        self.m.close()
+
+    def _socket_callback(self, what, sockfd, _multi, _socketp):
+        # Called by curl from within socket_action() and add_handle(), to say which events on which
+        # socket it wants to hear about. Must not raise, and must not call back into curl.
+        self.loop.remove_reader(sockfd)
+        self.loop.remove_writer(sockfd)
+        if what in (pycurl.POLL_IN, pycurl.POLL_INOUT):
+            self.loop.add_reader(sockfd, self._on_socket, sockfd, pycurl.CSELECT_IN)
+        if what in (pycurl.POLL_OUT, pycurl.POLL_INOUT):
+            self.loop.add_writer(sockfd, self._on_socket, sockfd, pycurl.CSELECT_OUT)
+        # For POLL_REMOVE, we're done already.
+
+    def _timer_callback(self, timeout_ms):
+        # Called by curl to say when it wants socket_action(SOCKET_TIMEOUT) to be called, at the latest.
+        # Again, must not raise, and must not call back into curl.
+        if self.timer_handle is not None:
+            self.timer_handle.cancel()
+            self.timer_handle = None
+        if timeout_ms >= 0:
+            self.timer_handle = self.loop.call_later(timeout_ms / 1000, self._on_socket, pycurl.SOCKET_TIMEOUT, 0)
+
+    def _on_socket(self, sockfd, event_bitmask):
+        if sockfd == pycurl.SOCKET_TIMEOUT:
+            self.timer_handle = None
+        self.m.socket_action(sockfd, event_bitmask)
+        while True:
+            num_queued, ok_list, err_list = self.m.info_read()
+            for c in ok_list:
+                self._finish(c, pycurl.E_OK, None)
+            for c, code, errstr in err_list:
+                self._finish(c, code, errstr)
+            if num_queued == 0:
+                break
+
+    def _finish(self, c, code, errstr):
+        self.m.remove_handle(c)
+        result, future = self.transfers.pop(c)
+        self.free_handles.append(c)
+        if future.cancelled():
+            return
+        try:
+            future.set_result(finish_transfer(c, result, code, errstr))
+        except BaseException as e:
+            # A python exception from a recv_callback, just like LockedCurl; re-raised by the await.
+            future.set_exception(e)
+
+    async def crawl_response_or_errdict(self, url):
+        """
+        Exactly like LockedCurl.crawl_response_or_errdict, but other coroutines keep running while
+        the transfer is in flight. There is no limit to the number of concurrent transfers, so the
+        caller is responsible for that, as well as for politeness.
+        """
+        if self.free_handles:
+            c = self.free_handles.pop()
+        else:
+            c = make_curl_handle(verbose=self.verbose)
+        result = start_transfer(c, url)
+        future = self.loop.create_future()
+        self.transfers[c] = (result, future)
+        self.m.add_handle(c)
+        try:
+            return await future
+        except asyncio.CancelledError:
+            if c in self.transfers:
+                # Abort the transfer, so that the handle can be re-used:
+                self.m.remove_handle(c)
+                del self.transfers[c]
+                self.free_handles.append(c)
+            raise
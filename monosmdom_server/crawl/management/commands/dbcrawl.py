@@ -2,11 +2,16 @@
 
 from crawl import logic
 from django.core.management.base import BaseCommand
-from django.db import transaction
+from django.db import close_old_connections, connections, transaction
+import asyncio
+import concurrent.futures
+import datetime
 import functools
 import os.path
 import storage
 import storage.logic
+import sys
+import threading
 import time
 
 # Disgusting hack because there's too much buffering going on:
@@ -20,14 +25,73 @@ SLEEP_REDIRECT_SECONDS = 2.0
 SLEEP_DOMAIN_FORCEBUMP_SECONDS = SLEEP_REDIRECT_SECONDS
 
 
+def submit_response(process, result, errdict):
+    """
+    Saves the outcome of a single request, as returned by crawl_response_or_errdict.
+    Returns a tuple (result_success, next_url_obj, next_domain): result_success is the new ResultSuccess
+    row, if any. If the response redirects to a URL that we want to crawl next, then next_url_obj and
+    next_domain describe that URL, otherwise both are None.
+    """
+    if errdict is not None:
+        print(f"    curl reports error: {errdict['errstr']}")
+        process.submit_error(errdict)
+        return None, None, None
+    next_url_obj = None
+    next_crawl_url_obj = None
+    next_domain = None
+    if result.location is not None:
+        # If the redirect goes to a disastrous URL, this creates a DisasterUrl entry.
+        use_url = result.location[:1023]
+        # We don't want to mark any redirect-target as a CrawlableUrl,
+        # since we only indirectly care about that URL.
+        maybe_next_crawlable = storage.logic.discover_url(use_url, mark_crawlable=False)
+        next_url_obj = maybe_next_crawlable.url_obj  # FIXME
+        # If a redirect to a valid URL that we want to crawl, continue there:
+        if maybe_next_crawlable.want_to_crawl:
+            next_crawl_url_obj = next_url_obj
+            next_domain = maybe_next_crawlable.domain
+    result_success = process.submit_success(
+        result.status_code,
+        result.header.ba,
+        result.header.size,
+        result.header.truncated,
+        result.body.ba,
+        result.body.size,
+        result.body.truncated,
+        next_url_obj,
+    )
+    print(f"    saved as {result_success.content_file}")
+    return result_success, next_crawl_url_obj, next_domain
+
+
+def bump_redirect_target(previous_domain, next_domain):
+    # We got redirected to an entirely new domain.
+    # Currently, this causes some issues:
+    # 1. We might unintentionally send two or three requests per month instead of just one
+    #    per domain. Oh well, don't care.
+    # 2. An attacker might take over lots of domains and redirect them all to some victim
+    #    site, that we now unintentionally "flood" with requests (once very 1+2 seconds).
+    #    Bad.
+    #    To counter this, we wait a bit longer when bumping is unsuccessful.
+    # Returns the number of seconds to wait in addition to SLEEP_REDIRECT_SECONDS.
+    if lock_then_bump_domain(next_domain) is not None:
+        return 0
+    print(
+        f"  Got redirected from {previous_domain.domain_name} to {next_domain.domain_name}, "
+        "which is still on cooldown. Sleeping a bit extra …"
+    )
+    logic.bump_domain(next_domain)
+    return SLEEP_DOMAIN_FORCEBUMP_SECONDS
+
+
 def crawl_prepared_url(crawl_url_obj, curl_wrapper):
-    assert isinstance(crawl_url_obj, storage.models.Url), crawl_url_obj
     if crawl_url_obj is None:
         # Nothing matched; presumably because either the DB is empty, or somehow we crawled
         # everything so fast that we ran out of things to do. Slow down:
         print(f"Nothing to do! Sleeping for {SLEEP_IF_NO_MATCH_SECONDS} seconds …")
         time.sleep(SLEEP_IF_NO_MATCH_SECONDS)
         return
+    assert isinstance(crawl_url_obj, storage.models.Url), crawl_url_obj
     last_request = None
     previous_domain = crawl_url_obj.crawlableurl.domain
     for iteration in range(MAX_REDIRECT_DEPTH):
@@ -39,61 +103,338 @@ def crawl_prepared_url(crawl_url_obj, curl_wrapper):
                 last_request.next_request = process.result
                 last_request.save()
             result, errdict = curl_wrapper.crawl_response_or_errdict(crawl_url_obj.url)
-            crawl_url_obj = None  # Done crawling, probably.
-            if result is not None:
-                next_url_obj = None
-                if result.location is not None:
-                    # If the redirect goes to a disastrous URL, this creates a DisasterUrl entry.
-                    use_url = result.location[:1023]
-                    # We don't want to mark any redirect-target as a CrawlableUrl,
-                    # since we only indirectly care about that URL.
-                    maybe_next_crawlable = storage.logic.discover_url(use_url, mark_crawlable=False)
-                    next_url_obj = maybe_next_crawlable.url_obj  # FIXME
-                    # If a redirect to a valid URL that we want to crawl, continue there:
-                    if maybe_next_crawlable.want_to_crawl:
-                        crawl_url_obj = next_url_obj
-                        next_domain = maybe_next_crawlable.domain
-                result_success = process.submit_success(
-                    result.status_code,
-                    result.header.ba,
-                    result.header.size,
-                    result.header.truncated,
-                    result.body.ba,
-                    result.body.size,
-                    result.body.truncated,
-                    next_url_obj,
-                )
-                print(f"    saved as {result_success.content_file}")
-                last_request = result_success
-            if errdict is not None:
-                print(f"    curl reports error: {errdict['errstr']}")
-                process.submit_error(errdict)
+            # If crawl_url_obj becomes None, we're done crawling:
+            last_request, crawl_url_obj, next_domain = submit_response(process, result, errdict)
         if crawl_url_obj is None:
             # Done crawling the original crawlable URL, we have reached the end of the (possibly
             # empty) redirect chain.
             return
+        extra_sleep_seconds = 0
         if iteration + 1 != MAX_REDIRECT_DEPTH and next_domain != previous_domain:
-            # We got redirected to an entirely new domain.
-            # Currently, this causes some issues:
-            # 1. We might unintentionally send two or three requests per month instead of just one
-            #    per domain. Oh well, don't care.
-            # 2. An attacker might take over lots of domains and redirect them all to some victim
-            #    site, that we now unintentionally "flood" with requests (once very 1+2 seconds).
-            #    Bad.
-            #    To counter this, we wait a bit longer when bumping is unsuccessful.
-            bumped_domain = lock_then_bump_domain(next_domain)
-            if bumped_domain is not None:
-                print(f"  Got redirected from {previous_domain.domain_name} to {next_domain.domain_name}, which is still on cooldown. Sleeping a bit extra …")
-                time.sleep(SLEEP_DOMAIN_FORCEBUMP_SECONDS)
-                logic.bump_domain(next_domain)
+            extra_sleep_seconds = bump_redirect_target(previous_domain, next_domain)
             previous_domain = next_domain
-        time.sleep(SLEEP_REDIRECT_SECONDS)
+        time.sleep(SLEEP_REDIRECT_SECONDS + extra_sleep_seconds)
     print(f"Redirect chain is too long! {MAX_REDIRECT_DEPTH=}")
 
 
 def crawl_random_url(curl_wrapper):
     crurl = logic.pick_and_bump_random_crawlable_url()
-    crawl_prepared_url(crurl.url, curl_wrapper)
+    crawl_prepared_url(None if crurl is None else crurl.url, curl_wrapper)
+
+
+class LeasedDomainCrawler:
+    # Like crawl_random_url, but leases several domains at once, and then works through them.
+    # Many crawler processes can run like this side by side, without waiting for each other's locks.
+    def __init__(self, lease_count, lease_duration):
+        self.lease_count = lease_count
+        self.lease_duration = lease_duration
+        self.leased_domains = []
+
+    def next_bumped_domain_or_none(self):
+        while True:
+            if not self.leased_domains:
+                self.leased_domains = logic.lease_due_domains(self.lease_count, self.lease_duration)
+                print(f"Leased {len(self.leased_domains)} domains.")
+                if not self.leased_domains:
+                    return None
+            bumped_domain = logic.bump_leased_domain_or_none(self.leased_domains.pop(0))
+            if bumped_domain is not None:
+                return bumped_domain
+            # The lease has expired, and the domain has already been taken over by someone else.
+            print("Lost the lease of a domain, skipping it.")
+
+    def __call__(self, curl_wrapper):
+        bumped_domain = self.next_bumped_domain_or_none()
+        if bumped_domain is None:
+            crawl_prepared_url(None, curl_wrapper)
+            return
+        chosen_crurl = logic.pick_random_crawlable_url_from_bumped_domain(bumped_domain)
+        crawl_prepared_url(chosen_crurl.url, curl_wrapper)
+
+    def release(self):
+        num_released = logic.release_domain_leases(self.leased_domains)
+        print(f"Released {num_released} of {len(self.leased_domains)} leased domains.")
+        self.leased_domains = []
+
+
+class CrawlChain:
+    # The state of one crawl_prepared_url() call within ConcurrentCrawler: A crawlable URL,
+    # followed by its redirect chain, followed by next_delay_seconds of doing nothing.
+    def __init__(self, crawl_url_obj, domain):
+        # The URL to be crawled next, or None if the chain is done:
+        self.crawl_url_obj = crawl_url_obj
+        self.domain = domain
+        self.iteration = 0
+        self.last_request = None
+        # The CrawlProcess of the request that is currently in flight, if any:
+        self.process = None
+        # Like the time.sleep() calls in crawl_prepared_url, in terms of time.monotonic():
+        self.not_before = time.monotonic()
+
+
+class ConcurrentCrawler:
+    """
+    Does the same as LeasedDomainCrawler, but keeps up to 'concurrency' domains in flight at the same
+    time, using logic.MultiCurl. Politeness does not change: Each domain is still leased and bumped
+    before it is contacted, redirects still wait for SLEEP_REDIRECT_SECONDS, and there are never two
+    transfers to the same domain at the same time, even if two chains are redirected to the same
+    domain. With next_delay_seconds, each of the slots waits that long before taking the next domain,
+    so this behaves like 'concurrency' sequential crawlers, but within a single process.
+    """
+
+    def __init__(self, concurrency, leaser, next_delay_seconds):
+        self.concurrency = concurrency
+        self.leaser = leaser
+        self.next_delay_seconds = next_delay_seconds or 0
+        self.multi = logic.MultiCurl(concurrency)
+        # All chains, no matter whether they are in flight, waiting for a redirect, or cooling down:
+        self.chains = []
+        self.no_match_until = None
+
+    def fill(self, now):
+        if self.no_match_until is not None and now < self.no_match_until:
+            return
+        while len(self.chains) < self.concurrency:
+            bumped_domain = self.leaser.next_bumped_domain_or_none()
+            if bumped_domain is None:
+                # Same as crawl_prepared_url(None, …), except that the running chains continue.
+                print(f"Nothing to do! Not looking for new domains for {SLEEP_IF_NO_MATCH_SECONDS} seconds …")
+                self.no_match_until = now + SLEEP_IF_NO_MATCH_SECONDS
+                return
+            chosen_crurl = logic.pick_random_crawlable_url_from_bumped_domain(bumped_domain)
+            self.chains.append(CrawlChain(chosen_crurl.url, bumped_domain))
+
+    def start_due_chains(self, now):
+        # Starts the transfers of all chains that are ready, and drops the chains that are done.
+        # Returns the number of seconds until the next chain becomes ready, at most 1.
+        busy_domain_ids = {chain.domain.id for chain in self.chains if chain.process is not None}
+        timeout_seconds = 1.0
+        remaining_chains = []
+        for chain in self.chains:
+            if chain.process is None and chain.not_before > now:
+                timeout_seconds = min(timeout_seconds, chain.not_before - now)
+            elif chain.process is None and chain.crawl_url_obj is None:
+                continue  # Done, and cooled down.
+            elif chain.process is None and chain.domain.id not in busy_domain_ids:
+                print(f"Crawling {chain.crawl_url_obj} now …")
+                chain.process = logic.CrawlProcess(chain.crawl_url_obj)
+                chain.process.__enter__()
+                if chain.last_request is not None:
+                    chain.last_request.next_request = chain.process.result
+                    chain.last_request.save()
+                self.multi.start(chain.crawl_url_obj.url, chain)
+                busy_domain_ids.add(chain.domain.id)
+            # Otherwise, it is in flight, or waits for another transfer to the same domain. Either
+            # way, that transfer finishing wakes up poll().
+            remaining_chains.append(chain)
+        self.chains = remaining_chains
+        return timeout_seconds
+
+    def handle_response(self, chain, result, errdict):
+        # The part of crawl_prepared_url after crawl_response_or_errdict.
+        chain.last_request, next_url_obj, next_domain = submit_response(chain.process, result, errdict)
+        chain.process.__exit__(None, None, None)
+        chain.process = None
+        chain.iteration += 1
+        now = time.monotonic()
+        if next_url_obj is not None and chain.iteration == MAX_REDIRECT_DEPTH:
+            print(f"Redirect chain is too long! {MAX_REDIRECT_DEPTH=}")
+            next_url_obj = None
+        chain.crawl_url_obj = next_url_obj
+        if next_url_obj is None:
+            chain.not_before = now + self.next_delay_seconds
+            return
+        extra_sleep_seconds = 0
+        if next_domain != chain.domain:
+            extra_sleep_seconds = bump_redirect_target(chain.domain, next_domain)
+            chain.domain = next_domain
+        chain.not_before = now + SLEEP_REDIRECT_SECONDS + extra_sleep_seconds
+
+    def abort(self, exc_type, exc_value, tb):
+        # Record the exception for all requests in flight, just like CrawlProcess would do for a single one.
+        for chain in self.chains:
+            if chain.process is not None and not chain.process.has_submitted:
+                chain.process.__exit__(exc_type, exc_value, tb)
+
+    def run(self, endless):
+        # Returns True if the crawler was asked to stop.
+        stopping = False
+        try:
+            self.fill(time.monotonic())
+            while True:
+                if not stopping and os.path.exists("/tmp/STOP_OSMMONDOM"):
+                    print("/tmp/STOP_OSMMONDOM exists, finishing the current chains and shutting down!")
+                    stopping = True
+                # The crawler may run for days, so pick up the regularly updated CA bundle:
+                self.multi.check_cabundle()
+                now = time.monotonic()
+                if endless and not stopping:
+                    self.fill(now)
+                timeout_seconds = self.start_due_chains(now)
+                if not self.chains and not (endless and not stopping):
+                    break
+                for chain, result, errdict in self.multi.poll(timeout_seconds):
+                    self.handle_response(chain, result, errdict)
+        except BaseException:
+            self.abort(*sys.exc_info())
+            raise
+        self.leaser.release()
+        return stopping
+
+
+def call_with_db_connection(fn, *args):
+    # Runs in a thread of AsyncCrawler.db_pool. Just like Django does around each request, drop the
+    # thread's DB connection if it broke (e.g. because the DB restarted), or is older than CONN_MAX_AGE.
+    # Note that each call runs its own transactions, so there is never one open at this point.
+    close_old_connections()
+    try:
+        return fn(*args)
+    finally:
+        close_old_connections()
+
+
+class AsyncCrawler:
+    """
+    Does the same as ConcurrentCrawler, but on an asyncio event loop: Each of the 'concurrency' slots
+    is a coroutine that works just like crawl_prepared_url, but awaits logic.AsyncCurl instead of
+    blocking in perform(). All database writes (including the brotli compression in
+    CrawlProcess.submit_success) run in a thread pool with 'db_threads' threads, so the network waits
+    of the other slots overlap with them, instead of running one after another.
+    Politeness is the same as in ConcurrentCrawler.
+    """
+
+    def __init__(self, concurrency, leaser, next_delay_seconds, db_threads):
+        self.concurrency = concurrency
+        self.leaser = leaser
+        self.next_delay_seconds = next_delay_seconds or 0
+        self.db_threads = db_threads
+        self.db_pool = concurrent.futures.ThreadPoolExecutor(max_workers=db_threads, thread_name_prefix="dbcrawl-db")
+        # Initialized within the event loop, see run_async:
+        self.curl = None
+        self.stopping = None
+        self.lease_lock = None
+        self.domain_freed = None
+        self.busy_domain_ids = set()
+
+    async def db(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.db_pool, call_with_db_connection, fn, *args)
+
+    def close_db_pool(self):
+        # Each thread has its own DB connection, and only that thread may close it. The barrier makes sure
+        # that each thread runs exactly one of these calls:
+        barrier = threading.Barrier(self.db_threads)
+
+        def close_connections():
+            barrier.wait()
+            connections.close_all()
+
+        for future in [self.db_pool.submit(close_connections) for _ in range(self.db_threads)]:
+            future.result()
+        self.db_pool.shutdown()
+
+    async def sleep_unless_stopping(self, seconds):
+        try:
+            await asyncio.wait_for(self.stopping.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def watch_stop_file(self):
+        while not self.stopping.is_set():
+            if os.path.exists("/tmp/STOP_OSMMONDOM"):
+                print("/tmp/STOP_OSMMONDOM exists, finishing the current chains and shutting down!")
+                self.stopping.set()
+            await asyncio.sleep(1.0)
+
+    async def crawl_request(self, crawl_url_obj, domain, last_request):
+        # One iteration of crawl_prepared_url. Returns the same as submit_response.
+        # Never have two transfers to the same domain at the same time, even if two chains are
+        # redirected to the same domain:
+        async with self.domain_freed:
+            await self.domain_freed.wait_for(lambda: domain.id not in self.busy_domain_ids)
+            self.busy_domain_ids.add(domain.id)
+        try:
+            print(f"Crawling {crawl_url_obj} now …")
+            process = logic.CrawlProcess(crawl_url_obj)
+            await self.db(process.__enter__)
+            try:
+                if last_request is not None:
+                    last_request.next_request = process.result
+                    await self.db(last_request.save)
+                # The crawler may run for days, so pick up the regularly updated CA bundle:
+                self.curl.check_cabundle()
+                result, errdict = await self.curl.crawl_response_or_errdict(crawl_url_obj.url)
+                response = await self.db(submit_response, process, result, errdict)
+            except BaseException as e:
+                await self.db(process.__exit__, type(e), e, e.__traceback__)
+                raise
+            await self.db(process.__exit__, None, None, None)
+            return response
+        finally:
+            async with self.domain_freed:
+                self.busy_domain_ids.discard(domain.id)
+                self.domain_freed.notify_all()
+
+    async def crawl_chain(self, crawl_url_obj, domain):
+        # The async version of crawl_prepared_url.
+        last_request = None
+        for iteration in range(MAX_REDIRECT_DEPTH):
+            last_request, crawl_url_obj, next_domain = await self.crawl_request(crawl_url_obj, domain, last_request)
+            if crawl_url_obj is None:
+                return
+            extra_sleep_seconds = 0
+            if iteration + 1 != MAX_REDIRECT_DEPTH and next_domain != domain:
+                extra_sleep_seconds = await self.db(bump_redirect_target, domain, next_domain)
+                domain = next_domain
+            await asyncio.sleep(SLEEP_REDIRECT_SECONDS + extra_sleep_seconds)
+        print(f"Redirect chain is too long! {MAX_REDIRECT_DEPTH=}")
+
+    async def crawl_slot(self, endless):
+        while not self.stopping.is_set():
+            # LeasedDomainCrawler is not thread-safe, so only one slot may lease at a time:
+            async with self.lease_lock:
+                bumped_domain = await self.db(self.leaser.next_bumped_domain_or_none)
+            if bumped_domain is None:
+                if not endless:
+                    return
+                print(f"Nothing to do! Sleeping for {SLEEP_IF_NO_MATCH_SECONDS} seconds …")
+                await self.sleep_unless_stopping(SLEEP_IF_NO_MATCH_SECONDS)
+                continue
+            # Django refuses to run any query within the event loop, including the lazy lookup of crurl.url:
+            chosen_url_obj = await self.db(
+                lambda: logic.pick_random_crawlable_url_from_bumped_domain(bumped_domain).url
+            )
+            await self.crawl_chain(chosen_url_obj, bumped_domain)
+            if not endless:
+                return
+            await self.sleep_unless_stopping(self.next_delay_seconds)
+
+    async def run_async(self, endless):
+        self.curl = logic.AsyncCurl()
+        self.stopping = asyncio.Event()
+        self.lease_lock = asyncio.Lock()
+        self.domain_freed = asyncio.Condition()
+        watcher = asyncio.create_task(self.watch_stop_file())
+        slots = [asyncio.create_task(self.crawl_slot(endless)) for _ in range(self.concurrency)]
+        try:
+            await asyncio.gather(*slots)
+        except BaseException:
+            # Stop the other slots as well. Their requests in flight get recorded as internal errors.
+            for slot in slots:
+                slot.cancel()
+            await asyncio.gather(*slots, return_exceptions=True)
+            raise
+        finally:
+            watcher.cancel()
+            self.curl.close()
+        await self.db(self.leaser.release)
+        return self.stopping.is_set()
+
+    def run(self, endless):
+        # Returns True if the crawler was asked to stop.
+        try:
+            return asyncio.run(self.run_async(endless))
+        finally:
+            self.close_db_pool()
 
 
 def lock_then_bump_domain(domain):
@@ -139,14 +480,59 @@ class Command(BaseCommand):
             help="Crawl uniformly random URL from the database",
             action="store_true",
         )
+        parser.add_argument(
+            "--lease-domains",
+            help="With --random-url, lease this many domains at once, so that many crawler processes can run in "
+            "parallel (default: just lock a single domain at a time)",
+            type=int,
+        )
+        parser.add_argument(
+            "--concurrency",
+            help="With --random-url, crawl this many domains at the same time within this process (default: 1)",
+            type=int,
+        )
+        parser.add_argument(
+            "--asyncio",
+            dest="use_asyncio",
+            help="With --concurrency, run on an asyncio event loop, "
+            "and write to the database in a separate thread pool",
+            action="store_true",
+        )
+        parser.add_argument(
+            "--db-threads",
+            help="With --asyncio, the number of threads that write to the database (default: 4)",
+            type=int,
+            default=4,
+        )
         parser.add_argument(
             "--next-delay-seconds",
             help="Enables endless crawling, waiting X seconds between each crawling attempt.",
             type=float,
         )
 
-    def handle(self, *, domain, url, random_url, next_delay_seconds, **options):
+    def handle(
+        self,
+        *,
+        domain,
+        url,
+        random_url,
+        lease_domains,
+        concurrency,
+        use_asyncio,
+        db_threads,
+        next_delay_seconds,
+        **options,
+    ):
         assert next_delay_seconds is None or next_delay_seconds > 0
+        assert lease_domains is None or lease_domains >= 1, lease_domains
+        assert lease_domains is None or random_url, "--lease-domains only makes sense with --random-url"
+        assert concurrency is None or concurrency >= 1, concurrency
+        assert concurrency is None or random_url, "--concurrency only makes sense with --random-url"
+        assert concurrency is not None or not use_asyncio, "--asyncio only makes sense with --concurrency"
+        assert db_threads >= 1, db_threads
+        if concurrency is not None and lease_domains is None:
+            # Concurrency always needs leases, so that each slot has its own domain:
+            lease_domains = concurrency
         assert not (url is not None and next_delay_seconds is not None), "--url and --next-delay-seconds are mutually exclusive"
         if domain is not None and next_delay_seconds is not None:
             print(f"WARNING: This will ONLY crawl random urls from the domain >>{domain}<<, and nothing else!")
@@ -154,6 +540,26 @@ class Command(BaseCommand):
         if domain is not None:
             domain_row = storage.models.Domain.objects.get(domain_name=domain)
             do_one_crawl = functools.partial(crawl_domain, domain_row)
+        elif random_url and lease_domains is not None:
+            # Each leased domain costs at most a redirect chain plus the delay, and the lease must
+            # comfortably outlast the entire batch:
+            seconds_per_domain = MAX_REDIRECT_DEPTH * (logic.MAX_CONN_TIMEOUT_MS / 1000 + SLEEP_REDIRECT_SECONDS) + (
+                next_delay_seconds or 0
+            )
+            lease_duration = max(
+                logic.DOMAIN_LEASE_DURATION, datetime.timedelta(seconds=2 * lease_domains * seconds_per_domain)
+            )
+            do_one_crawl = LeasedDomainCrawler(lease_domains, lease_duration)
+            if concurrency is not None:
+                if use_asyncio:
+                    concurrent_crawler = AsyncCrawler(concurrency, do_one_crawl, next_delay_seconds, db_threads)
+                else:
+                    concurrent_crawler = ConcurrentCrawler(concurrency, do_one_crawl, next_delay_seconds)
+                print(f"Begin crawling, {concurrency} domains at a time!")
+                if concurrent_crawler.run(endless=next_delay_seconds is not None):
+                    exit(2)
+                print("Done crawling!")
+                return
         elif random_url:
             do_one_crawl = crawl_random_url
         elif url is not None:
@@ -165,6 +571,8 @@ class Command(BaseCommand):
         while True:
             if os.path.exists("/tmp/STOP_OSMMONDOM"):
                 print("/tmp/STOP_OSMMONDOM exists, shutting down!")
+                if isinstance(do_one_crawl, LeasedDomainCrawler):
+                    do_one_crawl.release()
                 exit(2)
             do_one_crawl(curl_wrapper)
             if next_delay_seconds is not None:
@@ -172,4 +580,6 @@ class Command(BaseCommand):
                 time.sleep(next_delay_seconds)
             else:
                 break
+        if isinstance(do_one_crawl, LeasedDomainCrawler):
+            do_one_crawl.release()
         print("Done crawling!")
@@ -0,0 +1,53 @@
+from django.db import migrations, models
+
+
+class RemoveResultBase(migrations.operations.base.Operation):
+    """
+    0002 turned ResultSuccess and ResultError from subclasses of Result into separate models with a
+    OneToOneField. But the migration state still listed Result as their base, and thus still had the
+    implicit parent link "result_ptr". PostgreSQL dropped that column, but SQLite rebuilt the table
+    from the state, and kept it as NOT NULL. So no result could ever be written on SQLite.
+    """
+
+    reduces_to_sql = False
+    reversible = True
+
+    def __init__(self, name):
+        self.name = name
+
+    def deconstruct(self):
+        return (self.__class__.__name__, [self.name], {})
+
+    def state_forwards(self, app_label, state):
+        state.models[app_label, self.name.lower()].bases = (models.Model,)
+        state.reload_model(app_label, self.name.lower(), delay=True)
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != "sqlite":
+            return
+        model = to_state.apps.get_model(app_label, self.name)
+        with schema_editor.connection.cursor() as cursor:
+            columns = schema_editor.connection.introspection.get_table_description(cursor, model._meta.db_table)
+        if any(column.name == "result_ptr_id" for column in columns):
+            # Rebuilds the table from the (now correct) state, which drops the stale column. There is no
+            # public API for this: The column does not exist in any model state, so RemoveField can't
+            # name it. The SQLite schema editor itself uses _remake_table for every AlterField.
+            schema_editor._remake_table(model)  # pylint: disable=protected-access
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        # The column never held any data, so there is no point in bringing it back.
+        pass
+
+    def describe(self):
+        return f"Remove the stale base Result from {self.name}"
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("crawl", "0007_squatproof"),
+    ]
+
+    operations = [
+        RemoveResultBase("ResultSuccess"),
+        RemoveResultBase("ResultError"),
+    ]
@@ -97,6 +97,14 @@ class Result(models.Model):
     def __str__(self):
         return f"<Result#{self.id} {self.url.truncated}>"
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # Keep the redundant CrawlableUrl.last_crawled_at up to date. Does nothing if the URL isn't crawlable
+        # (e.g. a redirect target), or if this is just the update at the end of the crawl.
+        storage.models.CrawlableUrl.objects.filter(url_id=self.url_id, last_crawled_at__lt=self.crawl_begin).update(
+            last_crawled_at=self.crawl_begin
+        )
+
 
 # "Success" simply means that the server responded with *something* that could be interpreted as a valid HTTP response.
 # So 200 is successful, 301 is successful, 404 is successful, 500 is successful.
@@ -1,11 +1,25 @@
 from collections import Counter
 from crawl import logic, models
+from crawl.management.commands import dbcrawl
 from django.conf import settings
-from django.test import TestCase, TransactionTestCase
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
 from monosmdom_server import common
+from unittest import mock
+import asyncio
 import brotli
+import contextlib
 import datetime
+import http.server
+import io
+import os
+import pycurl
 import storage
+import storage.logic
+import tempfile
+import threading
+import time
+import urllib.parse
 
 
 # If any of the following tests takes longer than this, then something has *seriously* gone wrong anyway.
@@ -134,6 +148,94 @@ class PickCrawlableUrlTests(TransactionTestCase):
         self.assert_recent_domain(other_domain)
         self.assert_old_domain(some_domain, 1)
 
+    def test_bump_sets_next_due(self):
+        some_domain = storage.models.Domain.objects.create(domain_name="foo.com")
+        some_url = storage.models.Url.objects.create(url="https://foo.com/bar/baz")
+        storage.models.CrawlableUrl.objects.create(url=some_url, domain=some_domain)
+        logic.pick_and_bump_random_crawlable_url()
+        some_domain.refresh_from_db()
+        self.assertEqual(
+            some_domain.next_due, some_domain.last_contacted + datetime.timedelta(days=logic.CRAWL_DOMAIN_DELAY_DAYS)
+        )
+
+    def test_stale_has_crawlable(self):
+        # Bulk inserts bypass CrawlableUrl.save(), so the domain isn't scheduled until refresh_domain_has_crawlable():
+        some_domain = storage.models.Domain.objects.create(domain_name="foo.com")
+        some_url = storage.models.Url.objects.create(url="https://foo.com/bar/baz")
+        some_crurl = storage.models.CrawlableUrl.objects.bulk_create(
+            [storage.models.CrawlableUrl(url=some_url, domain=some_domain)]
+        )[0]
+        self.assertIsNone(logic.pick_and_bump_random_crawlable_url())
+        storage.logic.refresh_domain_has_crawlable()
+        self.assertEqual(logic.pick_and_bump_random_crawlable_url(), some_crurl)
+
+    def make_crawlable_domain(self, domain_name, last_contacted=None):
+        domain = storage.models.Domain.objects.create(domain_name=domain_name, last_contacted=last_contacted)
+        url = storage.models.Url.objects.create(url=f"https://{domain_name}/")
+        storage.models.CrawlableUrl.objects.create(url=url, domain=domain)
+        return domain
+
+    def test_lease_batch(self):
+        old_domain = self.make_crawlable_domain("old.com", old_date(1))
+        null_domain = self.make_crawlable_domain("null.com")
+        self.make_crawlable_domain("fresh.com", common.now_tzaware())
+        leased = logic.lease_due_domains(5)
+        self.assertEqual(leased, [null_domain, old_domain])
+        # The lease hides the domains from everyone else, but doesn't count as contact yet:
+        self.assertEqual(logic.lease_due_domains(5), [])
+        self.assertIsNone(logic.pick_and_bump_random_crawlable_url())
+        old_domain.refresh_from_db()
+        self.assert_old_domain(old_domain, 1)
+        self.assertEqual(old_domain.next_due, leased[1].next_due)
+
+    def test_lease_bump(self):
+        self.make_crawlable_domain("foo.com")
+        leased_domain = logic.lease_due_domains(1)[0]
+        self.assertEqual(logic.bump_leased_domain_or_none(leased_domain), leased_domain)
+        leased_domain.refresh_from_db()
+        self.assert_recent_domain(leased_domain)
+        self.assertEqual(
+            leased_domain.next_due,
+            leased_domain.last_contacted + datetime.timedelta(days=logic.CRAWL_DOMAIN_DELAY_DAYS),
+        )
+
+    def test_lease_lost_to_redirect(self):
+        # Another crawler might get redirected to a leased domain, and contact it first:
+        self.make_crawlable_domain("foo.com")
+        leased_domain = logic.lease_due_domains(1)[0]
+        redirected_domain = storage.models.Domain.objects.get(domain_name="foo.com")
+        self.assertIsNotNone(logic.bump_locked_domain_or_none(redirected_domain))
+        self.assertIsNone(logic.bump_leased_domain_or_none(leased_domain))
+
+    def test_lease_expired(self):
+        # A crawler that crashes never bumps its leased domains, so someone else can take them over:
+        self.make_crawlable_domain("foo.com")
+        crashed_lease = logic.lease_due_domains(1, datetime.timedelta(microseconds=1))[0]
+        time.sleep(0.001)
+        new_lease = logic.lease_due_domains(1)[0]
+        self.assertEqual(new_lease, crashed_lease)
+        self.assertIsNone(logic.bump_leased_domain_or_none(crashed_lease))
+        self.assertIsNotNone(logic.bump_leased_domain_or_none(new_lease))
+
+    def test_lease_release(self):
+        some_domain = self.make_crawlable_domain("foo.com", old_date(1))
+        leased = logic.lease_due_domains(1)
+        self.assertEqual(logic.release_domain_leases(leased), 1)
+        self.assertEqual(logic.lease_due_domains(1), [some_domain])
+        some_domain.refresh_from_db()
+        self.assert_old_domain(some_domain, 1)
+
+    def test_result_sets_last_crawled_at(self):
+        some_domain = storage.models.Domain.objects.create(domain_name="foo.com")
+        some_url = storage.models.Url.objects.create(url="https://foo.com/1")
+        some_crurl = storage.models.CrawlableUrl.objects.create(url=some_url, domain=some_domain)
+        self.assertEqual(some_crurl.last_crawled_at, storage.models.NEVER_CRAWLED)
+        models.Result.objects.create(url=some_url, crawl_begin=old_date(1))
+        # An older result must not move it backwards:
+        models.Result.objects.create(url=some_url, crawl_begin=old_date(2))
+        some_crurl.refresh_from_db()
+        self.assert_old_domain(storage.models.Domain(last_contacted=some_crurl.last_crawled_at), 1)
+
     def test_happy_null_result1(self):
         some_domain = storage.models.Domain.objects.create(domain_name="foo.com")
         some_url = storage.models.Url.objects.create(url="https://foo.com/1")
@@ -181,6 +283,43 @@ class PickCrawlableUrlTests(TransactionTestCase):
         self.assertNotEqual(picked_crurl, some_crurl)
 
 
+class RedirectTargetTests(TransactionTestCase):
+    def test_bump_redirect_target(self):
+        previous_domain = storage.models.Domain.objects.create(
+            domain_name="foo.com", last_contacted=common.now_tzaware()
+        )
+        next_domain = storage.models.Domain.objects.create(domain_name="bar.com", last_contacted=old_date(1))
+        # A due redirect target is simply bumped:
+        self.assertEqual(dbcrawl.bump_redirect_target(previous_domain, next_domain), 0)
+        next_domain.refresh_from_db()
+        first_contact = next_domain.last_contacted
+        self.assertGreater(first_contact, old_date(0))
+        # Now it's on cooldown, e.g. because another chain got redirected there as well. So wait a bit extra:
+        self.assertEqual(
+            dbcrawl.bump_redirect_target(previous_domain, next_domain), dbcrawl.SLEEP_DOMAIN_FORCEBUMP_SECONDS
+        )
+        next_domain.refresh_from_db()
+        self.assertGreater(next_domain.last_contacted, first_contact)
+
+    def test_bump_stale_redirect_target(self):
+        previous_domain = storage.models.Domain.objects.create(
+            domain_name="foo.com", last_contacted=common.now_tzaware()
+        )
+        next_domain = storage.models.Domain.objects.create(
+            domain_name="bar.com", last_contacted=common.now_tzaware(), has_crawlable=True
+        )
+        # Meanwhile, an import removes the last CrawlableUrl of the redirect target:
+        storage.models.Domain.objects.filter(id=next_domain.id).update(has_crawlable=False)
+        self.assertEqual(
+            dbcrawl.bump_redirect_target(previous_domain, next_domain), dbcrawl.SLEEP_DOMAIN_FORCEBUMP_SECONDS
+        )
+        next_domain.refresh_from_db()
+        self.assertFalse(next_domain.has_crawlable)
+        self.assertEqual(
+            next_domain.next_due, next_domain.last_contacted + datetime.timedelta(days=logic.CRAWL_DOMAIN_DELAY_DAYS)
+        )
+
+
 class LossyCompressionTests(TestCase):
     def assert_compresses_at_least(self, content_bytes, max_length, saved_bytes_min, saved_bytes_max):
         with self.subTest(content_bytes=content_bytes):
@@ -336,6 +475,293 @@ class UploadRegexAndFunctionAgree(TestCase):
         self.assertEqual(len(lengths), 1, lengths)
 
 
+class QuietHTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class MultiCurlTests(TestCase):
+    def setUp(self):
+        # Doesn't need the internet, just a tiny local server:
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), QuietHTTPRequestHandler)
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.server_thread.join()
+
+    def urls(self):
+        return [
+            f"{self.base_url}/",  # 200, directory listing
+            f"{self.base_url}/does/not/exist",  # 404
+            f"{self.base_url}/crawl",  # 301 to /crawl/
+            "http://127.0.0.1:1/",  # Connection refused
+        ]
+
+    def assert_same_as_locked_curl(self, urls, outcomes):
+        locked_curl = logic.LockedCurl()
+        expected = [locked_curl.crawl_response_or_errdict(url) for url in urls]
+        self.assertEqual(len(outcomes), len(urls))
+        for i, (expected_result, expected_errdict) in enumerate(expected):
+            actual_result, actual_errdict = outcomes[i]
+            with self.subTest(url=urls[i]):
+                if expected_errdict is not None:
+                    # The errstr contains timings like "after 0 ms", so ignore it:
+                    self.assertEqual({**actual_errdict, "errstr": None}, {**expected_errdict, "errstr": None})
+                self.assertEqual(actual_errdict is None, expected_errdict is None)
+                self.assertEqual(actual_result is None, expected_result is None)
+                if expected_result is not None:
+                    self.assertEqual(actual_result.status_code, expected_result.status_code)
+                    self.assertEqual(actual_result.location, expected_result.location)
+                    self.assertEqual(actual_result.body.ba, expected_result.body.ba)
+        self.assertEqual([outcomes[i][0].status_code for i in range(3)], [200, 404, 301])
+        self.assertEqual(outcomes[3][1]["errcode"], pycurl.E_COULDNT_CONNECT)
+
+    def test_multi_curl(self):
+        urls = self.urls()
+        multi_curl = logic.MultiCurl(3)
+        outcomes = dict()
+        for i, url in enumerate(urls):
+            while multi_curl.num_free() == 0:
+                outcomes.update((tag, (result, errdict)) for tag, result, errdict in multi_curl.poll(1.0))
+            multi_curl.start(url, i)
+        while multi_curl.num_busy() > 0:
+            outcomes.update((tag, (result, errdict)) for tag, result, errdict in multi_curl.poll(1.0))
+        self.assertEqual(multi_curl.num_free(), 3)
+        self.assert_same_as_locked_curl(urls, outcomes)
+
+    def test_multi_curl_cabundle(self):
+        multi_curl = logic.MultiCurl(2)
+        multi_curl.start(f"{self.base_url}/", "busy")
+        long_ago = common.now_tzaware() - logic.CACHE_CABUNDLE_TIMEOUT * 2
+        multi_curl.last_cabundle_read = long_ago
+        # Re-reads it for the busy handle as well, and then not again for a while:
+        multi_curl.check_cabundle()
+        self.assertGreater(multi_curl.last_cabundle_read, long_ago)
+        last_read = multi_curl.last_cabundle_read
+        multi_curl.check_cabundle()
+        self.assertEqual(multi_curl.last_cabundle_read, last_read)
+        outcomes = []
+        while multi_curl.num_busy() > 0:
+            outcomes.extend(multi_curl.poll(1.0))
+        self.assertEqual([(tag, result.status_code) for tag, result, _errdict in outcomes], [("busy", 200)])
+
+    def test_async_curl(self):
+        urls = self.urls()
+
+        async def crawl_all():
+            async_curl = logic.AsyncCurl()
+            try:
+                return await asyncio.gather(*[async_curl.crawl_response_or_errdict(url) for url in urls])
+            finally:
+                async_curl.close()
+
+        outcomes = asyncio.run(crawl_all())
+        self.assert_same_as_locked_curl(urls, outcomes)
+
+    def test_async_curl_cabundle(self):
+        async def crawl_with_stale_cabundle():
+            async_curl = logic.AsyncCurl()
+            try:
+                # Creates a handle, which is then free:
+                await async_curl.crawl_response_or_errdict(f"{self.base_url}/")
+                long_ago = common.now_tzaware() - logic.CACHE_CABUNDLE_TIMEOUT * 2
+                async_curl.last_cabundle_read = long_ago
+                async_curl.check_cabundle()
+                self.assertGreater(async_curl.last_cabundle_read, long_ago)
+                return await async_curl.crawl_response_or_errdict(f"{self.base_url}/")
+            finally:
+                async_curl.close()
+
+        result, errdict = asyncio.run(crawl_with_stale_cabundle())
+        self.assertIsNone(errdict)
+        self.assertEqual(result.status_code, 200)
+
+
+class FakeWebHandler(http.server.BaseHTTPRequestHandler):
+    # Acts as the HTTP proxy for all requests (see ConcurrentCrawlerTests), and answers them itself
+    # through server.respond(url), which returns the Location to redirect to, or None.
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        with self.server.lock:
+            self.server.requests.append(self.path)
+            self.server.in_flight[url.hostname] += 1
+            if self.server.in_flight[url.hostname] > self.server.max_in_flight[url.hostname]:
+                self.server.max_in_flight[url.hostname] = self.server.in_flight[url.hostname]
+        try:
+            location = self.server.respond(url)
+            self.send_response(200 if location is None else 302)
+            if location is not None:
+                self.send_header("Location", location)
+            self.send_header("Content-Length", "6")
+            self.end_headers()
+            self.wfile.write(b"Hello!")
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # The crawler gave up on this transfer.
+        finally:
+            with self.server.lock:
+                self.server.in_flight[url.hostname] -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ConcurrentCrawlerTests(TransactionTestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FakeWebHandler)
+        self.server.lock = threading.Lock()
+        self.server.requests = []
+        self.server.in_flight = Counter()
+        self.server.max_in_flight = Counter()
+        self.server.respond = self.respond
+        self.slow_hostnames = dict()
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.start()
+        self.addCleanup(self.stop_server)
+        # curl sends everything to the proxy, so the crawler can contact real-looking domains on port
+        # 80 (anything else would be a disaster URL), without ever leaving this machine:
+        proxy_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.enterContext(mock.patch.dict(os.environ, {"http_proxy": proxy_url, "no_proxy": ""}))
+        self.enterContext(override_settings(MEDIA_ROOT=self.enterContext(tempfile.TemporaryDirectory())))
+        self.enterContext(mock.patch.object(dbcrawl, "SLEEP_REDIRECT_SECONDS", 0.05))
+        self.enterContext(mock.patch.object(dbcrawl, "SLEEP_DOMAIN_FORCEBUMP_SECONDS", 0.05))
+        self.enterContext(contextlib.redirect_stdout(io.StringIO()))
+
+    def stop_server(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.server_thread.join()
+
+    def respond(self, url):
+        time.sleep(self.slow_hostnames.get(url.hostname, 0))
+        if url.hostname in ["alpha.de", "beta.de"] and url.path == "/":
+            return f"http://gamma.de/from-{url.hostname[:-3]}"
+        if url.hostname == "loop.de":
+            return f"http://loop.de/{int(url.path[1:]) + 1}"
+        return None
+
+    def make_crawlable_domain(self, domain_name, path="/", last_contacted=None):
+        domain = storage.models.Domain.objects.create(domain_name=domain_name, last_contacted=last_contacted)
+        url = storage.models.Url.objects.create(url=f"http://{domain_name}{path}")
+        storage.models.CrawlableUrl.objects.create(url=url, domain=domain)
+        return domain
+
+    def make_crawler(self, concurrency, lease_count):
+        leaser = dbcrawl.LeasedDomainCrawler(lease_count, logic.DOMAIN_LEASE_DURATION)
+        return dbcrawl.ConcurrentCrawler(concurrency, leaser, None)
+
+    def result_success_of(self, url_string):
+        return models.ResultSuccess.objects.get(result__url__url=url_string)
+
+    def test_redirect_chains(self):
+        for domain_name in ["alpha.de", "beta.de"]:
+            self.make_crawlable_domain(domain_name)
+        self.make_crawlable_domain("loop.de", "/0")
+        # Due, but leased after the others, and never gets a slot:
+        spare_domain = self.make_crawlable_domain("spare.de", last_contacted=old_date(1))
+        # Both alpha.de and beta.de redirect to gamma.de, and the first request there takes a while:
+        self.slow_hostnames["gamma.de"] = 0.3
+        crawler = self.make_crawler(3, 4)
+        self.assertFalse(crawler.run(endless=False))
+        hostnames = Counter(urllib.parse.urlsplit(url).hostname for url in self.server.requests)
+        self.assertEqual(hostnames, {"alpha.de": 1, "beta.de": 1, "gamma.de": 2, "loop.de": dbcrawl.MAX_REDIRECT_DEPTH})
+        # Never two requests to the same domain at the same time:
+        self.assertEqual(max(self.server.max_in_flight.values()), 1)
+        for name in ["alpha", "beta"]:
+            with self.subTest(name=name):
+                result_success = self.result_success_of(f"http://{name}.de/")
+                self.assertEqual(result_success.status_code, 302)
+                self.assertEqual(result_success.next_request.url.url, f"http://gamma.de/from-{name}")
+                self.assertEqual(self.result_success_of(f"http://gamma.de/from-{name}").status_code, 200)
+        gamma_domain = storage.models.Domain.objects.get(domain_name="gamma.de")
+        self.assertGreater(gamma_domain.last_contacted, old_date(0))
+        # The redirect chain stops at MAX_REDIRECT_DEPTH, without requesting the next URL:
+        last_loop = self.result_success_of(f"http://loop.de/{dbcrawl.MAX_REDIRECT_DEPTH - 1}")
+        self.assertEqual(last_loop.next_url.url, f"http://loop.de/{dbcrawl.MAX_REDIRECT_DEPTH}")
+        self.assertIsNone(last_loop.next_request)
+        self.assertEqual(models.ResultError.objects.count(), 0)
+        self.assertEqual(models.Result.objects.filter(crawl_end=None).count(), 0)
+        # The unused lease has been released, and spare.de is due just like before:
+        self.assertFalse(models.Result.objects.filter(url__url="http://spare.de/").exists())
+        self.assertEqual(logic.lease_due_domains(5), [spare_domain])
+
+    def test_abort(self):
+        self.make_crawlable_domain("alpha.de", "/fast")
+        self.make_crawlable_domain("beta.de", "/slow")
+        self.slow_hostnames["beta.de"] = 0.5
+        real_submit_response = dbcrawl.submit_response
+
+        def submit_response(process, result, errdict):
+            if process.result.url.url == "http://alpha.de/fast":
+                raise ValueError("Let's pretend something went wrong")
+            return real_submit_response(process, result, errdict)
+
+        crawler = self.make_crawler(2, 2)
+        with mock.patch.object(dbcrawl, "submit_response", submit_response), self.assertRaises(ValueError):
+            crawler.run(endless=False)
+        # Both the failed request and the one still in flight are recorded:
+        self.assertEqual(models.Result.objects.filter(crawl_end=None).count(), 0)
+        result_errors = {result_error.result.url.url: result_error for result_error in models.ResultError.objects.all()}
+        self.assertEqual(set(result_errors), {"http://alpha.de/fast", "http://beta.de/slow"})
+        for result_error in result_errors.values():
+            self.assertTrue(result_error.is_internal_error)
+            self.assertRegex(result_error.description_json, '"exception_or_missing_submit"')
+        self.assertRegex(result_errors["http://alpha.de/fast"].description_json, "Let's pretend something went wrong")
+
+
+class AsyncCrawlerTests(ConcurrentCrawlerTests):
+    # The same tests, but for AsyncCrawler.
+    def setUp(self):
+        super().setUp()
+        self.submit_thread_names = set()
+        real_submit_response = dbcrawl.submit_response
+
+        def submit_response(process, result, errdict):
+            self.submit_thread_names.add(threading.current_thread().name)
+            return real_submit_response(process, result, errdict)
+
+        self.enterContext(mock.patch.object(dbcrawl, "submit_response", submit_response))
+
+    def make_crawler(self, concurrency, lease_count):
+        leaser = dbcrawl.LeasedDomainCrawler(lease_count, logic.DOMAIN_LEASE_DURATION)
+        # The in-memory SQLite test database locks entire tables across threads, so only use one there:
+        db_threads = 1 if connection.vendor == "sqlite" else 2
+        return dbcrawl.AsyncCrawler(concurrency, leaser, None, db_threads)
+
+    def test_redirect_chains(self):
+        super().test_redirect_chains()
+        # The database is only ever accessed from the thread pool, never from the event loop:
+        self.assertTrue(self.submit_thread_names)
+        for thread_name in self.submit_thread_names:
+            self.assertRegex(thread_name, "^dbcrawl-db")
+
+    def test_abort(self):
+        super().test_abort()
+        # The other slot got cancelled:
+        result_error = models.ResultError.objects.get(result__url__url="http://beta.de/slow")
+        self.assertRegex(result_error.description_json, "CancelledError")
+
+    def test_db_connections(self):
+        crawler = dbcrawl.AsyncCrawler(1, None, None, 3)
+        with mock.patch.object(dbcrawl, "close_old_connections") as close_old_connections:
+            thread_name = asyncio.run(crawler.db(lambda: threading.current_thread().name))
+        self.assertRegex(thread_name, "^dbcrawl-db")
+        # Once before, and once after the call:
+        self.assertEqual(close_old_connections.call_count, 2)
+        closing_thread_names = []
+
+        def close_all():
+            closing_thread_names.append(threading.current_thread().name)
+
+        with mock.patch.object(dbcrawl.connections, "close_all", close_all):
+            crawler.close_db_pool()
+        # Each thread closes its own connection, even the ones that never ran anything:
+        self.assertEqual(len(set(closing_thread_names)), 3)
+
+
 class CrawlProcessTests(TransactionTestCase):
     def test_golden(self):
         some_domain = storage.models.Domain.objects.create(domain_name="foo.com")
@@ -84,7 +84,7 @@ class DomainCrawlabilityFilter(admin.SimpleListFilter):
 class DomainAdminForm(ReadOnlyModelAdmin):
     empty_value_display = "(never)"
     list_display = ["domain_name", "last_contacted"]
-    readonly_fields = ["domain_name", "last_contacted"]
+    readonly_fields = ["domain_name", "last_contacted", "has_crawlable"]
     # TODO: Action: Set last_contacted to "now"
     # TODO: Action: Clear last_contacted
     list_filter = [DomainCrawlabilityFilter]
@@ -307,4 +307,6 @@ class ImportAdminForm(ReadOnlyModelAdmin):
     readonly_fields = ["urlfile_name", "import_begin", "import_end", "import_duration", "additional_data"]
 
     def import_duration(self, obj):
+        if obj.import_end is None:
+            return None  # Unfinished resumable import
         return obj.import_end - obj.import_begin
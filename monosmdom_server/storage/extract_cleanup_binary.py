@@ -0,0 +1 @@
+../../extract/cleanup_binary.py
\ No newline at end of file
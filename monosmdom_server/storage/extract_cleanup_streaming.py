@@ -0,0 +1 @@
+../../extract/cleanup_streaming.py
\ No newline at end of file
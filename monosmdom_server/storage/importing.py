@@ -0,0 +1,244 @@
+from django.db import connection
+from storage import logic, models
+import contextlib
+import time
+import tracemalloc
+
+
+def quoted_table(model):
+    return connection.ops.quote_name(model._meta.db_table)
+
+
+def wipe_staging_tables():
+    print("    Wiping staging tables …")
+    if connection.vendor == "postgresql":
+        # Much faster than DELETE, and doesn't leave dead tuples behind:
+        with connection.cursor() as cursor:
+            cursor.execute(f"TRUNCATE {', '.join(quoted_table(model) for model in logic.STAGING_LEAF_MODELS)}")
+    else:
+        for model in logic.STAGING_LEAF_MODELS:
+            model.objects.all().delete()
+
+
+def copy_table(cursor, source_model, destination_model, *, on_conflict=""):
+    # Both models have the same columns, except that the id of OccurrenceInOsm must be freshly assigned.
+    columns = ", ".join(
+        connection.ops.quote_name(field.column)
+        for field in source_model._meta.concrete_fields
+        if field.column != "id"
+    )
+    source_table = quoted_table(source_model)
+    destination_table = quoted_table(destination_model)
+    # The "WHERE TRUE" avoids a parsing ambiguity with ON CONFLICT in SQLite:
+    cursor.execute(
+        f"INSERT INTO {destination_table} ({columns}) SELECT {columns} FROM {source_table} WHERE TRUE {on_conflict}"
+    )
+    return cursor.rowcount
+
+
+def publish_staging_tables():
+    # Must run in a transaction, so that the crawler either sees the old or the new state.
+    assert connection.in_atomic_block
+    print("    Wiping old OSM state (tables CrawlableUrl, OccurrenceInOsm) …")
+    models.CrawlableUrl.objects.all().delete()
+    models.OccurrenceInOsm.objects.all().delete()
+    print("    Copying staging tables …")
+    with connection.cursor() as cursor:
+        # Just like in a normal import, DisasterUrls are only ever upserted, never deleted:
+        copy_table(
+            cursor,
+            models.StagingDisasterUrl,
+            models.DisasterUrl,
+            on_conflict="ON CONFLICT (url_id) DO UPDATE SET reason = excluded.reason",
+        )
+        copy_table(cursor, models.StagingCrawlableUrl, models.CrawlableUrl)
+        copy_table(cursor, models.StagingOccurrenceInOsm, models.OccurrenceInOsm)
+    wipe_staging_tables()
+
+
+def swap_staging_tables():
+    """
+    Publishes the staging tables by renaming them to the live tables, and vice versa. Unlike
+    publish_staging_tables, this only needs to copy the DisasterUrls, so the transaction is much
+    shorter. It still locks out the crawler until the commit, so the caller should prepare anything
+    expensive beforehand (see update_osm_state.prepare_staged_domain_scheduling).
+    Note that nothing refers to the leaf tables, so renaming them is safe. However, the staging
+    tables must have exactly the same columns and indexes as the live tables.
+    """
+    assert connection.in_atomic_block
+    with connection.cursor() as cursor:
+        if connection.vendor == "postgresql":
+            # Take all locks up front, so that the crawler can't sneak in a DisasterUrl between copying and renaming:
+            all_tables = [quoted_table(model) for model in logic.LIVE_LEAF_MODELS + logic.STAGING_LEAF_MODELS]
+            cursor.execute(f"LOCK TABLE {', '.join(all_tables)} IN ACCESS EXCLUSIVE MODE")
+        # Just like in a normal import, DisasterUrls are never deleted. In particular, the crawler
+        # creates them when it gets redirected to a disastrous URL. The import's reason wins:
+        print("    Keeping previous DisasterUrls …")
+        copy_table(cursor, models.DisasterUrl, models.StagingDisasterUrl, on_conflict="ON CONFLICT (url_id) DO NOTHING")
+        print("    Swapping live and staging tables …")
+        for live_model, staging_model in zip(logic.LIVE_LEAF_MODELS, logic.STAGING_LEAF_MODELS):
+            live_table = quoted_table(live_model)
+            staging_table = quoted_table(staging_model)
+            temp_table = connection.ops.quote_name(f"{live_model._meta.db_table}_swap")
+            cursor.execute(f"ALTER TABLE {live_table} RENAME TO {temp_table}")
+            cursor.execute(f"ALTER TABLE {staging_table} RENAME TO {live_table}")
+            cursor.execute(f"ALTER TABLE {temp_table} RENAME TO {staging_table}")
+            swap_index_names(cursor, live_model, staging_model)
+
+
+def swap_index_names(cursor, live_model, staging_model):
+    # Renaming a table keeps its indexes, including their names. So after the swap, the live table
+    # would carry the names from StagingX.Meta.indexes, and vice versa. Then any later migration
+    # that removes or renames one of these indexes by name would act on the wrong table.
+    # The staging models mirror the live models, so the indexes correspond one-to-one.
+    for live_index, staging_index in zip(live_model._meta.indexes, staging_model._meta.indexes):
+        live_name = connection.ops.quote_name(live_index.name)
+        staging_name = connection.ops.quote_name(staging_index.name)
+        if connection.vendor == "postgresql":
+            temp_name = connection.ops.quote_name(f"{live_index.name}_swap")
+            cursor.execute(f"ALTER INDEX {live_name} RENAME TO {temp_name}")
+            cursor.execute(f"ALTER INDEX {staging_name} RENAME TO {live_name}")
+            cursor.execute(f"ALTER INDEX {temp_name} RENAME TO {staging_name}")
+        else:
+            # SQLite can't rename indexes, so re-create them instead. That's only used for
+            # development anyway. Note that the schema editor is only used to generate the SQL.
+            schema_editor = connection.schema_editor()
+            cursor.execute(f"DROP INDEX {live_name}")
+            cursor.execute(f"DROP INDEX {staging_name}")
+            cursor.execute(str(live_index.create_sql(live_model, schema_editor)))
+            cursor.execute(str(staging_index.create_sql(staging_model, schema_editor)))
+
+
+class ImportProfiler:
+    """
+    Collects the wall time, DB time, number of queries, and peak of traced memory per phase of an
+    import (see --profile). Time is always attributed to the innermost active phase only, so the
+    phases add up to the total, and anything outside of a phase counts as "other".
+    A disabled profiler costs (almost) nothing, so it can be passed around unconditionally.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stats = dict()
+        self.active_phases = []
+        self.segment_begin = None
+
+    def stats_for(self, name):
+        if name not in self.stats:
+            self.stats[name] = dict(calls=0, wall_seconds=0.0, db_seconds=0.0, queries=0, peak_traced_bytes=0)
+        return self.stats[name]
+
+    def current_stats(self):
+        return self.stats_for(self.active_phases[-1] if self.active_phases else "other")
+
+    def end_segment(self):
+        # Attribute everything since the last phase change to the phase that was active until now.
+        now = time.perf_counter()
+        stats = self.current_stats()
+        stats["wall_seconds"] += now - self.segment_begin
+        stats["peak_traced_bytes"] = max(stats["peak_traced_bytes"], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        self.segment_begin = now
+
+    @contextlib.contextmanager
+    def running(self):
+        if not self.enabled:
+            yield
+            return
+        # Note that tracemalloc slows down Python code considerably (roughly by a factor 2), so
+        # compare the phases with each other, not the total with an unprofiled run.
+        tracemalloc.start()
+        self.segment_begin = time.perf_counter()
+        try:
+            with connection.execute_wrapper(self.execute_wrapper):
+                yield
+        finally:
+            self.end_segment()
+            tracemalloc.stop()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        self.end_segment()
+        self.active_phases.append(name)
+        self.stats_for(name)["calls"] += 1
+        try:
+            yield
+        finally:
+            self.end_segment()
+            self.active_phases.pop()
+
+    def iter_phase(self, name, items):
+        # Attributes the time spent *producing* each item to the phase, e.g. reading the urlfile.
+        if not self.enabled:
+            return items
+        return self._iter_phase(name, iter(items))
+
+    def _iter_phase(self, name, iterator):
+        while True:
+            with self.phase(name):
+                item = next(iterator, None)
+            if item is None:
+                return
+            yield item
+
+    def execute_wrapper(self, execute, sql, params, many, context):
+        begin = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            stats = self.current_stats()
+            stats["db_seconds"] += time.perf_counter() - begin
+            stats["queries"] += 1
+
+    def report(self):
+        total_seconds = sum(stats["wall_seconds"] for stats in self.stats.values())
+        return dict(
+            total_seconds=total_seconds,
+            peak_traced_bytes=max((stats["peak_traced_bytes"] for stats in self.stats.values()), default=0),
+            phases=self.stats,
+        )
+
+    def print_report(self):
+        report = self.report()
+        print(
+            f"  Profile (total {report['total_seconds']:.2f}s, "
+            f"peak traced memory {report['peak_traced_bytes'] / 1e6:.1f} MB):"
+        )
+        for name, stats in sorted(self.stats.items(), key=lambda item: -item[1]["wall_seconds"]):
+            share = stats["wall_seconds"] / report["total_seconds"] * 100 if report["total_seconds"] else 0
+            print(
+                f"    {name:15} {stats['wall_seconds']:9.3f}s wall ({share:5.1f}%), {stats['db_seconds']:9.3f}s in"
+                f" {stats['queries']:7} queries, {stats['calls']:8} calls,"
+                f" peak {stats['peak_traced_bytes'] / 1e6:8.1f} MB"
+            )
+
+
+def count_rows(count_models, *, estimate=()):
+    """
+    Returns a dict from model to its number of rows, all counted in a single query, and the list of
+    models whose count is only estimated: For the models in 'estimate', the planner's estimate
+    (pg_class.reltuples) is used instead of a full count on PostgreSQL. That costs nothing, but it's
+    only as fresh as the last (auto)vacuum or analyze.
+    """
+    if connection.vendor != "postgresql":
+        estimate = []
+    subqueries = []
+    params = []
+    for model in count_models:
+        if model in estimate:
+            subqueries.append("(SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass)")
+            params.append(model._meta.db_table)
+        else:
+            subqueries.append(f"(SELECT COUNT(*) FROM {quoted_table(model)})")
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT " + ", ".join(subqueries), params)
+        counts = dict(zip(count_models, cursor.fetchone(), strict=True))
+    # A table that has never been analyzed has no estimate (-1 since PostgreSQL 14, 0 before):
+    unknown = [model for model in estimate if counts[model] is None or counts[model] <= 0]
+    if unknown:
+        exact_counts, _estimated = count_rows(unknown)
+        counts.update(exact_counts)
+    return counts, [model for model in estimate if model not in unknown]
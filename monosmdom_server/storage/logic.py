@@ -1,64 +1,88 @@
+from django.db import connection, transaction
+from django.db.models import Exists, OuterRef
 from pathlib import Path
 from storage import extract_cleanup, models
 import collections
+import contextlib
+import functools
+import importlib.metadata
+import marshal
 import publicsuffix2
+import sys
+import time
 import urllib.parse
 
 
 PSL_FILENAME = Path(__file__).resolve().parent / "data/public_suffix_list.dat"
+# Written by 'manage.py compile_psl'. Parsing the text file takes a noticeable amount of time on each
+# process start, whereas unmarshalling the already-built trie is roughly 20 times faster.
+PSL_SNAPSHOT_FILENAME = PSL_FILENAME.with_suffix(".marshal")
+# The marshal format is only stable within the same Python version, and the trie layout is an
+# implementation detail of publicsuffix2. If either changes, the snapshot is silently ignored:
+PSL_SNAPSHOT_FORMAT = (
+    "monitor-osm-domains PSL snapshot",
+    1,
+    sys.version_info[:2],
+    importlib.metadata.version("publicsuffix2"),
+)
+# SQLite refuses queries with more than 32766 parameters, and postgres gets sluggish with huge IN-lists:
+BULK_UPSERT_CHUNK_SIZE = 5000
+# When LeafModelBulkCache should be flushed, see over_budget(). An unsaved model instance takes
+# roughly 500 bytes (measured with tracemalloc), plus its strings. 50k instances are a few dozen MB,
+# and still large enough to amortize the round trips of a flush.
+FLUSH_MAX_OBJECTS = 50_000
+FLUSH_MAX_BYTES = 64 << 20
+ESTIMATED_INSTANCE_BYTES = 500
+# The hostname cache is process-global, and long-lived processes like the crawler (following redirects)
+# and the web UI only ever look up a few hostnames. So it stays small, and only the import raises it to
+# extract_cleanup.HOSTNAME_CACHE_SIZE for its duration, see large_hostname_cache().
+DEFAULT_HOSTNAME_CACHE_SIZE = 1 << 12
 
-# Some hostnames appear way too often in the dataset, and are uninteresting for our purposes.
-# These services are likely to work equally well as each other, so checking thousands of URLs is pointless.
-# Some of the pages on these servers are actually broken (i.e. 404), but I can't easily fix them.
-# I'd be happy to collaborate with you on fixing these. My focus for now is finding dead domains, offline webservers, etc.
-IGNORED_HOSTNAMES = {
-    "qr.bvg.de",  # Haltestellen Berlin, 7363 URLs
-    "fahrinfo.vbb.de",  # Haltestellen Berlin-Brandenburg, 3956 URLs
-    "ns.gis-bldam-brandenburg.de",  # Denkmale in Brandenburg, 2228 URLs
-    "www.wuppertal.de", "wuppertal.de",  # Denkmale and attractions in Wuppertal, >2128 URLs
-    "gisdata.krzn.de",  # Denkmale, GIS data, and attractions in NRW, 1592 URLs
-    "www.denkmalpflege.bremen.de", "denkmalpflege.bremen.de",  # Denkmale Bremen, >1462 URLs
-    "www.stadtwerke-muenster.de", "stadtwerke-muenster.de",  # Haltestellen Münster, >1314 URLs
-    "www.stolpersteine-berlin.de", "stolpersteine-berlin.de",  # Stolpersteine Berlin, >1075 URLs
-    "www.suehnekreuz.de", "suehnekreuz.de",  # Mahnkreuze, Germany-wide, >1008 URLs
-    "www.dortmund.de", "dortmund.de",  # ??? mostly dead links, Dortmund, >944 URLs
-    "kulturdb.de",  # Mahnkreuze, Germany-wide, 884 URLs
-    "www.rewe.de", "rewe.de",  # Discounter, Germany-wide, >866 URLs
-    "www.edeka.de", "edeka.de",  # Discounter, Germany-wide, >822 URLs
-    "denkmaldatenbank.berlin.de",  # Denkmale Berlin, 810 URLs
-    "rips-dienste.lubw.baden-wuerttemberg.de",  # Naturschutzgebiete BaWü, 746 URLs
-    "www.museenkoeln.de", "museenkoeln.de",  # Stolpersteine Köln, mostly dead links, >663 URLs
-    "db-sandsteinklettern.gipfelbuch.de",  # Gipfelbücher, 643 URLs
-    "www.facebook.com", "www.facebook.de", "de-de.facebook.com", "m.facebook.com", "facebook.com",  # If you don't know it be glad, >638 URLs
-    "www.spessartprojekt.de", "spessartprojekt.de",  # Naturschutzgebiete(?) Spessart, monstly dead links, >621 URLs
-    "nsg.naturschutzinformationen.nrw.de",  # Naturschutzgebiete NRW, 618 URLs
-    "gdi.essen.de",  # ALL DEAD LINKS, wtf, 601 URLs
-    "de.wikipedia.org", "de.m.wikipedia.org",  # You already know, >583 URLs
-    "vertretung.allianz.de",  # Store managers(?) of Allianz, 570 URLs
-    "www.nlwkn.niedersachsen.de", "nlwkn.niedersachsen.de",  # Naturschutzgebiete Niedersachsen, >556 URLs
-    # -- I didn't check the following domains, but it seems reasonable to skip them.
-    "www.denkmalprojekt.org", "denkmalprojekt.org",  # >486 URLs
-    "www.aldi-nord.de", "aldi-nord.de", "www.aldi-sued.de", "aldi-sued.de", "aldi.de",  # >438 URLs
-    "www.magdeburg.de", "magdeburg.de",  # >415 URLs
-    "www.berlin.de", "berlin.de",  # 411 URLs
-    "youtu.be", "www.youtube.com", "youtube.com",  # >385 URLs
-    "wuerzburgwiki.de",  # 371 URLs
-    "www.outdoor-karte.de", "outdoor-karte.de",  # >368 URLs
-    "www.lidl.de", "lidl.de",  # 360 URLs
-    "polska-org.pl",  # 360 URLs
-    "www.netto-online.de", "netto-online.de",  # >357 URLs
-    # This eliminates over 37k out of 572k URLs. It may be less than 10%, but it's saved work/traffic/energy nonetheless.
-    # Since we avoid recently-queried domains, this only has an effect in the long run.
-}
+# See there for the list and the rationale. It lives in extract/cleanup.py, so that the cleanup can
+# precompute the interest check (see monosmdom.json v3).
+IGNORED_HOSTNAMES = extract_cleanup.IGNORED_HOSTNAMES
 
 
 def get_cached_psl(*, _magic=[]):
     if not _magic:
-        with open(PSL_FILENAME, "r", encoding="utf8") as fp:
-            _magic.append(publicsuffix2.PublicSuffixList(fp))
+        psl = load_psl_snapshot_or_none()
+        if psl is None:
+            with open(PSL_FILENAME, "r", encoding="utf8") as fp:
+                psl = publicsuffix2.PublicSuffixList(fp)
+        _magic.append(psl)
     return _magic[0]
 
 
+def write_psl_snapshot(psl, snapshot_filename=PSL_SNAPSHOT_FILENAME):
+    # Write to a temporary file first, so that concurrently starting processes never see a half-written snapshot.
+    temp_filename = snapshot_filename.with_name(snapshot_filename.name + ".tmp")
+    with open(temp_filename, "wb") as fp:
+        marshal.dump((PSL_SNAPSHOT_FORMAT, psl.root, psl.tlds), fp)
+    temp_filename.replace(snapshot_filename)
+
+
+def load_psl_snapshot_or_none(snapshot_filename=PSL_SNAPSHOT_FILENAME, dat_filename=PSL_FILENAME):
+    """
+    Returns the PublicSuffixList from the snapshot, or None if the snapshot is missing, outdated
+    (i.e. older than the .dat file), or was written by a different Python or publicsuffix2 version.
+    """
+    try:
+        if snapshot_filename.stat().st_mtime < dat_filename.stat().st_mtime:
+            return None
+        with open(snapshot_filename, "rb") as fp:
+            # marshal.load(fp) reads the file in tiny pieces, which is several times slower:
+            snapshot_format, root, tlds = marshal.loads(fp.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if snapshot_format != PSL_SNAPSHOT_FORMAT:
+        return None
+    # Bypass __init__, which would parse the text file again:
+    psl = publicsuffix2.PublicSuffixList.__new__(publicsuffix2.PublicSuffixList)
+    psl.root = root
+    psl.tlds = tlds
+    return psl
+
+
 def get_strict_sld_and_interest(url):
     """
     Sorry for mixing two queries in the same function, but I want to avoid parsing the URL needlessly often.
@@ -73,9 +97,40 @@ def get_strict_sld_and_interest(url):
     Finding this example was non-trivial, so the difference doesn't seem to be too important.
     """
     hostname = urllib.parse.urlsplit(url).hostname
-    sld_or_none = get_cached_psl().get_sld(hostname, strict=True)
-    have_interest = hostname not in IGNORED_HOSTNAMES
-    return sld_or_none, have_interest
+    return get_strict_sld_and_interest_by_hostname(hostname)
+
+
+def lookup_strict_sld_and_interest_by_hostname(hostname):
+    return extract_cleanup.strict_sld_and_interest_by_hostname(get_cached_psl(), hostname)
+
+
+# Replaced by large_hostname_cache(), hence the indirection through a list:
+_hostname_cache = [functools.lru_cache(maxsize=DEFAULT_HOSTNAME_CACHE_SIZE)(lookup_strict_sld_and_interest_by_hostname)]
+
+
+def get_strict_sld_and_interest_by_hostname(hostname):
+    # Note that each worker process of 'update_osm_state --jobs' has its own cache.
+    return _hostname_cache[0](hostname)
+
+
+def hostname_cache_info():
+    return _hostname_cache[0].cache_info()
+
+
+@contextlib.contextmanager
+def large_hostname_cache():
+    """
+    Uses a fresh hostname cache that is large enough for a full import, and drops it afterwards.
+    Enter this before starting the workers of 'update_osm_state --jobs', so that they inherit it.
+    """
+    previous_cache = _hostname_cache[0]
+    _hostname_cache[0] = functools.lru_cache(maxsize=extract_cleanup.HOSTNAME_CACHE_SIZE)(
+        lookup_strict_sld_and_interest_by_hostname
+    )
+    try:
+        yield
+    finally:
+        _hostname_cache[0] = previous_cache
 
 
 def upsert_url(raw_url):
@@ -87,24 +142,250 @@ def upsert_url(raw_url):
     return url
 
 
+def bulk_upsert_unique(model, field_name, values):
+    """
+    Makes sure that a row of 'model' exists for each of the given 'values' of the unique field
+    'field_name', and returns a dict that maps each value to the primary key of its row.
+    Existing rows are left untouched.
+    We can't simply use bulk_create(update_conflicts=True), because it does not return primary keys:
+        https://code.djangoproject.com/ticket/7596#comment:16
+    So instead, we look up the existing rows, insert only the missing ones, and look those up again.
+    During a typical import, nearly all rows already exist, so that's usually one query per chunk.
+    """
+    id_by_value = dict()
+    values = list(dict.fromkeys(values))
+    for chunk_begin in range(0, len(values), BULK_UPSERT_CHUNK_SIZE):
+        chunk = values[chunk_begin:chunk_begin + BULK_UPSERT_CHUNK_SIZE]
+        id_by_value.update(model.objects.filter(**{f"{field_name}__in": chunk}).values_list(field_name, "id"))
+        missing = [value for value in chunk if value not in id_by_value]
+        if not missing:
+            continue
+        # Another process (e.g. the crawler following a redirect) might insert the same row
+        # concurrently. In that case, simply use their row:
+        model.objects.bulk_create([model(**{field_name: value}) for value in missing], ignore_conflicts=True)
+        id_by_value.update(model.objects.filter(**{f"{field_name}__in": missing}).values_list(field_name, "id"))
+    assert len(id_by_value) == len(values), (model, len(id_by_value), len(values))
+    return id_by_value
+
+
+def can_copy():
+    # COPY FROM STDIN through psycopg 3's copy API. Other backends (e.g. SQLite) use bulk_create.
+    return connection.vendor == "postgresql"
+
+
+def copy_fields(model):
+    # All columns that an INSERT would set, i.e. everything except an automatic primary key.
+    return [field for field in model._meta.concrete_fields if field is not model._meta.auto_field]
+
+
+def copy_row(obj, fields):
+    row = []
+    for field in fields:
+        if field.is_relation:
+            # The related Url or Domain instance might have received its primary key only after obj was
+            # created (see LeafModelBulkCache.resolve_pending), so the cached "url_id" might still be None.
+            row.append(getattr(obj, field.name).pk)
+        else:
+            row.append(field.get_db_prep_save(field.pre_save(obj, True), connection))
+    return row
+
+
+def copy_into(table, model, objs):
+    fields = copy_fields(model)
+    columns = ", ".join(connection.ops.quote_name(field.column) for field in fields)
+    with connection.cursor() as cursor:
+        # Django doesn't know about COPY, so talk to the psycopg cursor directly:
+        with cursor.cursor.copy(f"COPY {connection.ops.quote_name(table)} ({columns}) FROM STDIN") as copy:
+            for obj in objs:
+                copy.write_row(copy_row(obj, fields))
+
+
+def insert_leaves(model, objs, *, use_copy):
+    """
+    Inserts all objs, just like bulk_create, but with use_copy, the rows are streamed with COPY,
+    which is several times faster than the huge multi-row INSERTs that bulk_create builds.
+    Note that this does not set the primary key of the objs.
+    """
+    if not objs:
+        return
+    if use_copy:
+        copy_into(model._meta.db_table, model, objs)
+    else:
+        model.objects.bulk_create(objs)
+
+
+def upsert_leaves(model, objs, *, unique_field, update_field, use_copy):
+    """
+    Like bulk_create(update_conflicts=True). COPY can't deal with conflicts by itself, so with use_copy,
+    the rows are copied into a temporary table first, and then upserted from there in one statement.
+    """
+    if not objs:
+        return
+    if not use_copy:
+        model.objects.bulk_create(
+            objs, update_conflicts=True, update_fields=[update_field], unique_fields=[unique_field]
+        )
+        return
+    table = connection.ops.quote_name(model._meta.db_table)
+    columns = ", ".join(connection.ops.quote_name(field.column) for field in copy_fields(model))
+    unique_column = connection.ops.quote_name(model._meta.get_field(unique_field).column)
+    update_column = connection.ops.quote_name(model._meta.get_field(update_field).column)
+    # ON COMMIT DROP only works inside a transaction:
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f"CREATE TEMPORARY TABLE monosmdom_copy_upsert (LIKE {table}) ON COMMIT DROP")
+        copy_into("monosmdom_copy_upsert", model, objs)
+        cursor.execute(
+            f"INSERT INTO {table} ({columns}) SELECT {columns} FROM monosmdom_copy_upsert"
+            f" ON CONFLICT ({unique_column}) DO UPDATE SET {update_column} = EXCLUDED.{update_column}"
+        )
+        # There might be more flushes in the same transaction:
+        cursor.execute("DROP TABLE monosmdom_copy_upsert")
+
+
+def bulk_upsert_urls(url_strings):
+    return bulk_upsert_unique(models.Url, "url", url_strings)
+
+
+def bulk_upsert_domains(domain_names):
+    return bulk_upsert_unique(models.Domain, "domain_name", domain_names)
+
+
+LeafModels = collections.namedtuple("LeafModels", ["disasterurl", "crawlableurl", "occurrenceinosm"])
+LIVE_LEAF_MODELS = LeafModels(models.DisasterUrl, models.CrawlableUrl, models.OccurrenceInOsm)
+STAGING_LEAF_MODELS = LeafModels(models.StagingDisasterUrl, models.StagingCrawlableUrl, models.StagingOccurrenceInOsm)
+
+
 class LeafModelBulkCache:
-    def __init__(self):
+    def __init__(
+        self,
+        leaf_models=LIVE_LEAF_MODELS,
+        profiler=None,
+        *,
+        max_objects=FLUSH_MAX_OBJECTS,
+        max_bytes=FLUSH_MAX_BYTES,
+        use_copy=None,
+        sort_by_domain=False,
+    ):
+        # Which tables to write to, i.e. either the live ones, or the staging ones:
+        self.leaf_models = leaf_models
+        # Whether to write the leaf models with COPY (see insert_leaves). Only possible on PostgreSQL.
+        if use_copy is None:
+            use_copy = can_copy()
+        assert not use_copy or can_copy(), "COPY requires PostgreSQL"
+        self.use_copy = use_copy
+        # Whether to sort each flush by registrable domain, see sort_pending():
+        self.sort_by_domain = sort_by_domain
+        self.domain_switches = dict(unsorted=0, sorted=0)
+        # Optional, see importing.ImportProfiler:
+        self.profiler = profiler
+        # Url and Domain instances that have been handed out, but not written to the DB yet:
+        self.pending_urls = dict()
+        self.pending_domains = dict()
         self.objs_disasterurl = []
         self.objs_crawlableurl = []
         self.objs_occurrenceinosm = []
+        # Memory budget, see over_budget():
+        self.max_objects = max_objects
+        self.max_bytes = max_bytes
+        self.pending_objects = 0
+        self.pending_bytes = 0
+        self.flush_stats = dict(flushes=0, objects=0, total_seconds=0.0, max_seconds=0.0)
+
+    def account(self, *strings):
+        # Called for each new instance, with the strings that it holds on to.
+        self.pending_objects += 1
+        self.pending_bytes += ESTIMATED_INSTANCE_BYTES + sum(len(string) for string in strings)
+
+    def over_budget(self):
+        # The caller decides when to flush, because it must happen between two entries. Thus, a
+        # single huge entry (some URLs have 10k occurrences) can exceed the budget, but only by itself.
+        return self.pending_objects >= self.max_objects or self.pending_bytes >= self.max_bytes
+
+    def url_instance(self, url_string):
+        url_obj = self.pending_urls.get(url_string)
+        if url_obj is None:
+            url_obj = models.Url(url=url_string)
+            self.pending_urls[url_string] = url_obj
+            self.account(url_string)
+        return url_obj
+
+    def domain_instance(self, domain_name):
+        domain_obj = self.pending_domains.get(domain_name)
+        if domain_obj is None:
+            domain_obj = models.Domain(domain_name=domain_name)
+            self.pending_domains[domain_name] = domain_obj
+            self.account(domain_name)
+        return domain_obj
+
+    def phase(self, name):
+        if self.profiler is None:
+            return contextlib.nullcontext()
+        return self.profiler.phase(name)
 
     def flush(self):
-        models.DisasterUrl.objects.bulk_create(
-            self.objs_disasterurl,
-            update_conflicts=True,
-            update_fields=["reason"],
-            unique_fields=["url"],
-        )
+        time_begin = time.perf_counter()
+        if self.sort_by_domain:
+            self.sort_pending()
+        self.resolve_pending()
+        with self.phase("leaf_flush"):
+            self.write_leaves()
         self.objs_disasterurl = []
-        models.CrawlableUrl.objects.bulk_create(self.objs_crawlableurl)
         self.objs_crawlableurl = []
-        models.OccurrenceInOsm.objects.bulk_create(self.objs_occurrenceinosm)
         self.objs_occurrenceinosm = []
+        seconds = time.perf_counter() - time_begin
+        self.flush_stats["flushes"] += 1
+        self.flush_stats["objects"] += self.pending_objects
+        self.flush_stats["total_seconds"] += seconds
+        self.flush_stats["max_seconds"] = max(self.flush_stats["max_seconds"], seconds)
+        self.pending_objects = 0
+        self.pending_bytes = 0
+
+    def sort_pending(self):
+        # Insert everything grouped by registrable domain, and then by URL: New Urls get consecutive
+        # IDs per domain, and consecutive rows (and their index entries, e.g. on domain_id) end up on
+        # the same pages, instead of all over the B-trees. Note that the sorting is stable, so the
+        # "last reason wins" rule for DisasterUrl still holds.
+        domain_by_url = {crurl.url.url: crurl.domain.domain_name for crurl in self.objs_crawlableurl}
+
+        def url_key(url_string):
+            return (domain_by_url.get(url_string, ""), url_string)
+
+        self.pending_urls = dict(sorted(self.pending_urls.items(), key=lambda item: url_key(item[0])))
+        self.pending_domains = dict(sorted(self.pending_domains.items()))
+        self.domain_switches["unsorted"] += count_domain_switches(self.objs_crawlableurl)
+        self.objs_crawlableurl.sort(key=lambda crurl: url_key(crurl.url.url))
+        self.domain_switches["sorted"] += count_domain_switches(self.objs_crawlableurl)
+        self.objs_disasterurl.sort(key=lambda durl: url_key(durl.url.url))
+        self.objs_occurrenceinosm.sort(key=lambda occ: url_key(occ.url.url))
+
+    def resolve_pending(self):
+        # Assign primary keys to all pending Url and Domain instances. The leaf model instances
+        # refer to these exact instances, so they pick up the IDs in bulk_create.
+        with self.phase("url_upsert"):
+            url_ids = bulk_upsert_urls(self.pending_urls.keys())
+            for url_string, url_obj in self.pending_urls.items():
+                url_obj.id = url_ids[url_string]
+            self.pending_urls = dict()
+        with self.phase("domain_upsert"):
+            domain_ids = bulk_upsert_domains(self.pending_domains.keys())
+            for domain_name, domain_obj in self.pending_domains.items():
+                domain_obj.id = domain_ids[domain_name]
+            self.pending_domains = dict()
+
+    def write_leaves(self):
+        # A Url can have several disaster reasons, but only one DisasterUrl. Postgres refuses to
+        # update the same row twice in one statement, so only keep the last reason, just like an
+        # upsert of each reason in turn would.
+        disasterurls_by_url_id = {durl.url.id: durl for durl in self.objs_disasterurl}
+        upsert_leaves(
+            self.leaf_models.disasterurl,
+            list(disasterurls_by_url_id.values()),
+            unique_field="url",
+            update_field="reason",
+            use_copy=self.use_copy,
+        )
+        insert_leaves(self.leaf_models.crawlableurl, self.objs_crawlableurl, use_copy=self.use_copy)
+        insert_leaves(self.leaf_models.occurrenceinosm, self.objs_occurrenceinosm, use_copy=self.use_copy)
 
     # @classmethod
     # FIXME: Somehow, "@classmethod" breaks wk-only arguments. Why?!
@@ -117,7 +398,8 @@ class LeafModelBulkCache:
                 # Need to overwrite the "wrong" reason:
                 durl.save()
         else:
-            cache.objs_disasterurl.append(models.DisasterUrl(url=url, reason=reason))
+            cache.objs_disasterurl.append(cache.leaf_models.disasterurl(url=url, reason=reason))
+            cache.account(reason)
 
     # @classmethod
     # FIXME: Somehow, "@classmethod" breaks "**kwargs". Why?!
@@ -127,20 +409,203 @@ class LeafModelBulkCache:
             return crurl
         # Note: If we use a cache, then we can assume this is a bulk import that already has
         # been deduplicated.
-        crurl = models.CrawlableUrl(**kwargs)
+        crurl = cache.leaf_models.crawlableurl(**kwargs)
         cache.objs_crawlableurl.append(crurl)
-        # We shouldn't return crurl because it does not have an ID yet, and never will have.
+        cache.account()
+        # We shouldn't return crurl because it won't be saved until the next flush.
         # We shouldn't return None, because that might be misconstrued as the indication for
         # disaster. Instead, return a poison value, since in the case of bulk inserting, the
         # CrawlableUrl should not be used anyway.
         return models.CrawlableUrl.DoesNotExist()
 
     def cache_occ(self, **kwargs):
-        occ = models.OccurrenceInOsm(**kwargs)
+        occ = self.leaf_models.occurrenceinosm(**kwargs)
         self.objs_occurrenceinosm.append(occ)
+        self.account(occ.osm_tag_key, occ.osm_tag_value)
+
+
+def count_domain_switches(crawlableurls):
+    # How often two consecutive CrawlableUrls belong to different domains. Lower means better locality.
+    return sum(a.domain is not b.domain for a, b in zip(crawlableurls, crawlableurls[1:]))
+
+
+def occurrence_key(occ):
+    return (occ.osm_item_type, occ.osm_item_id, occ.osm_tag_key, occ.osm_tag_value, occ.osm_long, occ.osm_lat)
+
+
+OCCURRENCE_KEY_FIELDS = ["osm_item_type", "osm_item_id", "osm_tag_key", "osm_tag_value", "osm_long", "osm_lat"]
+
+
+def chunked(items, chunk_size=BULK_UPSERT_CHUNK_SIZE):
+    items = list(items)
+    for chunk_begin in range(0, len(items), chunk_size):
+        yield items[chunk_begin:chunk_begin + chunk_size]
+
+
+class LeafModelDiffCache(LeafModelBulkCache):
+    """
+    Like LeafModelBulkCache, but instead of blindly inserting the leaf models into freshly-wiped
+    tables, each flush compares the leaf models with the rows that already exist for the same Urls,
+    and only inserts, updates, or deletes the difference. After the last flush, call
+    delete_unseen() to remove the rows of all Urls that are no longer part of the import.
+    The number of touched rows is collected in 'stats'.
+    """
+
+    def __init__(self, profiler=None, **budget):
+        # Diffing only makes sense against the live tables:
+        super().__init__(LIVE_LEAF_MODELS, profiler, **budget)
+        self.seen_crawlable_url_ids = set()
+        self.seen_occurrence_url_ids = set()
+        self.stats = {
+            table: dict(inserted=0, updated=0, deleted=0, unchanged=0)
+            for table in ["disasterurl", "crawlableurl", "occurrenceinosm"]
+        }
+
+    def write_leaves(self):
+        self._write_disasterurls()
+        self._write_crawlableurls()
+        self._write_occurrences()
+
+    def _write_disasterurls(self):
+        # If there are multiple reasons for the same Url, the last one wins, just like with
+        # bulk_create(update_conflicts=True).
+        wanted = {durl.url.id: durl for durl in self.objs_disasterurl}
+        existing = dict()
+        for chunk in chunked(wanted.keys()):
+            existing.update(models.DisasterUrl.objects.filter(url_id__in=chunk).values_list("url_id", "reason"))
+        to_insert = [durl for url_id, durl in wanted.items() if url_id not in existing]
+        to_update = [durl for url_id, durl in wanted.items() if url_id in existing and existing[url_id] != durl.reason]
+        for durl in to_update:
+            # See _write_crawlableurls:
+            durl.url_id = durl.url.id
+        insert_leaves(models.DisasterUrl, to_insert, use_copy=self.use_copy)
+        models.DisasterUrl.objects.bulk_update(to_update, ["reason"], batch_size=BULK_UPSERT_CHUNK_SIZE)
+        stats = self.stats["disasterurl"]
+        stats["inserted"] += len(to_insert)
+        stats["updated"] += len(to_update)
+        stats["unchanged"] += len(wanted) - len(to_insert) - len(to_update)
+
+    def _write_crawlableurls(self):
+        wanted = {crurl.url.id: crurl for crurl in self.objs_crawlableurl}
+        existing = dict()
+        for chunk in chunked(wanted.keys()):
+            existing.update(models.CrawlableUrl.objects.filter(url_id__in=chunk).values_list("url_id", "domain_id"))
+        to_insert = [crurl for url_id, crurl in wanted.items() if url_id not in existing]
+        to_update = [
+            crurl for url_id, crurl in wanted.items() if url_id in existing and existing[url_id] != crurl.domain.id
+        ]
+        for crurl in to_update:
+            # The Url was still unsaved when the CrawlableUrl was created, so the primary key is
+            # still None. bulk_create() picks up the ID by itself, but bulk_update() doesn't:
+            crurl.url_id = crurl.url.id
+        insert_leaves(models.CrawlableUrl, to_insert, use_copy=self.use_copy)
+        models.CrawlableUrl.objects.bulk_update(to_update, ["domain"], batch_size=BULK_UPSERT_CHUNK_SIZE)
+        self.seen_crawlable_url_ids.update(wanted.keys())
+        stats = self.stats["crawlableurl"]
+        stats["inserted"] += len(to_insert)
+        stats["updated"] += len(to_update)
+        stats["unchanged"] += len(wanted) - len(to_insert) - len(to_update)
+
+    def _write_occurrences(self):
+        # Occurrences have no natural key, and duplicates are meaningful. So for each Url, match the
+        # wanted occurrences against the existing ones as multisets.
+        wanted_by_url_id = collections.defaultdict(list)
+        for occ in self.objs_occurrenceinosm:
+            wanted_by_url_id[occ.url.id].append(occ)
+        # A Url might have been diffed by an earlier flush already (e.g. if it appears both as a
+        # disaster and as a simplified URL). Its existing rows are already accounted for, so the
+        # remaining occurrences can only be new:
+        to_insert = []
+        diff_url_ids = []
+        for url_id, occs in wanted_by_url_id.items():
+            if url_id in self.seen_occurrence_url_ids:
+                to_insert.extend(occs)
+            else:
+                diff_url_ids.append(url_id)
+        existing_by_url_id = collections.defaultdict(list)
+        for chunk in chunked(diff_url_ids):
+            for occ_id, url_id, *key in models.OccurrenceInOsm.objects.filter(url_id__in=chunk).values_list(
+                "id", "url_id", *OCCURRENCE_KEY_FIELDS
+            ):
+                existing_by_url_id[url_id].append((occ_id, tuple(key)))
+        to_delete = []
+        unchanged = 0
+        for url_id in diff_url_ids:
+            wanted_by_key = collections.defaultdict(list)
+            for occ in wanted_by_url_id[url_id]:
+                wanted_by_key[occurrence_key(occ)].append(occ)
+            for occ_id, key in existing_by_url_id[url_id]:
+                if wanted_by_key[key]:
+                    wanted_by_key[key].pop()
+                    unchanged += 1
+                else:
+                    to_delete.append(occ_id)
+            for occs in wanted_by_key.values():
+                to_insert.extend(occs)
+        for chunk in chunked(to_delete):
+            models.OccurrenceInOsm.objects.filter(id__in=chunk).delete()
+        insert_leaves(models.OccurrenceInOsm, to_insert, use_copy=self.use_copy)
+        self.seen_occurrence_url_ids.update(wanted_by_url_id.keys())
+        stats = self.stats["occurrenceinosm"]
+        stats["inserted"] += len(to_insert)
+        stats["deleted"] += len(to_delete)
+        stats["unchanged"] += unchanged
+
+    def delete_unseen(self):
+        # Note that DisasterUrls are never deleted, not even in a full import: The crawler also
+        # creates them when it gets redirected to a disastrous URL, and we can't tell them apart.
+        unseen_crawlable = (
+            set(models.CrawlableUrl.objects.values_list("url_id", flat=True).iterator()) - self.seen_crawlable_url_ids
+        )
+        for chunk in chunked(unseen_crawlable):
+            models.CrawlableUrl.objects.filter(url_id__in=chunk).delete()
+        self.stats["crawlableurl"]["deleted"] += len(unseen_crawlable)
+        unseen_occurrence = (
+            set(models.OccurrenceInOsm.objects.values_list("url_id", flat=True).distinct().iterator())
+            - self.seen_occurrence_url_ids
+        )
+        for chunk in chunked(unseen_occurrence):
+            deleted, _ = models.OccurrenceInOsm.objects.filter(url_id__in=chunk).delete()
+            self.stats["occurrenceinosm"]["deleted"] += deleted
 
 
 MaybeCrawlableResult = collections.namedtuple("MaybeCrawlableResult", ["url_obj", "domain", "want_to_crawl"])
+UrlClassification = collections.namedtuple("UrlClassification", ["url", "sld", "have_interest", "disaster_reason"])
+
+
+def domains_changing_has_crawlable(crawlable_model=models.CrawlableUrl):
+    """
+    Finds the domains whose Domain.has_crawlable disagrees with the rows of crawlable_model, which
+    is either CrawlableUrl or StagingCrawlableUrl. This needs to look at every Domain, so it's slow.
+    Returns the querysets of domains that gain and lose their CrawlableUrls, respectively.
+    """
+    any_crawlable = Exists(crawlable_model.objects.filter(domain=OuterRef("pk")))
+    gaining = models.Domain.objects.filter(any_crawlable, has_crawlable=False)
+    losing = models.Domain.objects.filter(~any_crawlable, has_crawlable=True)
+    return gaining, losing
+
+
+def refresh_domain_has_crawlable():
+    """
+    Recomputes Domain.has_crawlable after CrawlableUrls have been written in bulk, which bypasses
+    CrawlableUrl.save(). Only touches the rows that actually change, which usually are only a few.
+    Returns the number of domains that gained and lost their CrawlableUrls, respectively.
+    """
+    gaining, losing = domains_changing_has_crawlable()
+    return gaining.update(has_crawlable=True), losing.update(has_crawlable=False)
+
+
+def set_domain_has_crawlable(domain_ids, has_crawlable):
+    """
+    Applies the result of domains_changing_has_crawlable() that was computed earlier, which only
+    needs to touch the given rows. Returns the number of domains that actually changed.
+    """
+    changed = 0
+    for chunk in chunked(domain_ids):
+        changed += models.Domain.objects.filter(id__in=chunk, has_crawlable=not has_crawlable).update(
+            has_crawlable=has_crawlable
+        )
+    return changed
 
 
 def discover_url(url_string, *, mark_crawlable=False, cache=None):
@@ -174,25 +639,57 @@ def discover_url(url_string, *, mark_crawlable=False, cache=None):
     - Url/Domain/CrawlableUrl are upserted; i.e. if they already exist in the DB, the existing row will be used.
       (Note that duplicate DisasterUrls are somewhat reasonable during import.)
     - CrawlableUrl" instance is created and linked, and the CrawlableUrl instance is returned.
+    - If a LeafModelBulkCache is given, nothing is written to the DB at all. Instead, the returned
+      Url and Domain instances are unsaved, and only receive their IDs during cache.flush().
 
     FIXME: This obviously needs tests.
     """
+    classification = classify_url(url_string)
+    if cache is not None:
+        # During import, the URL was already simplified by extract/cleanup.py:
+        assert classification.url == url_string, (classification.url, url_string)
+    return discover_classified_url(classification, mark_crawlable=mark_crawlable, cache=cache)
+
+
+def classify_url(url_string):
+    """
+    Runs the syntactical, semantical, and interest checks of discover_url (see there), without
+    touching the DB. This is the CPU-heavy part, so it can also run in a worker process.
+    Returns an UrlClassification, where 'url' is the simplified URL (or the original URL in case of
+    a syntactical failure), and exactly one of 'sld' and 'disaster_reason' is None.
+    """
     # Note that we don't apply regex-fixups to redirects, since these should absolutely be valid URLs already.
     # === Syntactical check:
     simplified_url, disaster_reason = extract_cleanup.simplified_url_or_disaster_reason(url_string)
     assert (simplified_url is None) != (disaster_reason is None)
-    if cache is not None:
-        assert simplified_url == url_string, (simplified_url, url_string)
     if simplified_url is not None:
         url_string = simplified_url
-    # Note that only now we know what the URL in the database will actually be, since we want to deduplicate in case of "weird" redirects.
-    url_object = upsert_url(url_string)
     # === Semantical and interest check:
     second_level_domain, have_interest = None, False
     if disaster_reason is None:
         second_level_domain, have_interest = get_strict_sld_and_interest(url_string)
         if second_level_domain is None:
             disaster_reason = "has no public suffix"
+    return UrlClassification(url_string, second_level_domain, have_interest, disaster_reason)
+
+
+def classify_url_tuple(url_string):
+    # Plain tuples are cheaper to pickle than namedtuples, which matters when sending them back
+    # from worker processes.
+    return tuple(classify_url(url_string))
+
+
+def discover_classified_url(classification, *, mark_crawlable=False, cache=None):
+    """
+    The DB part of discover_url (see there), given the result of classify_url.
+    """
+    url_string, second_level_domain, have_interest, disaster_reason = classification
+    # Note that only now we know what the URL in the database will actually be, since we want to deduplicate in case
+    # of "weird" redirects.
+    if cache is None:
+        url_object = upsert_url(url_string)
+    else:
+        url_object = cache.url_instance(url_string)
     # === Handle syntactical/semantical failure:
     if disaster_reason is not None:
         LeafModelBulkCache.upsert_durl(cache, url=url_object, reason=disaster_reason)
@@ -201,7 +698,10 @@ def discover_url(url_string, *, mark_crawlable=False, cache=None):
     if not have_interest:
         return MaybeCrawlableResult(url_object, None, False)
     # === Handle crawlable URL, the only happy path:
-    domain_object, _created = models.Domain.objects.get_or_create(domain_name=second_level_domain)
+    if cache is None:
+        domain_object, _created = models.Domain.objects.get_or_create(domain_name=second_level_domain)
+    else:
+        domain_object = cache.domain_instance(second_level_domain)
     if mark_crawlable:
         _crawlable_object = LeafModelBulkCache.upsert_crurl_via(cache, url=url_object, domain=domain_object)
     return MaybeCrawlableResult(url_object, domain_object, True)
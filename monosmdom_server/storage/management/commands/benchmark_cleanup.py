@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+from django.core.management.base import BaseCommand
+from storage import extract_cleanup
+from storage.management.commands import generate_urlfile
+import time
+
+
+def best_urls_per_second(function, urls, repeat):
+    best = None
+    for _ in range(repeat):
+        time_begin = time.perf_counter()
+        for url in urls:
+            function(url)
+        seconds = time.perf_counter() - time_begin
+        if best is None or seconds < best:
+            best = seconds
+    return len(urls) / best
+
+
+class Command(BaseCommand):
+    help = (
+        "Micro-benchmarks repair_easy_stuff of extract/cleanup.py, which runs on every single tag value of the extract"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--urls",
+            help="Approximate number of synthetic URLs, see generate_urlfile (default: 100000)",
+            type=int,
+            default=100000,
+        )
+        parser.add_argument("--seed", help="Seed for the random number generator (default: 1)", type=int, default=1)
+        parser.add_argument(
+            "--repeat",
+            help="How often to run each variant; only the best run counts (default: 5)",
+            type=int,
+            default=5,
+        )
+
+    def handle(self, *, urls, seed, repeat, **options):
+        assert repeat >= 1, repeat
+        findings = generate_urlfile.UrlfileGenerator(urls, seed).raw_data()["findings"]
+        # Exactly the strings that split_tag_value would pass to repair_easy_stuff:
+        partial_urls = [
+            partial_url for entry in findings for partial_url in extract_cleanup.RE_MULTI_VALUE.split(entry["url"])
+        ]
+        num_slow = sum(extract_cleanup.RE_NEEDS_EASY_REPAIR.search(url) is not None for url in partial_urls)
+        print(
+            f"Benchmarking with {len(partial_urls)} URLs, "
+            f"{num_slow} ({num_slow / len(partial_urls):.1%}) of which might need repairs …"
+        )
+        for url in partial_urls:
+            assert extract_cleanup.repair_easy_stuff(url) == extract_cleanup.repair_easy_stuff_thoroughly(url), url
+        thorough = best_urls_per_second(extract_cleanup.repair_easy_stuff_thoroughly, partial_urls, repeat)
+        print(f"    Always all EASY_REPAIRS: {thorough:,.0f} URLs/s")
+        fast = best_urls_per_second(extract_cleanup.repair_easy_stuff, partial_urls, repeat)
+        print(f"    With prefilter:          {fast:,.0f} URLs/s ({fast / thorough:.1f}x)")
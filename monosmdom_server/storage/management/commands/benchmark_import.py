@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection
+from storage import extract_cleanup, logic, models
+from storage.management.commands import generate_urlfile
+import contextlib
+import io
+import os
+import statistics
+import tempfile
+import time
+
+
+class Command(BaseCommand):
+    help = "Runs 'update_osm_state --force OVERWRITE' against a scratch database, and reports the throughput"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "urlfile",
+            nargs="?",
+            help="File to import. If omitted, a synthetic one is generated (see generate_urlfile)",
+            metavar="file_with_all_osm_urls.monosmdom.json_or_bin",
+        )
+        parser.add_argument(
+            "--urls",
+            help="Without urlfile: Approximate number of simplified URLs (default: 100000)",
+            type=int,
+            default=100000,
+        )
+        parser.add_argument(
+            "--seed",
+            help="Without urlfile: Seed for the random number generator (default: 1)",
+            type=int,
+            default=1,
+        )
+        parser.add_argument(
+            "--format-version",
+            help="Without urlfile: Version of the generated file (default: 3)",
+            type=int,
+            choices=extract_cleanup.URLFILE_VERSIONS,
+            default=3,
+        )
+        parser.add_argument(
+            "--output-format",
+            help="Without urlfile: json (default) or binary",
+            choices=extract_cleanup.OUTPUT_FORMATS,
+            default="json",
+        )
+        parser.add_argument(
+            "--repeat",
+            help="How often to run the import, each time on a fresh scratch database (default: 3)",
+            type=int,
+            default=3,
+        )
+        parser.add_argument("--jobs", help="Passed on to update_osm_state", type=int, default=1)
+        parser.add_argument("--resumable", help="Passed on to update_osm_state", action="store_true")
+        parser.add_argument(
+            "--profile",
+            help="Passed on to update_osm_state (slows down the import)",
+            action="store_true",
+        )
+        parser.add_argument(
+            "--flush-objects",
+            help="Passed on to update_osm_state",
+            type=int,
+            default=logic.FLUSH_MAX_OBJECTS,
+        )
+        parser.add_argument(
+            "--flush-megabytes",
+            help="Passed on to update_osm_state",
+            type=int,
+            default=logic.FLUSH_MAX_BYTES >> 20,
+        )
+        parser.add_argument("--no-copy", help="Passed on to update_osm_state", action="store_true")
+        parser.add_argument("--sort-by-domain", help="Passed on to update_osm_state", action="store_true")
+        parser.add_argument("--verbose", help="Show the output of update_osm_state", action="store_true")
+
+    def handle(
+        self,
+        *,
+        urlfile,
+        urls,
+        seed,
+        format_version,
+        output_format,
+        repeat,
+        jobs,
+        resumable,
+        profile,
+        flush_objects,
+        flush_megabytes,
+        no_copy,
+        sort_by_domain,
+        verbose,
+        **options,
+    ):
+        assert repeat >= 1, repeat
+        with tempfile.TemporaryDirectory() as tempdir:
+            if urlfile is None:
+                urlfile = os.path.join(
+                    tempdir, f"synthetic_{urls}_{seed}.monosmdom.{'bin' if output_format == 'binary' else 'json'}"
+                )
+                print(f"Generating {urlfile} …")
+                with contextlib.redirect_stdout(io.StringIO()):
+                    generate_urlfile.generate_urlfile(
+                        urlfile, urls, seed=seed, format_version=format_version, output_format=output_format
+                    )
+            print(f"Benchmarking the import of {urlfile} ({os.path.getsize(urlfile)} bytes), {repeat} times …")
+            import_options = dict(
+                force="OVERWRITE",
+                jobs=jobs,
+                resumable=resumable,
+                profile=profile,
+                flush_objects=flush_objects,
+                flush_megabytes=flush_megabytes,
+                no_copy=no_copy,
+                sort_by_domain=sort_by_domain,
+            )
+            results = [self.run_once(urlfile, import_options, verbose) for _ in range(repeat)]
+        seconds = [result["seconds"] for result in results]
+        num_urls = results[0]["urls"]
+        for result in results[1:]:
+            assert result["urls"] == num_urls, "Same input, but different result?!"
+        best = min(seconds)
+        print(
+            f"Imported {num_urls} URLs, {results[0]['crawlable']} crawlable, {results[0]['occurrences']} occurrences."
+        )
+        print(f"Seconds per run: {', '.join(f'{s:.2f}' for s in seconds)} (median {statistics.median(seconds):.2f})")
+        print(f"Best run: {num_urls / best:.0f} URLs/s, {results[0]['occurrences'] / best:.0f} occurrences/s")
+
+    def run_once(self, urlfile, import_options, verbose):
+        # The scratch database is created and destroyed just like the test database, so the real
+        # database is never touched. On PostgreSQL, this requires the permission to create databases.
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+            with output:
+                time_begin = time.perf_counter()
+                call_command("update_osm_state", urlfile, **import_options)
+                time_end = time.perf_counter()
+            result = dict(
+                seconds=time_end - time_begin,
+                urls=models.Url.objects.count(),
+                crawlable=models.CrawlableUrl.objects.count(),
+                occurrences=models.OccurrenceInOsm.objects.count(),
+            )
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        print(f"    {result['seconds']:.2f}s, {result['urls'] / result['seconds']:.0f} URLs/s")
+        return result
@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+
+from django.core.management.base import BaseCommand
+from storage import logic
+import publicsuffix2
+import time
+
+
+class Command(BaseCommand):
+    help = (
+        "Compiles the public suffix list into a snapshot that loads much faster. Re-run after updating the .dat file."
+    )
+
+    def handle(self, **options):
+        print(f"Parsing {logic.PSL_FILENAME} …")
+        time_begin = time.perf_counter()
+        with open(logic.PSL_FILENAME, "r", encoding="utf8") as fp:
+            psl = publicsuffix2.PublicSuffixList(fp)
+        time_parsed = time.perf_counter()
+        logic.write_psl_snapshot(psl)
+        psl_loaded = logic.load_psl_snapshot_or_none()
+        time_loaded = time.perf_counter()
+        assert psl_loaded is not None, "Snapshot was written, but can't be loaded?!"
+        assert psl_loaded.root == psl.root
+        print(f"Wrote {logic.PSL_SNAPSHOT_FILENAME} ({logic.PSL_SNAPSHOT_FILENAME.stat().st_size} bytes).")
+        print(
+            f"Parsing took {(time_parsed - time_begin) * 1000:.1f} ms, "
+            f"loading the snapshot took {(time_loaded - time_parsed) * 1000:.1f} ms."
+        )
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+from django.core.management.base import BaseCommand
+from storage import extract_cleanup, extract_cleanup_binary, logic
+import json
+import os
+import random
+
+
+# === DISTRIBUTION ===
+# See the histogram and statistics in update_osm_state.py. Note that the documented quantiles and the
+# documented average don't fit together (e.g. 0.0156% of URLs with 1190 or more occs alone would
+# already contribute 0.19 to the average), so we only match the share of URLs with 2 or more occs, the
+# average, and the maximum: Given at least 2 occs, the number of occs follows a discrete power law
+# P(n >= k) = (k / 2) ** -OCCS_TAIL_EXPONENT, cut off at OCCS_MAX. The exponent is chosen such that the
+# average number of occs per simplified URL is 1.244.
+OCCS_SHARE_MULTIPLE = 0.073
+OCCS_TAIL_EXPONENT = 1.72
+OCCS_MAX = 10456
+# The real data has roughly 2 URLs per domain, and a few domains with very many URLs.
+# Each URL belongs to a new domain with this probability, and otherwise to the domain of a random earlier URL,
+# which automatically results in a heavy tail:
+SHARE_NEW_DOMAIN = 0.5
+# 37k out of 572k URLs belong to ignored hostnames, see IGNORED_HOSTNAMES:
+SHARE_IGNORED = 0.065
+# Tag values that cleanup.py turns into disasters, see below:
+SHARE_DISASTER = 0.005
+# Tag values that contain two URLs, like "https://foo.de/;https://bar.de/":
+SHARE_MULTI_VALUE = 0.005
+# Most tag values are written exactly like their simplified URL. The rest differ in a trailing "/", "#",
+# or "?" (see orig_url_variant). This share is a rough guess, but it matters for the speed of
+# repair_easy_stuff in extract/cleanup.py, see benchmark_cleanup:
+SHARE_ORIG_URL_VARIANT = 0.05
+
+# Weighted choices, roughly as seen in the German extract:
+TLDS = [
+    ("de", 70), ("com", 10), ("org", 5), ("eu", 3), ("net", 3), ("info", 2), ("at", 2), ("ch", 2), ("co.uk", 1),
+    ("berlin", 1), ("nrw", 1),
+]
+HOSTNAME_PREFIXES = [("www.", 60), ("", 35), ("shop.", 2), ("de.", 2), ("m.", 1)]
+SCHEMES = [("https://", 80), ("http://", 20)]
+ITEM_TYPES = [("n", 60), ("w", 35), ("r", 5)]
+ITEM_ID_MAX = {"n": 11_000_000_000, "w": 1_200_000_000, "r": 17_000_000}
+TAG_KEYS = [
+    ("website", 70), ("contact:website", 15), ("url", 8), ("operator:website", 3), ("brand:website", 2),
+    ("heritage:website", 1), ("source:website", 1),
+]
+# Germany, roughly:
+BBOX_LONG = (5.9, 15.0)
+BBOX_LAT = (47.3, 55.0)
+SYLLABLES = [
+    "ba", "ber", "burg", "dorf", "ell", "en", "fa", "gen", "hof", "in", "ka", "ke", "la", "lin", "ma", "mer", "mu",
+    "na", "ne", "ra", "ri", "sa", "sch", "stadt", "ta", "ter", "to", "wald", "we", "zu",
+]
+PATH_SEGMENTS = [
+    "de", "en", "index.html", "kontakt", "ueber-uns", "produkte", "speisekarte", "standorte", "filiale", "impressum",
+    "aktuelles", "page", "shop", "info",
+]
+DISASTER_KINDS = ["space", "nbsp", "scheme", "port", "login", "ip", "no_suffix"]
+
+
+def weighted_choice(rng, choices):
+    values, weights = zip(*choices)
+    return rng.choices(values, weights)[0]
+
+
+class UrlfileGenerator:
+    """
+    Generates a statistically realistic raw extraction result, i.e. the input of "extract/cleanup.py",
+    with roughly the given number of simplified URLs. The same seed always results in the same data.
+    """
+
+    def __init__(self, num_urls, seed=1):
+        self.num_urls = num_urls
+        self.rng = random.Random(seed)
+        self.domains = []
+        self.seen_urls = set()
+        self.ignored_hostnames = sorted(extract_cleanup.IGNORED_HOSTNAMES)
+
+    def num_occs(self):
+        if self.rng.random() >= OCCS_SHARE_MULTIPLE:
+            return 1
+        while True:
+            num_occs = int(2 * (1 - self.rng.random()) ** (-1 / OCCS_TAIL_EXPONENT))
+            if num_occs <= OCCS_MAX:
+                return num_occs
+
+    def word(self):
+        return "".join(self.rng.choice(SYLLABLES) for _ in range(self.rng.randint(2, 4)))
+
+    def hostname(self):
+        if self.rng.random() < SHARE_IGNORED:
+            return self.rng.choice(self.ignored_hostnames)
+        if self.domains and self.rng.random() >= SHARE_NEW_DOMAIN:
+            domain = self.rng.choice(self.domains)
+        else:
+            domain = f"{self.word()}.{weighted_choice(self.rng, TLDS)}"
+        # Note that this also appends the domains of earlier URLs again, just like preferential attachment:
+        self.domains.append(domain)
+        return weighted_choice(self.rng, HOSTNAME_PREFIXES) + domain
+
+    def path(self):
+        if self.rng.random() < 0.5:
+            return "/"
+        segments = [self.rng.choice(PATH_SEGMENTS) for _ in range(self.rng.randint(1, 3))]
+        if self.rng.random() < 0.3:
+            segments.append(str(self.rng.randrange(100_000)))
+        path = "/" + "/".join(segments)
+        if self.rng.random() < 0.1:
+            path += f"?id={self.rng.randrange(10_000)}"
+        return path
+
+    def simplified_url(self):
+        while True:
+            url = weighted_choice(self.rng, SCHEMES) + self.hostname() + self.path()
+            if url not in self.seen_urls:
+                self.seen_urls.add(url)
+                return url
+
+    def orig_url_variant(self, url):
+        # Variants that "extract/cleanup.py" simplifies back to the same URL:
+        if self.rng.random() >= SHARE_ORIG_URL_VARIANT:
+            return url
+        variant = self.rng.randrange(1, 4)
+        if variant == 1 and url.count("/") == 3 and url.endswith("/"):
+            return url[:-1]
+        if variant == 2:
+            return url + "#"
+        if variant == 3 and "?" not in url:
+            return url + "?"
+        return url
+
+    def disaster_tag_value(self):
+        kind = self.rng.choice(DISASTER_KINDS)
+        word = self.word()
+        if kind == "space":
+            return f"http:// {word}.de"
+        if kind == "nbsp":
+            return f"https://www.{word}.de/\xa0"
+        if kind == "scheme":
+            return f"ftp://{word}.de/"
+        if kind == "port":
+            return f"https://{word}.de:8080/"
+        if kind == "login":
+            return f"https://user:{word}@{word}.de/"
+        if kind == "ip":
+            return f"http://192.168.{self.rng.randrange(256)}.{self.rng.randrange(256)}/"
+        assert kind == "no_suffix", kind
+        return f"https://{word}.invalid/"
+
+    def occ(self):
+        item_type = weighted_choice(self.rng, ITEM_TYPES)
+        return {
+            "t": item_type,
+            "id": self.rng.randrange(1, ITEM_ID_MAX[item_type]),
+            "k": weighted_choice(self.rng, TAG_KEYS),
+            "x": round(self.rng.uniform(*BBOX_LONG), 6),
+            "y": round(self.rng.uniform(*BBOX_LAT), 6),
+        }
+
+    def findings(self):
+        # One finding per distinct tag value, just like "extract" writes them.
+        findings = dict()
+        for _ in range(self.num_urls):
+            if self.rng.random() < SHARE_DISASTER:
+                findings.setdefault(self.disaster_tag_value(), []).append(self.occ())
+                continue
+            url = self.simplified_url()
+            if self.rng.random() < SHARE_MULTI_VALUE:
+                # The occurrences then count for both URLs:
+                findings.setdefault(f"{url};{self.simplified_url()}", []).append(self.occ())
+                continue
+            for _ in range(self.num_occs()):
+                findings.setdefault(self.orig_url_variant(url), []).append(self.occ())
+        return [dict(url=url, occ=occs) for url, occs in findings.items()]
+
+    def raw_data(self):
+        return {
+            "v": 2,
+            "type": "monitor-osm-domains extraction results",
+            "findings": self.findings(),
+        }
+
+
+def generate_urlfile(output_filename, num_urls, *, seed=1, format_version=3, output_format="json", raw=False):
+    data = UrlfileGenerator(num_urls, seed).raw_data()
+    if not raw:
+        psl = None
+        if format_version >= 3:
+            psl = logic.get_cached_psl()
+        extract_cleanup.cleanup(data, psl)
+    print(f"Writing to {output_filename} …")
+    if output_format == "binary":
+        assert not raw, "The binary format is only for cleaned-up data"
+        with open(output_filename, "wb") as fp:
+            extract_cleanup_binary.write_binary(data, fp)
+    else:
+        with open(output_filename, "w") as fp:
+            json.dump(data, fp, cls=extract_cleanup.DisasterEncoder)
+    return data
+
+
+class Command(BaseCommand):
+    help = "Writes a synthetic, but statistically realistic monosmdom.json file, e.g. for benchmarking update_osm_state"
+
+    def add_arguments(self, parser):
+        parser.add_argument("output_filename", metavar="/path/to/output/synthetic.monosmdom.json")
+        parser.add_argument(
+            "--urls",
+            help="Approximate number of simplified URLs (default: 10000)",
+            type=int,
+            default=10000,
+        )
+        parser.add_argument("--seed", help="Seed for the random number generator (default: 1)", type=int, default=1)
+        parser.add_argument(
+            "--format-version",
+            help="Version of the written file (default: 3)",
+            type=int,
+            choices=extract_cleanup.URLFILE_VERSIONS,
+            default=3,
+        )
+        parser.add_argument(
+            "--output-format",
+            help="json (default) or binary",
+            choices=extract_cleanup.OUTPUT_FORMATS,
+            default="json",
+        )
+        parser.add_argument(
+            "--raw",
+            help="Write the raw output of 'extract' instead, i.e. the input of 'extract/cleanup.py'",
+            action="store_true",
+        )
+
+    def handle(self, *, output_filename, urls, seed, format_version, output_format, raw, **options):
+        assert urls >= 0, urls
+        if os.path.exists(output_filename):
+            print(f"Refusing to overwrite {output_filename}")
+            return
+        data = generate_urlfile(
+            output_filename, urls, seed=seed, format_version=format_version, output_format=output_format, raw=raw
+        )
+        if not raw:
+            num_occs = sum(
+                len(entry["occs"] if format_version >= 3 else entry) for entry in data["simplified_urls"].values()
+            )
+            print(
+                f"Wrote {len(data['simplified_urls'])} simplified URLs with {num_occs} occurrences, "
+                f"and {len(data['disasters'])} disasters."
+            )
+        print("All done!")
@@ -1,9 +1,13 @@
 from django.core.management.base import BaseCommand
 from django.db import connection, transaction
+from django.db.models import Exists, Max, OuterRef, Subquery
 from monosmdom_server import common
-from storage import logic, models
+from storage import extract_cleanup, extract_cleanup_binary, importing, logic, models
 import crawl.models
+import contextlib
 import json
+import multiprocessing
+import os
 import random
 import datetime
 
@@ -29,10 +33,115 @@ MEGA_INSERT_TIME = datetime.timedelta(seconds=75, milliseconds=600)
 AVERAGE_OCCURRENCE_PER_URL = 1.25
 
 
+URLFILE_SECTIONS = {"disasters", "simplified_urls"}
+# How many simplified URLs are sent to the worker processes at once. Large enough to amortize the
+# pickling overhead, small enough that the classification of the next batch can overlap with the
+# DB work of the current batch.
+CLASSIFY_BATCH_SIZE = 2000
+# How many entries (disasters and simplified URLs) a resumable import commits at once. A crash loses
+# at most this much work, and each commit costs a few extra round trips.
+CHECKPOINT_ENTRIES = 50000
+
 assert 100 % REPORT_PERCENT_STEP == 0
 
 
-def read_urlfile(urlfile):
+class UrlfileStream:
+    """
+    Reads a *.monosmdom.json file incrementally, so that it never has to fit into memory.
+    Call disasters(), then simplified_urls(), then finish(); each section can only be read once,
+    and only in the order in which they appear in the file.
+    """
+
+    def __init__(self, fp):
+        self._reader = extract_cleanup.JsonStreamReader(fp)
+        self._keys = self._reader.iter_object_keys()
+        self.total_bytes = os.fstat(fp.fileno()).st_size
+        self.header = dict()
+        self.num_disasters = 0
+        self.num_simplified_urls = 0
+        self._enter_section("disasters")
+        self.version = self.header["v"]
+        assert self.version in extract_cleanup.URLFILE_VERSIONS, self.version
+        assert self.header["type"] == extract_cleanup.URLFILE_TYPE
+
+    def _enter_section(self, section_name):
+        for key in self._keys:
+            if key in URLFILE_SECTIONS:
+                assert key == section_name, f"Expected section {section_name}, but found {key} first"
+                return
+            self.header[key] = self._reader.read_value()
+        raise AssertionError(f"Missing section {section_name}")
+
+    def disasters(self):
+        # The section has already been entered by __init__, so that the header is already validated.
+        for url_string, disaster_context in self._reader.iter_object_items():
+            self.num_disasters += 1
+            yield url_string, disaster_context
+
+    def simplified_urls(self):
+        self._enter_section("simplified_urls")
+        for url_string, occs in self._reader.iter_object_items():
+            self.num_simplified_urls += 1
+            yield url_string, occs
+
+    def finish(self):
+        for key in self._keys:
+            assert key not in URLFILE_SECTIONS, f"Unexpected section {key}"
+            self.header[key] = self._reader.read_value()
+        self._reader.expect_eof()
+        assert set(self.header.keys()) == {"v", "type"}, self.header.keys()
+
+    def fraction_done(self):
+        if self.total_bytes == 0:
+            return 1.0
+        return min(1.0, self._reader.bytes_read / self.total_bytes)
+
+
+class BinaryUrlfileStream:
+    """
+    Same interface as UrlfileStream, but for *.monosmdom.bin files (see extract_cleanup_binary.BinaryUrlfileWriter).
+    """
+
+    def __init__(self, fp):
+        self._reader = extract_cleanup_binary.BinaryUrlfileReader(fp)
+        self._records = self._reader.iter_records()
+        self._lookahead = next(self._records, None)
+        self.total_bytes = os.fstat(fp.fileno()).st_size
+        self.header = self._reader.header
+        self.version = self.header["v"]
+        self.num_disasters = 0
+        self.num_simplified_urls = 0
+        assert self.version in extract_cleanup.URLFILE_VERSIONS, self.version
+        assert self.header["type"] == extract_cleanup.URLFILE_TYPE
+
+    def _iter_section(self, record_kind):
+        while self._lookahead is not None and self._lookahead[0] == record_kind:
+            _record_kind, url_string, value = self._lookahead
+            self._lookahead = next(self._records, None)
+            yield url_string, value
+
+    def disasters(self):
+        for url_string, disaster_context in self._iter_section("disaster"):
+            self.num_disasters += 1
+            yield url_string, disaster_context
+
+    def simplified_urls(self):
+        for url_string, occs in self._iter_section("simplified_url"):
+            self.num_simplified_urls += 1
+            yield url_string, occs
+
+    def finish(self):
+        assert self._lookahead is None, f"Unexpected {self._lookahead[0]} record after all simplified URLs"
+        self._reader.expect_eof()
+        assert set(self.header.keys()) == {"v", "type"}, self.header.keys()
+
+    def fraction_done(self):
+        if self.total_bytes == 0:
+            return 1.0
+        return min(1.0, self._reader.bytes_read / self.total_bytes)
+
+
+def read_urlfile(fp):
     # File format example, shown with `gron all.monosmdom.json | less`:
     # json = {};
     # json.disasters = {};
@@ -56,33 +165,213 @@ def read_urlfile(urlfile):
     # json.simplified_urls["http://0039italy-shop.com/"][0].t = "w";
     # json.simplified_urls["http://01ulf6.wix.com/soetbeer"] = [];
     # … more simplified_urls, then EOF.
-    with open(urlfile, "r") as fp:
-        data = json.load(fp)
-    assert data["v"] == 2
-    assert data["type"] == "monitor-osm-domains extraction results, filtered"
-    assert set(data.keys()) == set("v type disasters simplified_urls".split())
-    return data['disasters'], data['simplified_urls']
+    # In v3, each simplified URL additionally carries its registrable domain and the interest flag,
+    # and URLs without a public suffix are already moved to the disasters:
+    # json.simplified_urls["http://0039italy-shop.com/"] = {};
+    # json.simplified_urls["http://0039italy-shop.com/"].d = "0039italy-shop.com";
+    # json.simplified_urls["http://0039italy-shop.com/"].i = true;
+    # json.simplified_urls["http://0039italy-shop.com/"].occs = [];
+    # json.simplified_urls["http://0039italy-shop.com/"].occs[0] = {};
+    # json.simplified_urls["http://0039italy-shop.com/"].occs[0].id = 900538158;
+    # … and so on.
+    # A Germany-sized file does not comfortably fit into memory as Python objects, so instead of
+    # json.load(), the sections are streamed entry by entry. Note that json.dump() in cleanup.py
+    # writes the keys in exactly this order: v, type, disasters, simplified_urls.
+    # Alternatively, the file can be in the much more compact binary format (cleanup.py --output-format binary):
+    is_binary = fp.read(len(extract_cleanup_binary.BINARY_MAGIC)) == extract_cleanup_binary.BINARY_MAGIC
+    fp.seek(0)
+    if is_binary:
+        return BinaryUrlfileStream(fp)
+    return UrlfileStream(fp)
+
+
+@contextlib.contextmanager
+def classification_pool(jobs):
+    if jobs <= 1:
+        yield None
+        return
+    # Use "fork", so that the workers inherit the already-parsed PSL, and never need to set up Django
+    # or touch the DB connection: The workers only ever run logic.classify_url_tuple.
+    with multiprocessing.get_context("fork").Pool(jobs) as pool:
+        yield pool
+
+
+def iter_classified(items, pool, batch_size=CLASSIFY_BATCH_SIZE):
+    """
+    Yields (url_string, classification, occs) for each (url_string, occs) in items, in order.
+    Without a pool, the URLs are simply classified inline. With a pool, the next batch is already
+    being classified by the workers while the caller does the DB work for the current batch.
+    Note that we don't use Pool.imap, since that would eagerly consume the entire input.
+    """
+    if pool is None:
+        for url_string, occs in items:
+            yield url_string, logic.classify_url(url_string), occs
+        return
+    items = iter(items)
+
+    def submit_next_batch():
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) >= batch_size:
+                break
+        if not batch:
+            return None
+        return batch, pool.map_async(logic.classify_url_tuple, [url_string for url_string, _occs in batch])
 
+    pending = submit_next_batch()
+    while pending is not None:
+        batch, async_result = pending
+        pending = submit_next_batch()
+        for (url_string, occs), classification_tuple in zip(batch, async_result.get(), strict=True):
+            yield url_string, logic.UrlClassification(*classification_tuple), occs
 
-def show_summary(when):
+
+def iter_trusted(items):
+    """
+    Yields (url_string, classification, occs) for each entry of the "simplified_urls" of a v3 file.
+    There, extract/cleanup.py already did all checks, so there's nothing left to do but trust it.
+    """
+    for url_string, entry in items:
+        assert set(entry.keys()) == {"d", "i", "occs"}, entry.keys()
+        assert entry["d"] is not None, url_string
+        yield url_string, logic.UrlClassification(url_string, entry["d"], entry["i"], None), entry["occs"]
+
+
+class ImportCheckpoint:
+    """
+    Makes the import resumable (see --resumable): Every CHECKPOINT_ENTRIES entries (disasters and
+    simplified URLs), or earlier if the cache exceeds its memory budget, the cache is flushed into the
+    staging tables, and the number of processed entries is saved in the Import row, in the same
+    transaction. After a crash, the next run skips exactly that many entries of the file, and
+    continues from there.
+    """
+
+    def __init__(self, import_obj, checkpoint_entries=CHECKPOINT_ENTRIES):
+        self.import_obj = import_obj
+        self.checkpoint_entries = checkpoint_entries
+        self.state = json.loads(import_obj.additional_data)["resumable"]
+        self.entries_committed = self.state["entries_done"]
+        self.entries_done = self.entries_committed
+        # Everything that was committed by previous runs:
+        self._entries_to_skip = self.entries_committed
+
+    def skip_done(self, items):
+        # Disasters and simplified URLs are counted together, so this must see both sections in order.
+        for item in items:
+            if self._entries_to_skip > 0:
+                self._entries_to_skip -= 1
+                continue
+            yield item
+
+    def entry_done(self, cache):
+        self.entries_done += 1
+        if self.entries_done - self.entries_committed >= self.checkpoint_entries or cache.over_budget():
+            self.commit(cache)
+
+    def commit(self, cache, *, finished_reading=False):
+        with transaction.atomic():
+            cache.flush()
+            self.state["entries_done"] = self.entries_done
+            self.state["finished_reading"] = finished_reading
+            self.import_obj.additional_data = json.dumps(dict(resumable=self.state))
+            self.import_obj.save(update_fields=["additional_data"])
+        self.entries_committed = self.entries_done
+
+
+def find_or_begin_resumable_import(urlfile, *, abandon_unfinished=False):
+    urlfile_size = os.stat(urlfile).st_size
+    unfinished = models.Import.objects.filter(import_end=None)
+    if abandon_unfinished:
+        print(f"Abandoning {unfinished.count()} unfinished import(s) …")
+        unfinished.delete()
+    import_obj = unfinished.order_by("id").last()
+    if import_obj is not None:
+        state = json.loads(import_obj.additional_data)["resumable"]
+        assert import_obj.urlfile_name == urlfile and state["urlfile_size"] == urlfile_size, (
+            f"Import #{import_obj.id} of {import_obj.urlfile_name} (size {state['urlfile_size']}) is unfinished. "
+            "Resume it with the same file, or start over with --abandon-unfinished."
+        )
+        print(f"Resuming import #{import_obj.id} after {state['entries_done']} entries …")
+        return import_obj
+    with transaction.atomic():
+        importing.wipe_staging_tables()
+        import_obj = models.Import.objects.create(
+            urlfile_name=urlfile,
+            import_begin=common.now_tzaware(),
+            import_end=None,
+            additional_data=json.dumps(dict(resumable=dict(
+                urlfile_size=urlfile_size,
+                entries_done=0,
+                finished_reading=False,
+            ))),
+        )
+    print(f"Beginning resumable import #{import_obj.id} …")
+    return import_obj
+
+
+def show_staging_summary():
+    print()
+    print("  Staged state:")
+    counts, _estimated = importing.count_rows(logic.STAGING_LEAF_MODELS)
+    staged = dict(
+        disaster_entries=counts[models.StagingDisasterUrl],
+        crawlable=counts[models.StagingCrawlableUrl],
+        osm_occurrences=counts[models.StagingOccurrenceInOsm],
+    )
+    print(f"    Disaster URLs (before merging with the existing ones): {staged['disaster_entries']}")
+    print(f"    Crawlable URLs: {staged['crawlable']}")
+    print(f"    URL detections in OSM data: {staged['osm_occurrences']}")
+    print()
+    return staged
+
+
+# All tables in the summary, and those that an import doesn't touch, so their estimate stays valid:
+SUMMARY_MODELS = [
+    crawl.models.ResultSuccess,
+    crawl.models.ResultError,
+    models.Url,
+    models.DisasterUrl,
+    models.CrawlableUrl,
+    models.Domain,
+    models.OccurrenceInOsm,
+]
+SUMMARY_MODELS_UNTOUCHED = [crawl.models.ResultSuccess, crawl.models.ResultError]
+
+
+def summary_estimate(fast_summary, *, tables_analyzed):
+    # Which tables show_summary() may estimate with --fast-summary. Once the import has changed a table, its
+    # estimate is useless until the next ANALYZE. The crawl results are never touched by the import, and
+    # usually are the largest tables anyway.
+    if not fast_summary:
+        return ()
+    return SUMMARY_MODELS if tables_analyzed else SUMMARY_MODELS_UNTOUCHED
+
+
+def show_summary(when, *, estimate=()):
     print()
     print(f"  Stats {when}:")
-    crawl_successes = crawl.models.ResultSuccess.objects.count()
-    crawl_errors = crawl.models.ResultError.objects.count()
+    counts, estimated_models = importing.count_rows(SUMMARY_MODELS, estimate=estimate)
+    estimated = sorted(model._meta.db_table for model in estimated_models)
+    if estimated:
+        print(f"    (Estimated: {', '.join(estimated)})")
+    crawl_successes = counts[crawl.models.ResultSuccess]
+    crawl_errors = counts[crawl.models.ResultError]
     print(f"    Crawl results: {crawl_successes}s + {crawl_errors}e (should stay constant)")
-    urls_total = models.Url.objects.count()
-    disaster_entries_total = models.DisasterUrl.objects.count()
-    disaster_urls_total = models.DisasterUrl.objects.all().distinct().count()
-    crawlable_total = models.CrawlableUrl.objects.count()
+    urls_total = counts[models.Url]
+    # The primary key of DisasterUrl is the Url, so each disaster URL has exactly one entry:
+    disaster_entries_total = counts[models.DisasterUrl]
+    disaster_urls_total = disaster_entries_total
+    crawlable_total = counts[models.CrawlableUrl]
     ignored_obsolete = urls_total - disaster_urls_total - crawlable_total
     print(f"    Total URLs known: {urls_total}")
     print(f"      … disaster URLs: {disaster_urls_total}")
     print(f"        … total entries: {disaster_entries_total}")
     print(f"      … crawlable URLs: {crawlable_total}")
     print(f"      … ignored/obsolete: {ignored_obsolete} (calculated)")
-    domain_count = models.Domain.objects.count()
+    domain_count = counts[models.Domain]
     print(f"    Total Domains known: {domain_count}")
-    osm_occurrence_count = models.OccurrenceInOsm.objects.count()
+    osm_occurrence_count = counts[models.OccurrenceInOsm]
     print(f"    Total URL detections in OSM data: {osm_occurrence_count}")
     print()
     return dict(
@@ -101,6 +390,7 @@ def show_summary(when):
         ),
         domains=domain_count,
         osm_occurrences=osm_occurrence_count,
+        estimated=estimated,
     )
 
 
@@ -125,13 +415,126 @@ def register_occurrence(url_object, occ_dict, cache):
     # These will be completely wiped and re-written on every import anyway.
 
 
-def update_osm_state(disasters, simplified_urls):
+def refresh_last_crawled_at(crawlable_model=models.CrawlableUrl):
+    """
+    Recomputes last_crawled_at of crawlable_model (CrawlableUrl or StagingCrawlableUrl) from the
+    crawl results, but only for rows that were written in bulk and thus still say "never crawled",
+    which bypasses Result.save(). In a normal import or when publishing the staging tables, that's
+    all of them.
+    Returns the number of CrawlableUrls that turned out to have been crawled before.
+    """
+    results = crawl.models.Result.objects.filter(url_id=OuterRef("url_id"))
+    last_crawl = results.order_by("-crawl_begin").values("crawl_begin")[:1]
+    return crawlable_model.objects.filter(Exists(results), last_crawled_at=models.NEVER_CRAWLED).update(
+        last_crawled_at=Subquery(last_crawl)
+    )
+
+
+def catch_up_last_crawled_at(after_result_id):
+    """
+    Recomputes CrawlableUrl.last_crawled_at, but only for the URLs that have crawl results newer
+    than after_result_id. These are the few URLs that the crawler visited since
+    prepare_staged_domain_scheduling(), whose Result.save() updated the old tables instead.
+    Returns the number of CrawlableUrls that were caught up.
+    """
+    new_results = crawl.models.Result.objects.filter(id__gt=after_result_id)
+    results = crawl.models.Result.objects.filter(url_id=OuterRef("url_id"))
+    last_crawl = results.order_by("-crawl_begin").values("crawl_begin")[:1]
+    return models.CrawlableUrl.objects.filter(url_id__in=new_results.values("url_id")).update(
+        last_crawled_at=Subquery(last_crawl)
+    )
+
+
+def refresh_domain_scheduling(profiler):
+    # The leaf tables were written in bulk, so the crawler's Domain.has_crawlable and
+    # CrawlableUrl.last_crawled_at must be recomputed in the same transaction. Otherwise, the crawler
+    # might pick a domain without CrawlableUrls, or re-crawl the same URL of a domain over and over.
+    print("    Updating Domain.has_crawlable and CrawlableUrl.last_crawled_at …")
+    with profiler.phase("scheduling"):
+        gained, lost = logic.refresh_domain_has_crawlable()
+        num_crawled = refresh_last_crawled_at()
+    print(f"    {gained} domains gained their first crawlable URL, {lost} domains lost their last one.")
+    print(f"    {num_crawled} crawlable URLs were already crawled before.")
+
+
+def prepare_staged_domain_scheduling(profiler):
+    # Like refresh_domain_scheduling(), but computes everything against the staging tables, before
+    # swapping them in. The crawler doesn't touch the staging tables, so this can take its time
+    # without locking anything. Returns what finish_staged_domain_scheduling() needs.
+    print("    Computing Domain.has_crawlable and CrawlableUrl.last_crawled_at for the staging tables …")
+    with profiler.phase("scheduling"):
+        # Anything crawled after this must be caught up on during the swap. A result that is being
+        # inserted concurrently might be missed, which only means that its URL is due again early.
+        after_result_id = crawl.models.Result.objects.aggregate(Max("id"))["id__max"] or 0
+        num_crawled = refresh_last_crawled_at(models.StagingCrawlableUrl)
+        gaining, losing = logic.domains_changing_has_crawlable(models.StagingCrawlableUrl)
+        gaining_ids = list(gaining.values_list("id", flat=True))
+        losing_ids = list(losing.values_list("id", flat=True))
+    print(f"    {num_crawled} crawlable URLs were already crawled before.")
+    return after_result_id, gaining_ids, losing_ids
+
+
+def finish_staged_domain_scheduling(prepared, profiler):
+    # Runs in the swap transaction, which locks out the crawler, so this only applies the changes
+    # computed by prepare_staged_domain_scheduling(), and catches up on the crawls since then.
+    # Only imports write CrawlableUrls, so the domains that gain or lose them can't have changed.
+    after_result_id, gaining_ids, losing_ids = prepared
+    with profiler.phase("scheduling"):
+        gained = logic.set_domain_has_crawlable(gaining_ids, True)
+        lost = logic.set_domain_has_crawlable(losing_ids, False)
+        num_caught_up = catch_up_last_crawled_at(after_result_id)
+    print(f"    {gained} domains gained their first crawlable URL, {lost} domains lost their last one.")
+    print(f"    {num_caught_up} crawlable URLs were crawled while preparing the swap.")
+
+
+def update_osm_state(
+    urlfile_stream,
+    *,
+    diff=False,
+    pool=None,
+    checkpoint=None,
+    profiler=None,
+    flush_max_objects=logic.FLUSH_MAX_OBJECTS,
+    flush_max_bytes=logic.FLUSH_MAX_BYTES,
+    use_copy=None,
+    sort_by_domain=False,
+):
     # No need to touch CrawlResult, CrawlResultSuccess, CrawlResultError at all.
     # We completely delete and re-write the tables CrawlableUrl, DisasterUrl, OccurrenceInOsm.
     # The tables Domain and Url are extended, and existing data remains untouched.
-    print("    Wiping old OSM state (tables CrawlableUrl, OccurrenceInOsm) …")
-    models.CrawlableUrl.objects.all().delete()
-    models.OccurrenceInOsm.objects.all().delete()
+    # In diff mode, we instead compare each chunk with the existing rows, and only write the
+    # difference. That's much less work (and bloat) if only a few percent of URLs have changed.
+    # With a checkpoint, we instead write to the staging tables in committed chunks (see ImportCheckpoint),
+    # and the caller publishes them at the end (see importing.publish_staging_tables).
+    assert not (diff and checkpoint is not None), "Diff mode writes directly to the live tables"
+    if profiler is None:
+        profiler = importing.ImportProfiler(enabled=False)
+
+    def maybe_skip(items):
+        if checkpoint is None:
+            return items
+        return checkpoint.skip_done(items)
+
+    def entry_done():
+        # Flushing between two entries keeps the memory bounded, no matter how large the region is.
+        if checkpoint is not None:
+            checkpoint.entry_done(cache)
+        elif cache.over_budget():
+            cache.flush()
+
+    cache_options = dict(
+        max_objects=flush_max_objects, max_bytes=flush_max_bytes, use_copy=use_copy, sort_by_domain=sort_by_domain
+    )
+    if diff:
+        cache = logic.LeafModelDiffCache(profiler=profiler, **cache_options)
+    elif checkpoint is not None:
+        cache = logic.LeafModelBulkCache(logic.STAGING_LEAF_MODELS, profiler=profiler, **cache_options)
+    else:
+        print("    Wiping old OSM state (tables CrawlableUrl, OccurrenceInOsm) …")
+        with profiler.phase("wipe"):
+            models.CrawlableUrl.objects.all().delete()
+            models.OccurrenceInOsm.objects.all().delete()
+        cache = logic.LeafModelBulkCache(profiler=profiler, **cache_options)
     print("    Importing disaster URLs …")
     # How to import the data performantly?
     # - Ideally, we would use some kind of "automatic bulk upsert" scheme, that magically deals with
@@ -141,54 +544,110 @@ def update_osm_state(disasters, simplified_urls):
     #   with update_conflicts=True does NOT return primary keys:
     #     https://code.djangoproject.com/ticket/7596#comment:16
     #   Ironically, all that would be required is adding "RETURNING serial_pk" to the SQL query.
-    # - So instead, we insert the Urls and Domains row-by-row, and only use fast bulk inserts for
-    #   DisasterUrl, CrawlableUrl, and OccurrenceInOsm.
+    # - So previously, we inserted the Urls and Domains row-by-row, and only used fast bulk inserts
+    #   for DisasterUrl, CrawlableUrl, and OccurrenceInOsm.
     # - The original "insert everything row by row" method is much slower.
     # I timed it using a random subset of the real data, specifically 2%. The last method took 22.76
     # seconds, and the second-last method only 10.6 seconds. I believe this can be reduced more.
-    cache = logic.LeafModelBulkCache()
-    for url_string, disaster_context in disasters.items():
-        assert set(disaster_context.keys()) == {"occs", "reasons"}
-        url_object = logic.upsert_url(url_string)
-        for disaster_reason in disaster_context["reasons"]:
-            logic.LeafModelBulkCache.upsert_durl(cache, url=url_object, reason=disaster_reason)
-        for occ_dict in disaster_context["occs"]:
-            register_occurrence(url_object, occ_dict, cache)
+    # - Now, the cache hands out unsaved Url and Domain instances, and on flush looks up (or inserts)
+    #   the IDs of an entire chunk at once (see logic.bulk_upsert_unique), before bulk-inserting the
+    #   leaf models. That's a handful of queries per chunk instead of two round trips per URL.
+    #   The same goes for the disaster URLs.
+    with profiler.phase("disasters"):
+        for url_string, disaster_context in profiler.iter_phase("read", maybe_skip(urlfile_stream.disasters())):
+            assert set(disaster_context.keys()) == {"occs", "reasons"}
+            url_object = cache.url_instance(url_string)
+            for disaster_reason in disaster_context["reasons"]:
+                logic.LeafModelBulkCache.upsert_durl(cache, url=url_object, reason=disaster_reason)
+            for occ_dict in disaster_context["occs"]:
+                register_occurrence(url_object, occ_dict, cache)
+            entry_done()
+    print(f"    Imported {urlfile_stream.num_disasters} disaster URLs.")
     print("    Importing and checking simplified URLs …")
     done_items = 0
     percent_last_reported = 0
+    percent_at_step_begin = 0
     percent_step_began = common.now_tzaware()
     time_before = percent_step_began
-    time_in_crurl = datetime.timedelta(0)
-    time_in_register_occ = datetime.timedelta(0)
-    for i, (url_string, occs) in enumerate(simplified_urls.items()):
+    simplified_urls = maybe_skip(profiler.iter_phase("read", urlfile_stream.simplified_urls()))
+    if urlfile_stream.version >= 3:
+        classified_urls = iter_trusted(simplified_urls)
+    else:
         # Note: This duplicates the "Syntactical" check that was already done during "extract/cleanup.py".
         # However, this means very little additional work, and deduplicating the code seems more important on this occasion.
-        # TODO: The semantical checks still are a lot of work. Can this be precomputed and bulk-inserted instead?
-        t1 = common.now_tzaware()
-        maybe_crawlable = logic.discover_url(url_string, mark_crawlable=True, cache=cache)
-        t2 = common.now_tzaware()
-        for occ_dict in occs:
-            register_occurrence(maybe_crawlable.url_obj, occ_dict, cache)
-        t3 = common.now_tzaware()
-        time_in_crurl += t2 - t1
-        time_in_register_occ += t3 - t2
+        # The semantical checks are a lot of work though, which is why they can run in parallel (see --jobs),
+        # or even better, are already done by "extract/cleanup.py" (see v3).
+        classified_urls = iter_classified(simplified_urls, pool)
+    # With --jobs, this is only the time spent waiting for the workers.
+    for url_string, classification, occs in profiler.iter_phase("classification", classified_urls):
+        assert classification.url == url_string, (classification.url, url_string)
+        with profiler.phase("register"):
+            maybe_crawlable = logic.discover_classified_url(classification, mark_crawlable=True, cache=cache)
+            for occ_dict in occs:
+                register_occurrence(maybe_crawlable.url_obj, occ_dict, cache)
+        entry_done()
         done_items += 1
-        percent_done = done_items * 100 / len(simplified_urls)
+        # The total number of URLs is unknown until the end of the file, so estimate progress by
+        # how much of the file has been read so far:
+        percent_done = urlfile_stream.fraction_done() * 100
         if percent_done >= percent_last_reported + REPORT_PERCENT_STEP:
-            cache.flush()  # Make sure we don't hog too much memory
-            percent_last_reported += REPORT_PERCENT_STEP
+            # Reading ahead can skip several steps at once, especially on small files:
+            percent_last_reported = int(percent_done // REPORT_PERCENT_STEP) * REPORT_PERCENT_STEP
             percent_step_ended = common.now_tzaware()
             time_now = percent_step_ended.strftime("%F %T")
             # Let's try to guess how many future inserts there will be:
             # 1 row in CrawlableUrl, and one-point-something rows in OccurrenceInOsm.
-            remaining_time = (percent_step_ended - percent_step_began) * (100 - percent_done) / REPORT_PERCENT_STEP
+            remaining_time = (
+                (percent_step_ended - percent_step_began)
+                * (100 - percent_done)
+                / (percent_done - percent_at_step_begin)
+            )
             eta = (percent_step_ended + remaining_time).strftime("%F %T")
-            print(f"      {percent_last_reported:3}% done ({done_items:6}/{len(simplified_urls):6} at time {time_now}, ETA {eta})")
+            print(f"      {percent_last_reported:3}% done ({done_items:6} URLs at time {time_now}, ETA {eta})")
             percent_step_began = percent_step_ended
+            percent_at_step_begin = percent_done
+    with profiler.phase("read"):
+        urlfile_stream.finish()
+    if checkpoint is not None:
+        checkpoint.commit(cache, finished_reading=True)
+    else:
+        cache.flush()
+    if diff:
+        print("    Deleting rows of URLs that are no longer in the OSM data …")
+        with profiler.phase("delete_unseen"):
+            cache.delete_unseen()
+        for table, stats in cache.stats.items():
+            print(f"    Diff of {table}: {stats}")
+    if checkpoint is None:
+        # With a checkpoint, this happens when publishing the staging tables instead.
+        refresh_domain_scheduling(profiler)
+    flush_stats = cache.flush_stats
+    if flush_stats["flushes"] > 0:
+        average_ms = flush_stats["total_seconds"] / flush_stats["flushes"] * 1000
+        print(
+            f"    Flushed {flush_stats['objects']} objects in {flush_stats['flushes']} flushes, "
+            f"{average_ms:.1f} ms on average, at most {flush_stats['max_seconds'] * 1000:.1f} ms"
+        )
+    if sort_by_domain:
+        # v3 files are already sorted by domain (see extract/cleanup.py), so this mostly helps with v2 files.
+        switches = cache.domain_switches
+        print(
+            f"    Sorting by domain: Consecutive crawlable URLs switched domains {switches['sorted']} times, "
+            f"instead of {switches['unsorted']} times in file order"
+        )
+    hostname_cache_info = logic.hostname_cache_info()
+    if hostname_cache_info.hits + hostname_cache_info.misses > 0:
+        # Only the main process's cache, so nothing to see here with --jobs.
+        print(
+            f"    Hostname cache: {hostname_cache_info.hits} hits, {hostname_cache_info.misses} misses, "
+            f"{hostname_cache_info.currsize} entries"
+        )
     time_after = common.now_tzaware()
-    time_now = t2.strftime("%F %T")
+    time_now = time_after.strftime("%F %T")
     print(f"Import finished at {time_now}, total time taken: {time_after - time_before}")
+    if diff:
+        return cache.stats
+    return None
 
 
 def get_confirmation():
@@ -205,50 +664,272 @@ def get_confirmation():
         return False, "<Ctrl-C>"
 
 
+def confirm_or_roll_back(force, profiler):
+    # Must be called at the end of the import's transaction.
+    if force is not None:
+        return True
+    with profiler.phase("confirmation"):
+        should_commit, reason = get_confirmation()
+    if should_commit:
+        print(f"{ANSI_GREEN}Committing!{ANSI_RESET} Making state permanent. This might take a while …")
+        # Making state permanent by returning from "atomic".
+    else:
+        print(f"{ANSI_RED}Rolling back!{ANSI_RESET} No changes will be applied ({reason})")
+        transaction.set_rollback(True)
+    return should_commit
+
+
+def analyze_after_import(*, diff, profiler):
+    with profiler.phase("vacuum"), connection.cursor() as cursor:
+        if diff:
+            # Only a few rows have changed, so autovacuum can deal with the dead tuples. But the
+            # planner should know about the changes as soon as possible:
+            print("Running 'ANALYZE' …")
+            cursor.execute("ANALYZE")
+        else:
+            print("Running 'VACUUM ANALYZE' …")
+            if connection.vendor == "postgresql":
+                cursor.execute("VACUUM ANALYZE")
+            else:
+                # For example SQLite, which doesn't know the combined command:
+                cursor.execute("VACUUM")
+                cursor.execute("ANALYZE")
+
+
+def save_profile(import_obj, profiler):
+    # Called at the very end, so that the report also covers the VACUUM.
+    if not profiler.enabled:
+        return
+    profiler.print_report()
+    additional_data = json.loads(import_obj.additional_data)
+    additional_data["profile"] = profiler.report()
+    import_obj.additional_data = json.dumps(additional_data)
+    import_obj.save(update_fields=["additional_data"])
+
+
 class Command(BaseCommand):
     help = "Overwrites the set of URLs-to-be-crawled"
 
     def add_arguments(self, parser):
-        parser.add_argument("urlfile", metavar="file_with_all_osm_urls.monosmdom.json")
+        parser.add_argument("urlfile", metavar="file_with_all_osm_urls.monosmdom.json_or_bin")
         parser.add_argument("--force", metavar="Set to OVERWRITE to skip the question")
+        parser.add_argument(
+            "--diff",
+            help="Only write the difference to the current state, instead of wiping and re-writing everything",
+            action="store_true",
+        )
+        parser.add_argument(
+            "--jobs",
+            help="Number of worker processes for classifying URLs (default: 1, i.e. no worker processes)",
+            type=int,
+            default=1,
+        )
+        parser.add_argument(
+            "--resumable",
+            help="Write into staging tables in committed chunks, resume an unfinished import of the same file, "
+            "and publish everything at the end",
+            action="store_true",
+        )
+        parser.add_argument(
+            "--publish-by",
+            help="With --resumable: Either swap the staging tables with the live tables, which only locks out the "
+            "crawler briefly (default), or copy them over in one long transaction",
+            choices=["swap", "copy"],
+            default="swap",
+        )
+        parser.add_argument(
+            "--abandon-unfinished",
+            help="With --resumable: Discard any unfinished import, and start over",
+            action="store_true",
+        )
+        parser.add_argument(
+            "--profile",
+            help="Measure wall time, DB time, number of queries, and peak memory of each phase, "
+            "and store the report in the Import row (slows down the import)",
+            action="store_true",
+        )
+        parser.add_argument(
+            "--flush-objects",
+            help=f"Write the cached rows to the DB once this many are pending (default: {logic.FLUSH_MAX_OBJECTS})",
+            type=int,
+            default=logic.FLUSH_MAX_OBJECTS,
+        )
+        parser.add_argument(
+            "--flush-megabytes",
+            help="Write the cached rows to the DB once they take roughly this much memory "
+            f"(default: {logic.FLUSH_MAX_BYTES >> 20})",
+            type=int,
+            default=logic.FLUSH_MAX_BYTES >> 20,
+        )
+        parser.add_argument(
+            "--fast-summary",
+            help="On PostgreSQL, use the planner's row estimates for the tables that haven't changed since the last "
+            "ANALYZE, instead of counting all rows",
+            action="store_true",
+        )
+        parser.add_argument(
+            "--sort-by-domain",
+            help="Sort the rows of each flush by registrable domain and URL before writing them, "
+            "for better locality in the tables and indexes",
+            action="store_true",
+        )
+        parser.add_argument(
+            "--no-copy",
+            help="On PostgreSQL, write the rows with bulk_create instead of COPY, e.g. to compare the speed",
+            action="store_true",
+        )
 
-    def handle(self, *, urlfile, force, **options):
+    def handle(
+        self,
+        *,
+        urlfile,
+        force,
+        diff,
+        jobs,
+        resumable,
+        abandon_unfinished,
+        publish_by,
+        profile,
+        flush_objects,
+        flush_megabytes,
+        no_copy,
+        fast_summary,
+        sort_by_domain,
+        **options,
+    ):
         assert force is None or force == "OVERWRITE"
-        print("Initializing PSL …")
-        logic.get_cached_psl()
-
-        print(f"Reading {urlfile=} …")
-        disasters, simplified_urls = read_urlfile(urlfile)
+        assert jobs >= 1, jobs
+        assert not (diff and resumable), "--diff and --resumable are mutually exclusive"
+        assert resumable or not abandon_unfinished, "--abandon-unfinished only makes sense with --resumable"
+        assert flush_objects >= 1 and flush_megabytes >= 1, (flush_objects, flush_megabytes)
+        import_options = dict(
+            flush_max_objects=flush_objects, flush_max_bytes=flush_megabytes << 20, sort_by_domain=sort_by_domain
+        )
+        if no_copy:
+            import_options["use_copy"] = False
+        profiler = importing.ImportProfiler(enabled=profile)
+        with profiler.running(), logic.large_hostname_cache():
+            print("Initializing PSL …")
+            with profiler.phase("psl"):
+                logic.get_cached_psl()
+            if resumable:
+                with classification_pool(jobs) as pool:
+                    self.handle_resumable(
+                        urlfile, force, pool, abandon_unfinished, publish_by, fast_summary, profiler, import_options
+                    )
+            else:
+                self.handle_normal(urlfile, force, diff, jobs, fast_summary, profiler, import_options)
 
-        with transaction.atomic():
+    def handle_normal(self, urlfile, force, diff, jobs, fast_summary, profiler, import_options):
+        print(f"Opening {urlfile=} …")
+        # Start the workers before opening the transaction, so that they don't inherit an active DB connection.
+        with classification_pool(jobs) as pool, open(urlfile, "rb") as fp, transaction.atomic():
+            urlfile_stream = read_urlfile(fp)
             import_begin = common.now_tzaware()
-            summary_before = show_summary("before")
-            print(f"Importing at least {len(disasters)} disasters and at most {len(simplified_urls)} crawlable URLs …")
-            print("    (Numbers might change slightly due to ignored or unregistered domains.)")
-            update_osm_state(disasters, simplified_urls)
-            summary_after = show_summary("after")
+            with profiler.phase("summaries"):
+                summary_before = show_summary("before", estimate=summary_estimate(fast_summary, tables_analyzed=True))
+            print(f"Importing {urlfile_stream.total_bytes} bytes of disasters and crawlable URLs …")
+            diff_stats = update_osm_state(urlfile_stream, diff=diff, pool=pool, profiler=profiler, **import_options)
+            print(
+                f"Imported {urlfile_stream.num_disasters} disasters "
+                f"and at most {urlfile_stream.num_simplified_urls} crawlable URLs."
+            )
+            print("    (Numbers might be slightly lower due to ignored or unregistered domains.)")
+            with profiler.phase("summaries"):
+                summary_after = show_summary("after", estimate=summary_estimate(fast_summary, tables_analyzed=False))
             additional_data = dict(
                 summary_before=summary_before,
                 summary_after=summary_after,
             )
-            models.Import.objects.create(
+            if diff_stats is not None:
+                additional_data["diff"] = diff_stats
+            import_obj = models.Import.objects.create(
                 urlfile_name=urlfile,
                 import_begin=import_begin,
                 import_end=common.now_tzaware(),
                 additional_data=json.dumps(additional_data),
             )
-            if force is None:
-                should_commit, reason = get_confirmation()
-                if should_commit:
-                    print(f"{ANSI_GREEN}Committing!{ANSI_RESET} Making state permanent. This might take a while …")
-                    # Making state permanent by returning from "atomic".
-                else:
-                    print(f"{ANSI_RED}Rolling back!{ANSI_RESET} No changes will be applied ({reason})")
-                    transaction.set_rollback(True)
-            else:
-                should_commit = True
+            should_commit = confirm_or_roll_back(force, profiler)
         if should_commit:
-            print("Running 'VACUUM ANALYZE' …")
-            with connection.cursor() as cursor:
-                cursor.execute("VACUUM ANALYZE")
+            analyze_after_import(diff=diff, profiler=profiler)
+            save_profile(import_obj, profiler)
+        print("All done!")
+
+    def handle_resumable(
+        self, urlfile, force, pool, abandon_unfinished, publish_by, fast_summary, profiler, import_options
+    ):
+        # Each chunk is committed on its own, so a crash only loses the current chunk, and the
+        # transactions stay short. Only publishing the staging tables happens in one big transaction.
+        import_obj = find_or_begin_resumable_import(urlfile, abandon_unfinished=abandon_unfinished)
+        checkpoint = ImportCheckpoint(import_obj)
+        if not checkpoint.state["finished_reading"]:
+            print(f"Opening {urlfile=} …")
+            with open(urlfile, "rb") as fp:
+                urlfile_stream = read_urlfile(fp)
+                print(
+                    f"Importing {urlfile_stream.total_bytes} bytes of disasters and crawlable URLs "
+                    "into staging tables …"
+                )
+                update_osm_state(urlfile_stream, pool=pool, checkpoint=checkpoint, profiler=profiler, **import_options)
+            print(f"Staged {checkpoint.entries_done} disasters and simplified URLs (including previous runs).")
+        else:
+            print("Staging tables are already complete.")
+        if publish_by == "swap":
+            self.publish_by_swap(import_obj, checkpoint, force, fast_summary, profiler)
+            return
+        with transaction.atomic():
+            with profiler.phase("summaries"):
+                summary_before = show_summary("before", estimate=summary_estimate(fast_summary, tables_analyzed=True))
+            with profiler.phase("publish"):
+                importing.publish_staging_tables()
+            refresh_domain_scheduling(profiler)
+            with profiler.phase("summaries"):
+                summary_after = show_summary("after", estimate=summary_estimate(fast_summary, tables_analyzed=False))
+            import_obj.import_end = common.now_tzaware()
+            import_obj.additional_data = json.dumps(dict(
+                summary_before=summary_before,
+                summary_after=summary_after,
+                resumable=checkpoint.state,
+            ))
+            import_obj.save()
+            # If this gets rolled back, the staging tables are still complete, and the next run
+            # with --resumable can directly try to publish again.
+            should_commit = confirm_or_roll_back(force, profiler)
+        if should_commit:
+            analyze_after_import(diff=False, profiler=profiler)
+            save_profile(import_obj, profiler)
+        print("All done!")
+
+    def publish_by_swap(self, import_obj, checkpoint, force, fast_summary, profiler):
+        # Ask first, so that the swap transaction (which locks out the crawler) stays really short.
+        with profiler.phase("summaries"):
+            summary_before = show_summary("before", estimate=summary_estimate(fast_summary, tables_analyzed=True))
+            staged = show_staging_summary()
+        if force is None:
+            with profiler.phase("confirmation"):
+                should_commit, reason = get_confirmation()
+            if not should_commit:
+                print(f"{ANSI_RED}Not swapping!{ANSI_RESET} The staging tables stay ready for the next run ({reason})")
+                return
+        print(f"{ANSI_GREEN}Swapping!{ANSI_RESET}")
+        prepared = prepare_staged_domain_scheduling(profiler)
+        with profiler.phase("publish"), transaction.atomic():
+            importing.swap_staging_tables()
+            finish_staged_domain_scheduling(prepared, profiler)
+            import_obj.import_end = common.now_tzaware()
+            import_obj.save(update_fields=["import_end"])
+        # The staging tables now contain the previous state, which is no longer needed:
+        with profiler.phase("wipe"):
+            importing.wipe_staging_tables()
+        with profiler.phase("summaries"):
+            summary_after = show_summary("after", estimate=summary_estimate(fast_summary, tables_analyzed=False))
+        import_obj.additional_data = json.dumps(dict(
+            summary_before=summary_before,
+            staged=staged,
+            summary_after=summary_after,
+            resumable=checkpoint.state,
+        ))
+        import_obj.save(update_fields=["additional_data"])
+        analyze_after_import(diff=False, profiler=profiler)
+        save_profile(import_obj, profiler)
         print("All done!")
@@ -0,0 +1,71 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("storage", "0011_store_long_lat"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="StagingDisasterUrl",
+            fields=[
+                (
+                    "url",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.RESTRICT,
+                        primary_key=True,
+                        related_name="+",
+                        serialize=False,
+                        to="storage.url",
+                    ),
+                ),
+                ("reason", models.CharField()),
+            ],
+        ),
+        migrations.AlterField(
+            model_name="import",
+            name="import_end",
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.CreateModel(
+            name="StagingCrawlableUrl",
+            fields=[
+                (
+                    "url",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.RESTRICT,
+                        primary_key=True,
+                        related_name="+",
+                        serialize=False,
+                        to="storage.url",
+                    ),
+                ),
+                (
+                    "domain",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.RESTRICT, related_name="+", to="storage.domain"
+                    ),
+                ),
+            ],
+        ),
+        migrations.CreateModel(
+            name="StagingOccurrenceInOsm",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("osm_item_type", models.CharField(max_length=1)),
+                ("osm_item_id", models.BigIntegerField()),
+                ("osm_tag_key", models.CharField(max_length=100)),
+                ("osm_tag_value", models.CharField(max_length=300)),
+                ("osm_long", models.FloatField(default=50)),
+                ("osm_lat", models.FloatField(default=10)),
+                (
+                    "url",
+                    models.ForeignKey(on_delete=django.db.models.deletion.RESTRICT, related_name="+", to="storage.url"),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:24
+
+from django.db import migrations, models
+from django.db.models import Exists, F, OuterRef
+import datetime
+
+# Copied from storage.models, because migrations must not depend on the current code:
+CRAWL_DOMAIN_DELAY_DAYS = 25
+
+
+def forwards_func(apps, schema_editor):
+    CrawlableUrl = apps.get_model("storage", "CrawlableUrl")
+    Domain = apps.get_model("storage", "Domain")
+    Domain.objects.filter(Exists(CrawlableUrl.objects.filter(domain=OuterRef("pk")))).update(has_crawlable=True)
+    Domain.objects.filter(last_contacted__isnull=False).update(
+        next_due=F("last_contacted") + datetime.timedelta(days=CRAWL_DOMAIN_DELAY_DAYS)
+    )
+
+
+def reverse_func(apps, schema_editor):
+    # Nothing to do, the columns are about to be dropped anyway.
+    pass
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("storage", "0012_staging_tables_for_resumable_import"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="domain",
+            name="has_crawlable",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name="domain",
+            name="next_due",
+            field=models.DateTimeField(default=datetime.datetime(1970, 1, 1, 0, 0, tzinfo=datetime.timezone.utc)),
+        ),
+        migrations.RunPython(forwards_func, reverse_func, elidable=True),
+        migrations.AddIndex(
+            model_name="domain",
+            index=models.Index(
+                condition=models.Q(("has_crawlable", True)), fields=["next_due"], name="domain_next_due_crawlable"
+            ),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:41
+
+from django.db import migrations, models
+from django.db.models import Exists, OuterRef, Subquery
+import datetime
+
+
+def forwards_func(apps, schema_editor):
+    CrawlableUrl = apps.get_model("storage", "CrawlableUrl")
+    Result = apps.get_model("crawl", "Result")
+    last_crawl = Result.objects.filter(url_id=OuterRef("url_id")).order_by("-crawl_begin").values("crawl_begin")[:1]
+    CrawlableUrl.objects.filter(Exists(Result.objects.filter(url_id=OuterRef("url_id")))).update(
+        last_crawled_at=Subquery(last_crawl)
+    )
+
+
+def reverse_func(apps, schema_editor):
+    # Nothing to do, the column is about to be dropped anyway.
+    pass
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("crawl", "0007_squatproof"),
+        ("storage", "0013_domain_scheduling_columns"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="crawlableurl",
+            name="last_crawled_at",
+            field=models.DateTimeField(default=datetime.datetime(1970, 1, 1, 0, 0, tzinfo=datetime.timezone.utc)),
+        ),
+        migrations.AddField(
+            model_name="stagingcrawlableurl",
+            name="last_crawled_at",
+            field=models.DateTimeField(default=datetime.datetime(1970, 1, 1, 0, 0, tzinfo=datetime.timezone.utc)),
+        ),
+        migrations.RunPython(forwards_func, reverse_func, elidable=True),
+        migrations.AddIndex(
+            model_name="crawlableurl",
+            index=models.Index(fields=["domain", "last_crawled_at"], name="crawlableurl_domain_last_crawl"),
+        ),
+        migrations.AddIndex(
+            model_name="stagingcrawlableurl",
+            index=models.Index(fields=["domain", "last_crawled_at"], name="stagingcrurl_domain_last_crawl"),
+        ),
+    ]
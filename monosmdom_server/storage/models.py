@@ -1,4 +1,5 @@
 from django.db import models
+import datetime
 
 # Questions that the models shall answer:
 # - Give me a random URL with at least one occurrence whose domain hasn't been contacted for at least 5 minutes and isn't ignored.
@@ -23,16 +24,53 @@ from django.db import models
 
 
 URL_TRUNCATION_LENGTH = 50
+# Each domain is contacted at most once in this many days. See also crawl.logic.
+CRAWL_DOMAIN_DELAY_DAYS = 25
+# The Domain.next_due of domains that were never contacted, i.e. "immediately". Not None, because
+# SQLite can't create indexes with "NULLS FIRST":
+NEVER_CONTACTED_DUE = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+# The CrawlableUrl.last_crawled_at of URLs that were never crawled. Not None for the same reason.
+NEVER_CRAWLED = NEVER_CONTACTED_DUE
+
+
+def next_due_after(last_contacted):
+    if last_contacted is None:
+        return NEVER_CONTACTED_DUE
+    # In UTC, because adding days to a local time would be off by an hour across DST changes:
+    return last_contacted.astimezone(datetime.timezone.utc) + datetime.timedelta(days=CRAWL_DOMAIN_DELAY_DAYS)
 
 
 class Domain(models.Model):
     # Domain names can be insanely long. OSM Germany contains a working domain name with 76 characters!
     domain_name = models.CharField(max_length=200, unique=True, db_index=True)
     last_contacted = models.DateTimeField(db_index=True, default=None, null=True)
+    # The following two columns are redundant, and only exist so that the crawler can pick the next
+    # domain with a single lookup in the partial index below, instead of joining ~400k domains with
+    # their CrawlableUrls for every single crawl:
+    # - When the domain may be contacted again. Usually derived from last_contacted by save(), except
+    #   while a crawler holds a lease on the domain (see crawl.logic.lease_due_domains).
+    next_due = models.DateTimeField(default=NEVER_CONTACTED_DUE)
+    # - Whether at least one CrawlableUrl belongs to this domain. CrawlableUrl.save() sets it, and
+    #   after writing CrawlableUrls in bulk (i.e. imports), call storage.logic.refresh_domain_has_crawlable().
+    has_crawlable = models.BooleanField(default=False)
 
     def __str__(self):
         return f"<Domain#{self.id} {self.domain_name}>"
 
+    def save(self, *args, **kwargs):
+        # Note that QuerySet.update() and bulk_create() bypass this.
+        self.next_due = next_due_after(self.last_contacted)
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and "last_contacted" in update_fields:
+            kwargs["update_fields"] = {*update_fields, "next_due"}
+        super().save(*args, **kwargs)
+
+    class Meta:
+        indexes = [
+            # Exactly matches the queries in crawl.logic.pick_and_bump_random_crawlable_url and lease_due_domains:
+            models.Index(fields=["next_due"], name="domain_next_due_crawlable", condition=models.Q(has_crawlable=True)),
+        ]
+
 
 class Url(models.Model):
     # URLs can be insanely long, but there also seems to be a limit of 255 characters. Use that!
@@ -70,10 +108,27 @@ class CrawlableUrl(models.Model):
     # Despite the name, a Url may be associated with zero or one CrawlableUrl:
     url = models.OneToOneField(Url, on_delete=models.RESTRICT, primary_key=True)
     domain = models.ForeignKey(Domain, on_delete=models.RESTRICT)
+    # Redundant: The crawl_begin of the most recent crawl.models.Result of this URL. This lets the
+    # crawler pick the least recently crawled URL of a domain with a single index lookup, instead of
+    # joining all results of all URLs of the domain. Result.save() keeps it up to date, and after
+    # writing CrawlableUrls in bulk (i.e. imports), see update_osm_state.refresh_last_crawled_at().
+    last_crawled_at = models.DateTimeField(default=NEVER_CRAWLED)
 
     def __str__(self):
         return f"<CrawlableUrl#{self.url_id} {self.url.truncated}>"
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        # Keep Domain.has_crawlable up to date.
+        # Bulk writes must call storage.logic.refresh_domain_has_crawlable() instead.
+        Domain.objects.filter(id=self.domain_id, has_crawlable=False).update(has_crawlable=True)
+
+    class Meta:
+        indexes = [
+            # Exactly matches the query in crawl.logic.pick_random_crawlable_url_from_bumped_domain:
+            models.Index(fields=["domain", "last_crawled_at"], name="crawlableurl_domain_last_crawl"),
+        ]
+
 
 class OccurrenceInOsm(models.Model):
     url = models.ForeignKey(Url, on_delete=models.RESTRICT)
@@ -99,5 +154,36 @@ class OccurrenceInOsm(models.Model):
 class Import(models.Model):
     urlfile_name = models.CharField(max_length=200)
     import_begin = models.DateTimeField()
-    import_end = models.DateTimeField()
+    # Only None while a resumable import is still being staged (see update_osm_state --resumable):
+    import_end = models.DateTimeField(null=True)
     additional_data = models.TextField()  # JSON
+
+
+# Staging tables for resumable imports (see update_osm_state --resumable). At the very end, these
+# are either swapped with their live counterparts by renaming, or copied over. So when changing the
+# columns or indexes of DisasterUrl, CrawlableUrl, or OccurrenceInOsm, change them here, too!
+# Note that the staging tables are never referenced from anywhere else, hence related_name="+".
+class StagingDisasterUrl(models.Model):
+    url = models.OneToOneField(Url, on_delete=models.RESTRICT, primary_key=True, related_name="+")
+    reason = models.CharField()
+
+
+class StagingCrawlableUrl(models.Model):
+    url = models.OneToOneField(Url, on_delete=models.RESTRICT, primary_key=True, related_name="+")
+    domain = models.ForeignKey(Domain, on_delete=models.RESTRICT, related_name="+")
+    last_crawled_at = models.DateTimeField(default=NEVER_CRAWLED)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["domain", "last_crawled_at"], name="stagingcrurl_domain_last_crawl"),
+        ]
+
+
+class StagingOccurrenceInOsm(models.Model):
+    url = models.ForeignKey(Url, on_delete=models.RESTRICT, related_name="+")
+    osm_item_type = models.CharField(max_length=1, blank=False)
+    osm_item_id = models.BigIntegerField()
+    osm_tag_key = models.CharField(max_length=100)
+    osm_tag_value = models.CharField(max_length=300)
+    osm_long = models.FloatField(default=50)
+    osm_lat = models.FloatField(default=10)
@@ -0,0 +1,147 @@
+from django.test import TestCase
+from storage import extract_cleanup, extract_cleanup_streaming, logic
+from storage.management.commands import generate_urlfile, update_osm_state
+import contextlib
+import io
+import json
+import os
+import tempfile
+
+
+class UrlfileGeneratorTests(TestCase):
+    def test_deterministic(self):
+        self.assertEqual(
+            generate_urlfile.UrlfileGenerator(100, seed=42).raw_data(),
+            generate_urlfile.UrlfileGenerator(100, seed=42).raw_data(),
+        )
+        self.assertNotEqual(
+            generate_urlfile.UrlfileGenerator(100, seed=42).raw_data(),
+            generate_urlfile.UrlfileGenerator(100, seed=43).raw_data(),
+        )
+
+    def test_distribution(self):
+        generator = generate_urlfile.UrlfileGenerator(0)
+        num_occs = [generator.num_occs() for _ in range(100000)]
+        self.assertLessEqual(max(num_occs), generate_urlfile.OCCS_MAX)
+        self.assertAlmostEqual(
+            sum(n >= 2 for n in num_occs) / len(num_occs), generate_urlfile.OCCS_SHARE_MULTIPLE, delta=0.005
+        )
+        # The heavy tail makes the average quite noisy:
+        self.assertAlmostEqual(sum(num_occs) / len(num_occs), 1.244, delta=0.1)
+
+    def test_cleanup(self):
+        data = generate_urlfile.UrlfileGenerator(2000).raw_data()
+        extract_cleanup.cleanup(data, logic.get_cached_psl())
+        self.assertAlmostEqual(len(data["simplified_urls"]), 2000, delta=100)
+        self.assertGreater(len(data["disasters"]), 0)
+        self.assertIn(False, {entry["i"] for entry in data["simplified_urls"].values()})
+
+
+class StreamingCleanupTests(TestCase):
+    def test_external_group_by(self):
+        grouper = extract_cleanup_streaming.ExternalGroupBy(max_buffered=3)
+        for order, key in enumerate(["b", "a", "c", "a", "b", "a", "d"]):
+            grouper.add(key, order, f"{key}{order}")
+        self.assertEqual(len(grouper.runs), 2)
+        self.assertEqual(
+            list(grouper.groups()),
+            [
+                ("a", [(1, "a1"), (3, "a3"), (5, "a5")]),
+                ("b", [(0, "b0"), (4, "b4")]),
+                ("c", [(2, "c2")]),
+                ("d", [(6, "d6")]),
+            ],
+        )
+        grouper.close()
+
+    def cleanup_both_ways(self, raw_data, psl, spill_entries):
+        in_memory = json.loads(json.dumps(raw_data))
+        with contextlib.redirect_stdout(io.StringIO()):
+            extract_cleanup.cleanup(in_memory, psl)
+        in_memory = json.loads(json.dumps(in_memory, cls=extract_cleanup.DisasterEncoder))
+        output = io.StringIO()
+        writer = extract_cleanup_streaming.JsonUrlfileWriter(output, dict(v=in_memory["v"], type=in_memory["type"]))
+        with contextlib.redirect_stdout(io.StringIO()):
+            extract_cleanup_streaming.cleanup_streaming(
+                io.BytesIO(json.dumps(raw_data).encode()), writer, psl, spill_entries=spill_entries
+            )
+        return in_memory, json.loads(output.getvalue())
+
+    def test_same_as_in_memory(self):
+        raw_data = generate_urlfile.UrlfileGenerator(1000).raw_data()
+        for spill_entries in [10, 100000]:
+            with self.subTest(spill_entries=spill_entries):
+                in_memory, streamed = self.cleanup_both_ways(raw_data, logic.get_cached_psl(), spill_entries)
+                self.assertEqual(in_memory, streamed)
+                # In v3, even the order is the same:
+                self.assertEqual(list(in_memory["simplified_urls"]), list(streamed["simplified_urls"]))
+                in_memory, streamed = self.cleanup_both_ways(raw_data, None, spill_entries)
+                self.assertEqual(in_memory, streamed)
+                self.assertEqual(sorted(in_memory["simplified_urls"]), list(streamed["simplified_urls"]))
+
+    def test_parallel_same_as_serial(self):
+        raw_data = generate_urlfile.UrlfileGenerator(1000).raw_data()
+        outputs = []
+        for jobs in [1, 3]:
+            data = json.loads(json.dumps(raw_data))
+            with contextlib.redirect_stdout(io.StringIO()):
+                extract_cleanup.cleanup(data, logic.get_cached_psl(), jobs=jobs)
+            outputs.append(json.dumps(data, cls=extract_cleanup.DisasterEncoder))
+        self.assertEqual(outputs[0], outputs[1])
+
+    def test_parallel_chars(self):
+        # Tiny chunks, so that the same regexed URL shows up in several chunks:
+        findings = [
+            dict(url=url, occ=[])
+            for url in ["https://ä.de", "https://ä.de#", "https://ö.de;https://ä.de", "ftp://ü.de"]
+        ]
+        by_regexed_url = extract_cleanup.simplify_regex(
+            findings, extract_cleanup.defaultdict(extract_cleanup.DisasterUrl)
+        )
+        _, all_seen_chars = extract_cleanup.simplify_semantically(
+            by_regexed_url, extract_cleanup.defaultdict(extract_cleanup.DisasterUrl)
+        )
+        preprocessed = extract_cleanup.preprocess_parallel(findings, 2, chunk_size=1)
+        self.assertEqual(list(all_seen_chars.items()), list(preprocessed.all_seen_chars.items()))
+        self.assertEqual(preprocessed.all_seen_chars["ä"], 1)
+
+    def test_json_writer(self):
+        data = dict(v=2, type="monitor-osm-domains extraction results, filtered", disasters={}, simplified_urls={})
+        output = io.StringIO()
+        extract_cleanup_streaming.JsonUrlfileWriter(output, dict(v=2, type=data["type"])).finish()
+        self.assertEqual(output.getvalue(), json.dumps(data))
+        data["disasters"]["ftp://x.de/"] = dict(reasons=["unusual scheme ftp"], occs=[dict(t="n", id=1)])
+        data["simplified_urls"]["https://x.de/"] = [dict(t="w", id=2)]
+        output = io.StringIO()
+        writer = extract_cleanup_streaming.JsonUrlfileWriter(output, dict(v=2, type=data["type"]))
+        writer.write_disaster("ftp://x.de/", ["unusual scheme ftp"], [dict(t="n", id=1)])
+        writer.write_simplified_url("https://x.de/", [dict(t="w", id=2)])
+        writer.finish()
+        self.assertEqual(output.getvalue(), json.dumps(data))
+
+    def test_run_from_server(self):
+        # The server imports cleanup.py and its siblings through the symlinks in storage/:
+        raw_data = generate_urlfile.UrlfileGenerator(300).raw_data()
+        with tempfile.TemporaryDirectory() as tempdir:
+            raw_filename = os.path.join(tempdir, "raw.monosmdom.json")
+            with open(raw_filename, "w") as fp:
+                json.dump(raw_data, fp)
+            results = []
+            for streaming in [False, True]:
+                for output_format in extract_cleanup.OUTPUT_FORMATS:
+                    output_filename = os.path.join(tempdir, f"{streaming}.{output_format}")
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        extract_cleanup.run(
+                            raw_filename,
+                            output_filename,
+                            format_version=2,
+                            output_format=output_format,
+                            streaming=streaming,
+                        )
+                    with open(output_filename, "rb") as fp:
+                        urlfile_stream = update_osm_state.read_urlfile(fp)
+                        results.append((dict(urlfile_stream.disasters()), dict(urlfile_stream.simplified_urls())))
+                        urlfile_stream.finish()
+        self.assertGreater(len(results[0][1]), 0)
+        for result in results[1:]:
+            self.assertEqual(result, results[0])
@@ -0,0 +1,676 @@
+from django.db import connection, transaction
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from storage import extract_cleanup, extract_cleanup_binary, importing, logic, models
+from storage.management.commands import update_osm_state
+import contextlib
+import crawl.models
+import datetime
+import io
+import json
+import tempfile
+
+
+class JsonStreamReaderTests(TestCase):
+    DOCUMENT = {
+        "v": 2,
+        "type": "some type with \"escapes\" and ümläuts",
+        "nested": {"empty_obj": {}, "empty_list": [], "numbers": [1, -23, 4.5e6, 1234567890123]},
+        "more": [True, False, None, "ß" * 30],
+    }
+
+    def make_reader(self, document, chunk_size):
+        encoded = json.dumps(document, ensure_ascii=False).encode()
+        return extract_cleanup.JsonStreamReader(io.BytesIO(encoded), chunk_size=chunk_size)
+
+    def test_read_value(self):
+        # Tiny chunks force values, numbers and multi-byte characters to be cut at buffer boundaries:
+        for chunk_size in [1, 2, 3, 7, 1000]:
+            with self.subTest(chunk_size=chunk_size):
+                reader = self.make_reader(self.DOCUMENT, chunk_size)
+                self.assertEqual(reader.read_value(), self.DOCUMENT)
+                reader.expect_eof()
+
+    def test_iter_nested(self):
+        for chunk_size in [1, 3, 1000]:
+            with self.subTest(chunk_size=chunk_size):
+                reader = self.make_reader(self.DOCUMENT, chunk_size)
+                seen = dict()
+                for key in reader.iter_object_keys():
+                    if key == "nested":
+                        seen[key] = dict(reader.iter_object_items())
+                    elif key == "more":
+                        seen[key] = list(reader.iter_array())
+                    else:
+                        seen[key] = reader.read_value()
+                reader.expect_eof()
+                self.assertEqual(seen, self.DOCUMENT)
+
+    def test_bare_floats(self):
+        # Here, numbers can be cut right before "." or "e", which still leaves a valid (shorter) number:
+        for chunk_size in [1, 2, 3, 6, 1000]:
+            with self.subTest(chunk_size=chunk_size):
+                reader = extract_cleanup.JsonStreamReader(
+                    io.BytesIO(b"[1.25, 3e5, 12345.5, -0.5E-3]"), chunk_size=chunk_size
+                )
+                self.assertEqual(list(reader.iter_array()), [1.25, 3e5, 12345.5, -0.5e-3])
+                reader.expect_eof()
+                reader = extract_cleanup.JsonStreamReader(io.BytesIO(b"12345.5"), chunk_size=chunk_size)
+                self.assertEqual(reader.read_value(), 12345.5)
+                reader.expect_eof()
+
+    def test_trailing_garbage(self):
+        reader = extract_cleanup.JsonStreamReader(io.BytesIO(b'{"a": 1} {}'))
+        self.assertEqual(reader.read_value(), {"a": 1})
+        with self.assertRaises(ValueError):
+            reader.expect_eof()
+
+
+class UrlfileStreamTests(TestCase):
+    def test_sections(self):
+        data = {
+            "v": 2,
+            "type": "monitor-osm-domains extraction results, filtered",
+            "disasters": {
+                "http:// bsr.de": {
+                    "occs": [{"id": 1, "k": "website", "orig_url": "http:// bsr.de", "t": "n", "x": 1.5, "y": 2.5}],
+                    "reasons": ["weird character b' '"],
+                },
+            },
+            "simplified_urls": {
+                "https://foo.com/": [
+                    {"id": 2, "k": "url", "orig_url": "https://foo.com", "t": "w", "x": 3.5, "y": 4.5}
+                ],
+                "https://bar.com/": [],
+            },
+        }
+        with tempfile.TemporaryFile() as fp:
+            fp.write(json.dumps(data).encode())
+            fp.seek(0)
+            urlfile_stream = update_osm_state.read_urlfile(fp)
+            self.assertEqual(dict(urlfile_stream.disasters()), data["disasters"])
+            self.assertEqual(dict(urlfile_stream.simplified_urls()), data["simplified_urls"])
+            urlfile_stream.finish()
+            self.assertEqual(urlfile_stream.fraction_done(), 1.0)
+        self.assertEqual(urlfile_stream.num_disasters, 1)
+        self.assertEqual(urlfile_stream.num_simplified_urls, 2)
+
+    def test_binary_matches_json(self):
+        occ_a = {"id": 1, "k": "website", "orig_url": "http:// bsr.de", "t": "n", "x": 13.404954, "y": 52.520008}
+        occ_b = {
+            "id": 9876543210,
+            "k": "contact:website",
+            "orig_url": "https://foo.com;https://bär.com",
+            "t": "r",
+            "x": -1.5,
+            "y": 0.0,
+        }
+        occ_c = {"id": 3, "k": "url", "orig_url": "https://foo.com", "t": "w", "x": 3.5, "y": 4.5}
+        for version, entries in [
+            (2, {"https://foo.com/": [occ_b, occ_c, occ_b], "https://bär.com/": [occ_b], "https://empty.com/": []}),
+            (
+                3,
+                {
+                    "https://foo.com/": dict(d="foo.com", i=True, occs=[occ_b, occ_c]),
+                    "https://bär.com/": dict(d="xn--br-via.com", i=False, occs=[occ_b]),
+                },
+            ),
+        ]:
+            data = {
+                "v": version,
+                "type": "monitor-osm-domains extraction results, filtered",
+                "disasters": {
+                    "http:// bsr.de": {"occs": [occ_a], "reasons": ["weird character b' '"]},
+                    "https://foo.invalid/": {
+                        "occs": [occ_a, occ_c],
+                        "reasons": ["has no public suffix", "weird character b' '"],
+                    },
+                },
+                "simplified_urls": entries,
+            }
+            with self.subTest(version=version), tempfile.TemporaryFile() as fp:
+                writer = extract_cleanup_binary.BinaryUrlfileWriter(
+                    fp, dict(v=data["v"], type=data["type"]), block_size=2
+                )
+                for url_string, disaster in data["disasters"].items():
+                    writer.write_disaster(url_string, disaster["reasons"], disaster["occs"])
+                for url_string, entry in data["simplified_urls"].items():
+                    writer.write_simplified_url(url_string, entry)
+                writer.finish()
+                fp.seek(0)
+                urlfile_stream = update_osm_state.read_urlfile(fp)
+                self.assertIsInstance(urlfile_stream, update_osm_state.BinaryUrlfileStream)
+                self.assertEqual(urlfile_stream.version, version)
+                self.assertEqual(dict(urlfile_stream.disasters()), data["disasters"])
+                self.assertEqual(dict(urlfile_stream.simplified_urls()), data["simplified_urls"])
+                urlfile_stream.finish()
+                self.assertEqual(urlfile_stream.fraction_done(), 1.0)
+
+    def test_binary_truncated(self):
+        with tempfile.TemporaryFile() as fp:
+            writer = extract_cleanup_binary.BinaryUrlfileWriter(
+                fp, dict(v=2, type="monitor-osm-domains extraction results, filtered")
+            )
+            writer.write_simplified_url("https://foo.com/", [])
+            writer.finish()
+            fp.truncate(fp.tell() - 1)
+            fp.seek(0)
+            urlfile_stream = update_osm_state.read_urlfile(fp)
+            with self.assertRaises(ValueError):
+                list(urlfile_stream.simplified_urls())
+
+    def test_v3_matches_v2(self):
+        def make_raw():
+            return {
+                "v": 2,
+                "type": "monitor-osm-domains extraction results",
+                "findings": [
+                    {
+                        "url": "https://www.foo.com/x;https://bar.foo.com",
+                        "occ": [{"id": 1, "k": "website", "t": "n", "x": 1.5, "y": 2.5}],
+                    },
+                    {"url": "https://www.wuppertal.de/", "occ": [{"id": 2, "k": "url", "t": "w", "x": 3.5, "y": 4.5}]},
+                    {"url": "https://foo.invalid/", "occ": [{"id": 3, "k": "website", "t": "r", "x": 5.5, "y": 6.5}]},
+                    {"url": "https://aaa.com", "occ": [{"id": 4, "k": "website", "t": "n", "x": 7.5, "y": 8.5}]},
+                ],
+            }
+        data_v2 = make_raw()
+        extract_cleanup.cleanup(data_v2)
+        data_v3 = make_raw()
+        extract_cleanup.cleanup(data_v3, logic.get_cached_psl())
+        self.assertEqual(data_v3["v"], 3)
+        self.assertEqual(list(data_v3["simplified_urls"].keys()), [
+            "https://aaa.com/",
+            "https://bar.foo.com/",
+            "https://www.foo.com/x",
+            "https://www.wuppertal.de/",
+        ])
+        self.assertEqual(data_v3["simplified_urls"]["https://www.wuppertal.de/"]["d"], "wuppertal.de")
+        self.assertFalse(data_v3["simplified_urls"]["https://www.wuppertal.de/"]["i"])
+        self.assertEqual(data_v3["disasters"]["https://foo.invalid/"].reasons, {"has no public suffix"})
+        for data in [data_v2, data_v3]:
+            with tempfile.TemporaryFile() as fp:
+                fp.write(json.dumps(data, cls=extract_cleanup.DisasterEncoder).encode())
+                fp.seek(0)
+                update_osm_state.update_osm_state(update_osm_state.read_urlfile(fp))
+            with self.subTest(v=data["v"]):
+                self.assertEqual(
+                    set(models.CrawlableUrl.objects.values_list("url__url", "domain__domain_name")),
+                    {
+                        ("https://aaa.com/", "aaa.com"),
+                        ("https://bar.foo.com/", "foo.com"),
+                        ("https://www.foo.com/x", "foo.com"),
+                    },
+                )
+                self.assertEqual(
+                    list(models.DisasterUrl.objects.values_list("url__url", "reason")),
+                    [("https://foo.invalid/", "has no public suffix")],
+                )
+                self.assertEqual(models.OccurrenceInOsm.objects.count(), 5)
+
+
+class BulkUpsertTests(TestCase):
+    def test_mixed_existing_and_new(self):
+        existing = models.Url.objects.create(url="https://foo.com/")
+        url_ids = logic.bulk_upsert_urls(["https://bar.com/", "https://foo.com/", "https://bar.com/"])
+        self.assertEqual(set(url_ids.keys()), {"https://foo.com/", "https://bar.com/"})
+        self.assertEqual(url_ids["https://foo.com/"], existing.id)
+        self.assertEqual(models.Url.objects.get(url="https://bar.com/").id, url_ids["https://bar.com/"])
+        self.assertEqual(models.Url.objects.count(), 2)
+
+    def test_empty(self):
+        self.assertEqual(logic.bulk_upsert_domains([]), dict())
+
+    def test_chunked(self):
+        domain_names = [f"foo{i}.com" for i in range(logic.BULK_UPSERT_CHUNK_SIZE + 3)]
+        domain_ids = logic.bulk_upsert_domains(domain_names)
+        self.assertEqual(len(set(domain_ids.values())), len(domain_names))
+        self.assertEqual(models.Domain.objects.count(), len(domain_names))
+
+    def test_discover_with_cache(self):
+        known_domain = models.Domain.objects.create(domain_name="foo.com")
+        cache = logic.LeafModelBulkCache()
+        crawlable = logic.discover_url("https://www.foo.com/", mark_crawlable=True, cache=cache)
+        crawlable_again = logic.discover_url("https://bar.foo.com/", mark_crawlable=True, cache=cache)
+        disaster = logic.discover_url("https://foo.invalid/", mark_crawlable=True, cache=cache)
+        self.assertTrue(crawlable.want_to_crawl)
+        self.assertIs(crawlable.domain, crawlable_again.domain)
+        self.assertFalse(disaster.want_to_crawl)
+        cache.cache_occ(
+            url=crawlable.url_obj,
+            osm_item_type="n",
+            osm_item_id=1234,
+            osm_tag_key="website",
+            osm_tag_value="https://www.foo.com",
+        )
+        # Nothing reaches the DB before flushing:
+        self.assertEqual(models.Url.objects.count(), 0)
+        cache.flush()
+        self.assertEqual(crawlable.domain.id, known_domain.id)
+        self.assertEqual(models.Domain.objects.count(), 1)
+        self.assertEqual(models.CrawlableUrl.objects.filter(domain=known_domain).count(), 2)
+        self.assertEqual(models.DisasterUrl.objects.get().url.url, "https://foo.invalid/")
+        self.assertEqual(models.OccurrenceInOsm.objects.get().url_id, crawlable.url_obj.id)
+
+    def test_budget(self):
+        cache = logic.LeafModelBulkCache(max_objects=1000, max_bytes=5000)
+        url_obj = cache.url_instance("https://foo.com/")
+        self.assertFalse(cache.over_budget())
+        for i in range(10):
+            cache.cache_occ(
+                url=url_obj, osm_item_type="n", osm_item_id=i, osm_tag_key="website", osm_tag_value="https://foo.com"
+            )
+        # Way below max_objects, but the estimated bytes are too much:
+        self.assertTrue(cache.over_budget())
+        cache.flush()
+        self.assertFalse(cache.over_budget())
+        self.assertEqual(cache.flush_stats["flushes"], 1)
+        self.assertEqual(cache.flush_stats["objects"], 11)
+        self.assertEqual(models.OccurrenceInOsm.objects.count(), 10)
+
+    def test_import_with_tiny_budget(self):
+        occ = {"id": 1, "k": "website", "orig_url": "https://foo.com/", "t": "n", "x": 1.5, "y": 2.5}
+        data = {
+            "v": 2,
+            "type": "monitor-osm-domains extraction results, filtered",
+            "disasters": {f"http:// bad{i}.de": {"occs": [occ], "reasons": ["weird character b' '"]} for i in range(5)},
+            "simplified_urls": {f"https://foo{i}.com/": [occ] * i for i in range(10)},
+        }
+        with tempfile.TemporaryFile() as fp:
+            fp.write(json.dumps(data).encode())
+            fp.seek(0)
+            update_osm_state.update_osm_state(update_osm_state.read_urlfile(fp), flush_max_objects=3)
+        self.assertEqual(models.DisasterUrl.objects.count(), 5)
+        self.assertEqual(models.CrawlableUrl.objects.count(), 10)
+        self.assertEqual(models.OccurrenceInOsm.objects.count(), 5 + sum(range(10)))
+
+    def test_disasters_batched(self):
+        occ = {"id": 1, "k": "website", "orig_url": "http:// bad.de", "t": "n", "x": 1.5, "y": 2.5}
+        data = {
+            "v": 2,
+            "type": "monitor-osm-domains extraction results, filtered",
+            "disasters": {
+                f"http:// bad{i}.de": {"occs": [occ], "reasons": ["has no public suffix", "weird character b' '"]}
+                for i in range(200)
+            },
+            "simplified_urls": {},
+        }
+        models.Url.objects.create(url="http:// bad0.de")
+        with tempfile.TemporaryFile() as fp:
+            fp.write(json.dumps(data).encode())
+            fp.seek(0)
+            with CaptureQueriesContext(connection) as queries:
+                update_osm_state.update_osm_state(update_osm_state.read_urlfile(fp))
+        # Not one (or two) round trips per disaster:
+        self.assertLess(len(queries), 30)
+        self.assertEqual(models.Url.objects.count(), 200)
+        self.assertEqual(models.OccurrenceInOsm.objects.count(), 200)
+        self.assertEqual(set(models.DisasterUrl.objects.values_list("reason", flat=True)), {"weird character b' '"})
+
+    def test_sort_by_domain(self):
+        cache = logic.LeafModelBulkCache(sort_by_domain=True)
+        for url_string in ["https://b.com/2", "https://a.com/", "https://b.com/1", "https://www.a.com/"]:
+            logic.discover_url(url_string, mark_crawlable=True, cache=cache)
+        cache.flush()
+        self.assertEqual(cache.domain_switches, dict(unsorted=3, sorted=1))
+        urls_by_id = list(models.Url.objects.order_by("id").values_list("url", flat=True))
+        self.assertEqual(urls_by_id, ["https://a.com/", "https://www.a.com/", "https://b.com/1", "https://b.com/2"])
+        self.assertEqual(
+            list(models.Domain.objects.order_by("id").values_list("domain_name", flat=True)), ["a.com", "b.com"]
+        )
+
+    def test_copy_row(self):
+        # The COPY path itself needs PostgreSQL, but the row conversion can be checked anywhere.
+        cache = logic.LeafModelBulkCache(use_copy=False)
+        url_obj = cache.url_instance("https://foo.com/")
+        cache.cache_occ(
+            url=url_obj, osm_item_type="n", osm_item_id=1234, osm_tag_key="website", osm_tag_value="https://foo.com"
+        )
+        occ = cache.objs_occurrenceinosm[0]
+        fields = logic.copy_fields(models.OccurrenceInOsm)
+        self.assertNotIn("id", [field.name for field in fields])
+        cache.resolve_pending()
+        # The occurrence was created before the Url had an ID:
+        self.assertIsNone(occ.url_id)
+        row = dict(zip([field.column for field in fields], logic.copy_row(occ, fields)))
+        self.assertEqual(row["url_id"], url_obj.id)
+        self.assertEqual(row["osm_item_id"], 1234)
+        self.assertEqual(row["osm_tag_value"], "https://foo.com")
+        self.assertEqual([field.column for field in logic.copy_fields(models.DisasterUrl)], ["url_id", "reason"])
+
+
+class SummaryTests(TestCase):
+    def test_single_query(self):
+        url = models.Url.objects.create(url="https://foo.com/")
+        models.Url.objects.create(url="https://bar.com/")
+        models.DisasterUrl.objects.create(url=url, reason="foo")
+        with CaptureQueriesContext(connection) as queries:
+            summary = update_osm_state.show_summary("now")
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(summary["urls"]["total"], 2)
+        self.assertEqual(summary["urls"]["disaster"], dict(entries=1, unique_urls=1))
+        self.assertEqual(summary["urls"]["ignored_obsolete"], 1)
+        self.assertEqual(summary["estimated"], [])
+
+    def test_estimate(self):
+        # Only PostgreSQL has estimates, and even there, a fresh table might not have one yet.
+        models.Url.objects.create(url="https://foo.com/")
+        counts, estimated_models = importing.count_rows([models.Url, models.Domain], estimate=[models.Url])
+        if connection.vendor != "postgresql":
+            self.assertEqual(estimated_models, [])
+        if not estimated_models:
+            self.assertEqual(counts, {models.Url: 1, models.Domain: 0})
+
+
+class ImportProfilerTests(TestCase):
+    def test_phases(self):
+        occ = {"id": 1, "k": "website", "orig_url": "https://foo.com/", "t": "n", "x": 1.5, "y": 2.5}
+        data = {
+            "v": 2,
+            "type": "monitor-osm-domains extraction results, filtered",
+            "disasters": {"http:// bsr.de": {"occs": [occ], "reasons": ["weird character b' '"]}},
+            "simplified_urls": {"https://foo.com/": [occ], "https://bar.com/": [occ, occ]},
+        }
+        profiler = importing.ImportProfiler()
+        with profiler.running(), tempfile.TemporaryFile() as fp:
+            fp.write(json.dumps(data).encode())
+            fp.seek(0)
+            update_osm_state.update_osm_state(update_osm_state.read_urlfile(fp), profiler=profiler)
+        report = profiler.report()
+        for phase in ["read", "disasters", "classification", "register", "url_upsert", "domain_upsert", "leaf_flush"]:
+            self.assertIn(phase, report["phases"])
+        self.assertEqual(report["phases"]["classification"]["calls"], 3)  # Including the final, empty call
+        self.assertGreater(report["phases"]["leaf_flush"]["queries"], 0)
+        self.assertGreater(report["peak_traced_bytes"], 0)
+        self.assertAlmostEqual(
+            report["total_seconds"], sum(stats["wall_seconds"] for stats in report["phases"].values())
+        )
+        # Must be serializable, as it ends up in Import.additional_data:
+        json.dumps(report)
+
+    def test_disabled(self):
+        profiler = importing.ImportProfiler(enabled=False)
+        items = [1, 2]
+        with profiler.running(), profiler.phase("read"):
+            self.assertIs(profiler.iter_phase("read", items), items)
+        self.assertEqual(profiler.stats, dict())
+
+
+class ResumableImportTests(TestCase):
+    DATA = {
+        "v": 2,
+        "type": "monitor-osm-domains extraction results, filtered",
+        "disasters": {
+            "http:// bsr.de": {
+                "occs": [{"id": 1, "k": "website", "orig_url": "http:// bsr.de", "t": "n", "x": 1.5, "y": 2.5}],
+                "reasons": ["weird character b' '"],
+            },
+        },
+        "simplified_urls": {
+            f"https://foo{i}.com/": [
+                {"id": 100 + i, "k": "url", "orig_url": f"https://foo{i}.com", "t": "w", "x": 3.5, "y": 4.5}
+            ]
+            for i in range(7)
+        },
+    }
+
+    def test_crash_and_resume(self):
+        models.DisasterUrl.objects.create(
+            url=models.Url.objects.create(url="https://redirected.invalid/"), reason="has no public suffix"
+        )
+        models.CrawlableUrl.objects.create(
+            url=models.Url.objects.create(url="https://obsolete.com/"),
+            domain=models.Domain.objects.create(domain_name="obsolete.com"),
+        )
+
+        class CrashingStream:
+            def __init__(self, urlfile_stream):
+                self.urlfile_stream = urlfile_stream
+
+            def __getattr__(self, name):
+                return getattr(self.urlfile_stream, name)
+
+            def simplified_urls(self):
+                for index, item in enumerate(self.urlfile_stream.simplified_urls()):
+                    if index == 4:
+                        raise RuntimeError("Simulated crash")
+                    yield item
+
+        with tempfile.NamedTemporaryFile() as fp:
+            fp.write(json.dumps(self.DATA).encode())
+            fp.flush()
+            import_obj = update_osm_state.find_or_begin_resumable_import(fp.name)
+            with open(fp.name, "rb") as urlfile_fp, self.assertRaises(RuntimeError):
+                checkpoint = update_osm_state.ImportCheckpoint(import_obj, checkpoint_entries=2)
+                update_osm_state.update_osm_state(
+                    CrashingStream(update_osm_state.read_urlfile(urlfile_fp)), checkpoint=checkpoint
+                )
+            # The disaster and three simplified URLs were processed, but only the first four entries were committed:
+            self.assertEqual(json.loads(models.Import.objects.get().additional_data)["resumable"]["entries_done"], 4)
+            self.assertEqual(models.StagingCrawlableUrl.objects.count(), 3)
+            self.assertEqual(models.StagingOccurrenceInOsm.objects.count(), 4)
+            # The live tables haven't been touched yet:
+            self.assertEqual(models.CrawlableUrl.objects.get().url.url, "https://obsolete.com/")
+
+            import_obj = update_osm_state.find_or_begin_resumable_import(fp.name)
+            with open(fp.name, "rb") as urlfile_fp:
+                checkpoint = update_osm_state.ImportCheckpoint(import_obj, checkpoint_entries=2)
+                update_osm_state.update_osm_state(update_osm_state.read_urlfile(urlfile_fp), checkpoint=checkpoint)
+        self.assertEqual(
+            checkpoint.state, dict(urlfile_size=len(json.dumps(self.DATA)), entries_done=8, finished_reading=True)
+        )
+        with transaction.atomic():
+            importing.publish_staging_tables()
+        self.assertEqual(
+            set(models.CrawlableUrl.objects.values_list("url__url", flat=True)),
+            set(self.DATA["simplified_urls"].keys()),
+        )
+        self.assertEqual(
+            set(models.DisasterUrl.objects.values_list("url__url", flat=True)),
+            {"http:// bsr.de", "https://redirected.invalid/"},
+        )
+        self.assertEqual(models.OccurrenceInOsm.objects.count(), 8)
+        self.assertEqual(models.StagingCrawlableUrl.objects.count(), 0)
+
+    def stage(self, data):
+        with tempfile.NamedTemporaryFile() as fp:
+            fp.write(json.dumps(data).encode())
+            fp.flush()
+            import_obj = update_osm_state.find_or_begin_resumable_import(fp.name)
+            with open(fp.name, "rb") as urlfile_fp:
+                checkpoint = update_osm_state.ImportCheckpoint(import_obj)
+                update_osm_state.update_osm_state(update_osm_state.read_urlfile(urlfile_fp), checkpoint=checkpoint)
+        import_obj.import_end = import_obj.import_begin
+        import_obj.save()
+
+    def test_swap(self):
+        models.DisasterUrl.objects.create(
+            url=models.Url.objects.create(url="https://redirected.invalid/"), reason="has no public suffix"
+        )
+        models.CrawlableUrl.objects.create(
+            url=models.Url.objects.create(url="https://obsolete.com/"),
+            domain=models.Domain.objects.create(domain_name="obsolete.com"),
+        )
+        self.stage(self.DATA)
+        with transaction.atomic():
+            importing.swap_staging_tables()
+        self.assertEqual(
+            set(models.CrawlableUrl.objects.values_list("url__url", flat=True)),
+            set(self.DATA["simplified_urls"].keys()),
+        )
+        self.assertEqual(
+            set(models.DisasterUrl.objects.values_list("url__url", flat=True)),
+            {"http:// bsr.de", "https://redirected.invalid/"},
+        )
+        self.assertEqual(models.OccurrenceInOsm.objects.count(), 8)
+        # The staging tables now contain the previous state:
+        self.assertEqual(models.StagingCrawlableUrl.objects.get().url.url, "https://obsolete.com/")
+        self.assert_index_names_follow_tables()
+        importing.wipe_staging_tables()
+        # And once more, to make sure that the swapped tables are still fully functional:
+        data = dict(self.DATA, simplified_urls={"https://bar.com/": []})
+        self.stage(data)
+        with transaction.atomic():
+            importing.swap_staging_tables()
+        self.assertEqual(list(models.CrawlableUrl.objects.values_list("url__url", flat=True)), ["https://bar.com/"])
+        self.assertEqual(models.OccurrenceInOsm.objects.count(), 1)
+        self.assertEqual(models.DisasterUrl.objects.count(), 2)
+        self.assert_index_names_follow_tables()
+
+    def test_swap_scheduling(self):
+        models.CrawlableUrl.objects.create(
+            url=models.Url.objects.create(url="https://obsolete.com/"),
+            domain=models.Domain.objects.create(domain_name="obsolete.com"),
+        )
+        crawled_before = models.NEVER_CRAWLED + datetime.timedelta(days=1)
+        crawl.models.Result.objects.create(
+            url=models.Url.objects.create(url="https://foo0.com/"), crawl_begin=crawled_before
+        )
+        self.stage(self.DATA)
+        profiler = importing.ImportProfiler(enabled=False)
+        with contextlib.redirect_stdout(io.StringIO()):
+            prepared = update_osm_state.prepare_staged_domain_scheduling(profiler)
+            # The crawler keeps going until the swap:
+            crawled_meanwhile = crawled_before + datetime.timedelta(days=1)
+            crawl.models.Result.objects.create(
+                url=models.Url.objects.get(url="https://foo1.com/"), crawl_begin=crawled_meanwhile
+            )
+            self.assertEqual(
+                list(models.Domain.objects.filter(has_crawlable=True).values_list("domain_name", flat=True)),
+                ["obsolete.com"],
+            )
+            with transaction.atomic():
+                importing.swap_staging_tables()
+                update_osm_state.finish_staged_domain_scheduling(prepared, profiler)
+        self.assertEqual(
+            set(models.Domain.objects.filter(has_crawlable=True).values_list("domain_name", flat=True)),
+            {f"foo{i}.com" for i in range(7)},
+        )
+        last_crawled_at = dict(models.CrawlableUrl.objects.values_list("url__url", "last_crawled_at"))
+        self.assertEqual(last_crawled_at.pop("https://foo0.com/"), crawled_before)
+        self.assertEqual(last_crawled_at.pop("https://foo1.com/"), crawled_meanwhile)
+        self.assertEqual(set(last_crawled_at.values()), {models.NEVER_CRAWLED})
+
+    def assert_index_names_follow_tables(self):
+        # Index names must stay with the model, not with the physical table that has been renamed:
+        with connection.cursor() as cursor:
+            for model in logic.LIVE_LEAF_MODELS + logic.STAGING_LEAF_MODELS:
+                constraints = connection.introspection.get_constraints(cursor, model._meta.db_table)
+                for index in model._meta.indexes:
+                    self.assertIn(index.name, constraints, model)
+
+
+class DomainSchedulingTests(TestCase):
+    def test_next_due(self):
+        domain = models.Domain.objects.create(domain_name="foo.com")
+        self.assertEqual(domain.next_due, models.NEVER_CONTACTED_DUE)
+        domain.last_contacted = models.NEVER_CONTACTED_DUE + datetime.timedelta(days=1)
+        domain.save(update_fields=["last_contacted"])
+        domain.refresh_from_db()
+        self.assertEqual(
+            domain.next_due, domain.last_contacted + datetime.timedelta(days=models.CRAWL_DOMAIN_DELAY_DAYS)
+        )
+
+    def test_has_crawlable(self):
+        domain = models.Domain.objects.create(domain_name="foo.com")
+        self.assertFalse(domain.has_crawlable)
+        models.CrawlableUrl.objects.create(url=models.Url.objects.create(url="https://foo.com/"), domain=domain)
+        domain.refresh_from_db()
+        self.assertTrue(domain.has_crawlable)
+        # Bulk writes bypass save():
+        other_domain = models.Domain.objects.create(domain_name="bar.com")
+        models.CrawlableUrl.objects.bulk_create(
+            [models.CrawlableUrl(url=models.Url.objects.create(url="https://bar.com/"), domain=other_domain)]
+        )
+        models.CrawlableUrl.objects.filter(domain=domain).delete()
+        self.assertEqual(logic.refresh_domain_has_crawlable(), (1, 1))
+        self.assertEqual(list(models.Domain.objects.filter(has_crawlable=True)), [other_domain])
+        self.assertEqual(logic.refresh_domain_has_crawlable(), (0, 0))
+
+    def test_import(self):
+        models.CrawlableUrl.objects.create(
+            url=models.Url.objects.create(url="https://obsolete.com/"),
+            domain=models.Domain.objects.create(domain_name="obsolete.com"),
+        )
+        crawled_url = models.Url.objects.create(url="https://foo.com/crawled")
+        models.CrawlableUrl.objects.create(url=crawled_url, domain=models.Domain.objects.create(domain_name="foo.com"))
+        crawl_begin = models.NEVER_CRAWLED + datetime.timedelta(days=1)
+        crawl.models.Result.objects.create(url=crawled_url, crawl_begin=crawl_begin)
+        data = dict(
+            v=2,
+            type="monitor-osm-domains extraction results, filtered",
+            disasters={},
+            simplified_urls={"https://foo.com/": [], "https://foo.com/crawled": []},
+        )
+        with contextlib.redirect_stdout(io.StringIO()):
+            with tempfile.TemporaryFile() as fp:
+                fp.write(json.dumps(data).encode())
+                fp.seek(0)
+                update_osm_state.update_osm_state(update_osm_state.read_urlfile(fp))
+        self.assertEqual(
+            list(models.Domain.objects.filter(has_crawlable=True).values_list("domain_name", flat=True)), ["foo.com"]
+        )
+        # The import re-wrote all CrawlableUrls, but the crawl history is still there:
+        self.assertEqual(
+            dict(models.CrawlableUrl.objects.values_list("url__url", "last_crawled_at")),
+            {"https://foo.com/": models.NEVER_CRAWLED, "https://foo.com/crawled": crawl_begin},
+        )
+
+
+class LeafModelDiffCacheTests(TestCase):
+    def discover_all(self, cache, urls_and_occ_ids):
+        for url_string, occ_ids in urls_and_occ_ids:
+            maybe_crawlable = logic.discover_url(url_string, mark_crawlable=True, cache=cache)
+            for occ_id in occ_ids:
+                cache.cache_occ(
+                    url=maybe_crawlable.url_obj,
+                    osm_item_type="n",
+                    osm_item_id=occ_id,
+                    osm_tag_key="website",
+                    osm_tag_value=url_string,
+                )
+        cache.flush()
+
+    def test_diff(self):
+        self.discover_all(logic.LeafModelBulkCache(), [
+            ("https://foo.com/", [1, 1, 2]),
+            ("https://bar.com/", [3]),
+        ])
+        cache = logic.LeafModelDiffCache()
+        self.discover_all(cache, [
+            ("https://foo.com/", [1, 2, 4]),
+            ("https://quux.com/", [5]),
+        ])
+        cache.delete_unseen()
+        self.assertEqual(
+            set(models.CrawlableUrl.objects.values_list("url__url", flat=True)),
+            {"https://foo.com/", "https://quux.com/"},
+        )
+        self.assertEqual(
+            sorted(models.OccurrenceInOsm.objects.values_list("url__url", "osm_item_id")),
+            [("https://foo.com/", 1), ("https://foo.com/", 2), ("https://foo.com/", 4), ("https://quux.com/", 5)],
+        )
+        self.assertEqual(cache.stats["crawlableurl"], dict(inserted=1, updated=0, deleted=1, unchanged=1))
+        self.assertEqual(cache.stats["occurrenceinosm"], dict(inserted=2, updated=0, deleted=2, unchanged=2))
+
+    def test_diff_domain_changed(self):
+        # For example, after a PSL update, the same Url might belong to a different Domain:
+        url_obj = models.Url.objects.create(url="https://foo.com/")
+        models.CrawlableUrl.objects.create(url=url_obj, domain=models.Domain.objects.create(domain_name="stale.com"))
+        cache = logic.LeafModelDiffCache()
+        self.discover_all(cache, [("https://foo.com/", [])])
+        cache.delete_unseen()
+        self.assertEqual(
+            dict(models.CrawlableUrl.objects.values_list("url_id", "domain__domain_name")), {url_obj.id: "foo.com"}
+        )
+        self.assertEqual(cache.stats["crawlableurl"], dict(inserted=0, updated=1, deleted=0, unchanged=0))
+
+    def test_diff_disaster_reason_changed(self):
+        url_obj = models.Url.objects.create(url="https://foo.invalid/")
+        models.DisasterUrl.objects.create(url=url_obj, reason="some outdated reason")
+        cache = logic.LeafModelDiffCache()
+        self.discover_all(cache, [("https://foo.invalid/", [])])
+        self.assertEqual(
+            dict(models.DisasterUrl.objects.values_list("url_id", "reason")), {url_obj.id: "has no public suffix"}
+        )
+        self.assertEqual(cache.stats["disasterurl"], dict(inserted=0, updated=1, deleted=0, unchanged=0))
@@ -1,5 +1,9 @@
 from django.test import TestCase
 from storage import extract_cleanup, logic
+from storage.management.commands import generate_urlfile, update_osm_state
+import os
+import pathlib
+import tempfile
 
 
 # Note that the simplification itself is already tested as self-tests during boot of extract_cleanup.py.
@@ -70,6 +74,15 @@ class UrlClassificationTests(TestCase):
             ("http://siko23.ddns3-instar.de:8081/", None, "refusing to use forced port 8081"),
         ])
 
+    def testEasyRepairPrefilter(self):
+        for entry in generate_urlfile.UrlfileGenerator(2000).raw_data()["findings"]:
+            for partial_url in extract_cleanup.RE_MULTI_VALUE.split(entry["url"]):
+                with self.subTest(partial_url=partial_url):
+                    self.assertEqual(
+                        extract_cleanup.repair_easy_stuff_thoroughly(partial_url),
+                        extract_cleanup.repair_easy_stuff(partial_url),
+                    )
+
 
 class SecondLevelDomainTests(TestCase):
     def assertSld(self, url_string, expected_sld, expected_interest):
@@ -252,3 +265,70 @@ class SecondLevelDomainTests(TestCase):
             ("https://sub.epma.care", "epma.care", True),
             ("https://epma.care", "epma.care", True),
         ])
+
+
+class PslSnapshotTests(TestCase):
+    def test_roundtrip(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            snapshot_filename = pathlib.Path(tempdir) / "psl.marshal"
+            logic.write_psl_snapshot(logic.get_cached_psl(), snapshot_filename)
+            psl = logic.load_psl_snapshot_or_none(snapshot_filename)
+            self.assertIsNotNone(psl)
+            for hostname in [
+                "www.foo.com",
+                "foo.bar.co.uk",
+                "something.blogspot.com",
+                "foo.invalid",
+                "xn--mnchen-3ya.de",
+            ]:
+                with self.subTest(hostname=hostname):
+                    self.assertEqual(
+                        psl.get_sld(hostname, strict=True), logic.get_cached_psl().get_sld(hostname, strict=True)
+                    )
+
+    def test_outdated(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            snapshot_filename = pathlib.Path(tempdir) / "psl.marshal"
+            self.assertIsNone(logic.load_psl_snapshot_or_none(snapshot_filename))
+            logic.write_psl_snapshot(logic.get_cached_psl(), snapshot_filename)
+            dat_mtime = logic.PSL_FILENAME.stat().st_mtime
+            os.utime(snapshot_filename, (dat_mtime - 1, dat_mtime - 1))
+            self.assertIsNone(logic.load_psl_snapshot_or_none(snapshot_filename))
+
+
+class ClassificationTests(TestCase):
+    URLS = [
+        "https://www.foo.com/",
+        "https://foo.invalid/",
+        "http://www.google.com/maps",
+        "https://example.co.uk/path?query",
+    ]
+
+    def test_classify(self):
+        self.assertEqual(logic.classify_url("https://www.foo.com/"), ("https://www.foo.com/", "foo.com", True, None))
+        disaster = logic.classify_url("https://foo.invalid/")
+        self.assertEqual((disaster.sld, disaster.disaster_reason), (None, "has no public suffix"))
+
+    def test_hostname_cache(self):
+        small_cache_info = logic.hostname_cache_info()
+        self.assertEqual(small_cache_info.maxsize, logic.DEFAULT_HOSTNAME_CACHE_SIZE)
+        with logic.large_hostname_cache():
+            self.assertEqual(logic.hostname_cache_info().maxsize, extract_cleanup.HOSTNAME_CACHE_SIZE)
+            for url_string, expected in [
+                ("https://www.wuppertal.de/foo", ("wuppertal.de", False)),
+                ("https://www.wuppertal.de/bar", ("wuppertal.de", False)),
+                ("https://jobcenter.wuppertal.de/", ("wuppertal.de", True)),
+            ]:
+                self.assertEqual(logic.get_strict_sld_and_interest(url_string), expected)
+            cache_info = logic.hostname_cache_info()
+            self.assertEqual((cache_info.hits, cache_info.misses), (1, 2))
+        # Afterwards, the large cache is gone, and the small one is untouched:
+        self.assertEqual(logic.hostname_cache_info(), small_cache_info)
+
+    def test_pool_matches_serial(self):
+        items = [(url_string, [index]) for index, url_string in enumerate(self.URLS * 3)]
+        serial = list(update_osm_state.iter_classified(items, None))
+        with update_osm_state.classification_pool(2) as pool:
+            parallel = list(update_osm_state.iter_classified(items, pool, batch_size=5))
+        self.assertEqual(parallel, serial)
+        self.assertEqual([occs for _url, _classification, occs in parallel], [[i] for i in range(len(items))])
@@ -10,11 +10,13 @@ import os
 def compute_fresh_stats():
     stats = dict()
     stats["Current server time"] = common.strftime(common.now_tzaware())
-    stats["OSM import epoch"] = storage.models.Import.objects.count()
+    # Unfinished resumable imports don't count:
+    finished_imports = storage.models.Import.objects.exclude(import_end=None)
+    stats["OSM import epoch"] = finished_imports.count()
     # This code was written long after the crawler already started running,
     # and I don't care too much about being able to run other instances.
     # So, we happily break here if there was no input yet.
-    most_recent_import = storage.models.Import.objects.order_by("-import_end")[0]
+    most_recent_import = finished_imports.order_by("-import_end")[0]
     stats["Most recent OSM import"] = common.strftime(most_recent_import.import_end)
     occ_total = storage.models.OccurrenceInOsm.objects.count()
     stats["OSM item-tags with URLs"] = f"{occ_total:,} entries"